@@ -1,3 +1,4 @@
 from .agent import Agent
+from .errors import JsonRpcError
 
-__all__ = ['Agent']
\ No newline at end of file
+__all__ = ['Agent', 'JsonRpcError']
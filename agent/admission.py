@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+from .errors import OVERLOADED, JsonRpcError
+
+CONTROL = "control"
+DATA = "data"
+NORMAL = "normal"
+
+# never shed or limited per connection, they keep working while the
+# Message lane is saturated. A METHOD_RATE_LIMITS entry still applies
+CONTROL_METHODS = frozenset(
+    (
+        "register_handler",
+        "register_behaviour",
+        "deactivate_behaviour",
+        "set_behaviour_interval",
+        "metrics",
+        "events",
+        "outbox_stats",
+        "receipt_stats",
+        "transfer_stats",
+        "webhook_stats",
+        "webhook_dead_letters",
+        "add_rule",
+        "add_rules",
+        "remove_rule",
+        "list_rules",
+        "negotiate_codec",
+        "peer_announce",
+        "mesh_routes",
+        "subscribe_topic",
+        "unsubscribe_topic",
+    )
+)
+DATA_METHODS = frozenset(("Message",))
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """0 when a token was taken, otherwise the seconds until one is available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+def parse_method_limits(value):
+    """Method=rate[:burst] pairs separated by commas"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        method, _, limit = item.partition("=")
+        rate, _, burst = limit.partition(":")
+        limits[method] = (float(rate), float(burst) if burst else None)
+    return limits
+
+
+class AdmissionControl:
+    """
+    Decides before dispatch whether a call is taken on. Calls take a token
+    of their method when it is limited and, except control methods, of
+    their connection. Message calls are shed while the inbox is filled
+    above shed_at of its capacity. Rejections are raised as OVERLOADED errors
+    carrying a retry_after hint in seconds
+    """
+
+    def __init__(
+        self,
+        inbox_queue,
+        client_rate=0,
+        client_burst=None,
+        method_limits=None,
+        shed_at=0.9,
+        retry_after=0.5,
+        methods=None,
+    ):
+        self.inbox_queue = inbox_queue
+        # dispatch table of the agent, rejections of other methods are
+        # counted under one label so made up names do not grow the metrics
+        self.methods = methods
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.method_buckets = {
+            method: TokenBucket(rate, burst)
+            for method, (rate, burst) in (method_limits or {}).items()
+        }
+        self.shed_at = shed_at
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_env(cls, inbox_queue, methods=None):
+        burst = os.getenv("CLIENT_RATE_BURST")
+        return cls(
+            inbox_queue,
+            client_rate=float(os.getenv("CLIENT_RATE_LIMIT", 0)),
+            client_burst=float(burst) if burst else None,
+            method_limits=parse_method_limits(os.getenv("METHOD_RATE_LIMITS", "")),
+            shed_at=float(os.getenv("INBOX_SHED_AT", 0.9)),
+            retry_after=float(os.getenv("OVERLOAD_RETRY_AFTER", 0.5)),
+            methods=methods,
+        )
+
+    def client(self):
+        """Token bucket of a new connection, None without a client limit"""
+        if not self.client_rate:
+            return None
+        return TokenBucket(self.client_rate, self.client_burst)
+
+    def priority(self, method):
+        if method in CONTROL_METHODS:
+            return CONTROL
+        if method in DATA_METHODS:
+            return DATA
+        return NORMAL
+
+    def saturated(self):
+        capacity = self.inbox_queue.maxsize
+        return capacity > 0 and self.inbox_queue.qsize() >= capacity * self.shed_at
+
+    def admit(self, method, client=None):
+        """Raises JsonRpcError when the call is rejected"""
+        priority = self.priority(method)
+        if priority == DATA and self.saturated():
+            self.reject(method, "inbox", "Inbox saturated", self.retry_after)
+        if client is not None and priority != CONTROL:
+            wait = client.take()
+            if wait:
+                self.reject(method, "client", "Client rate limit exceeded", wait)
+        bucket = self.method_buckets.get(method)
+        if bucket is not None:
+            wait = bucket.take()
+            if wait:
+                self.reject(method, "method", "Method rate limit exceeded", wait)
+
+    def reject(self, method, reason, message, retry_after):
+        if self.methods is not None and method not in self.methods:
+            method = "other"
+        REGISTRY.counter("rejected_calls_total", method=method, reason=reason).inc()
+        raise JsonRpcError(
+            OVERLOADED, message, data={"retry_after": round(retry_after, 3)}
+        )
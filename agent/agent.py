@@ -1,4 +1,6 @@
+import os
 import threading
+import inspect
 import json
 import logging
 import queue
@@ -6,15 +8,33 @@ import queue
 
 from dotenv import load_dotenv
 
+from .admission import AdmissionControl
 from .base_agent import BaseAgent
+from .errors import (
+    INTERNAL_ERROR,
+    INVALID_PARAMS,
+    INVALID_REQUEST,
+    METHOD_NOT_FOUND,
+    OVERLOADED,
+    PARSE_ERROR,
+    SERVER_ERROR,
+    JsonRpcError,
+)
 from behaviours import Behaviours
-from handlers import Handlers
-from w3 import W3
+from events import EVENTS
+from handlers import Handlers, WebhookDispatcher
+from messages import Message, Request, Response, message_from_dict
+from metrics import REGISTRY
+from w3 import W3, is_address
 
 load_dotenv()
 
 logger = logging.getLogger("App.Agent")
 
+JSONRPC_VERSION = "2.0"
+# most rows a single indexer query returns
+MAX_QUERY_LIMIT = 1000
+
 
 class Agent(BaseAgent):
     def __init__(self, inbox_queue, outbox_queue):
@@ -22,12 +42,57 @@ class Agent(BaseAgent):
         self.outbox_queue = outbox_queue
 
         self.w3 = W3()
-        self.handlers = Handlers(self.w3, self.inbox_queue)
+        if os.getenv("W3_EAGER") == "1":
+            # pay for web3 before listening instead of on the first chain call
+            self.w3.connect()
+        self.handlers = Handlers(
+            self.w3,
+            self.inbox_queue,
+            workers=int(os.getenv("HANDLER_WORKERS", 2)),
+            lanes={"chain": int(os.getenv("CHAIN_LANE_WORKERS", 1))},
+            transfer_window=float(os.getenv("TRANSFER_WINDOW", 1)),
+            transfer_window_size=int(os.getenv("TRANSFER_WINDOW_SIZE", 50)),
+            processes=int(os.getenv("CPU_LANE_PROCESSES", 2)),
+            webhooks=WebhookDispatcher(
+                concurrency=int(os.getenv("WEBHOOK_CONCURRENCY", 8)),
+                max_batch=int(os.getenv("WEBHOOK_MAX_BATCH", 100)),
+                attempts=int(os.getenv("WEBHOOK_ATTEMPTS", 5)),
+                timeout=float(os.getenv("WEBHOOK_TIMEOUT", 5)),
+            ),
+        )
         self.behaviours = Behaviours(self.w3, self.outbox_queue)
 
         self.stop_event = threading.Event()
         self.threads = []
 
+        # set by the server when the agent is part of a mesh
+        self.router = None
+        self.rpc_methods = {}
+        self.admission = AdmissionControl.from_env(self.inbox_queue, self.rpc_methods)
+
+        self.register_method("register_handler", self.register_handler)
+        self.register_method("register_behaviour", self.register_behaviour)
+        self.register_method("deactivate_behaviour", self.deactivate_behaviour)
+        self.register_method("set_behaviour_interval", self.set_behaviour_interval)
+        self.register_method("Message", self.deliver_message, raw=True)
+        self.register_method("receipt_stats", self.receipt_stats)
+        self.register_method("transfer_stats", self.transfer_stats)
+        self.register_method("metrics", self.metrics)
+        self.register_method("events", self.events)
+        self.register_method("webhook_stats", self.webhook_stats)
+        self.register_method("webhook_dead_letters", self.webhook_dead_letters)
+        self.register_method("add_rule", self.add_rule)
+        self.register_method("add_rules", self.add_rules)
+        self.register_method("remove_rule", self.remove_rule)
+        self.register_method("list_rules", self.list_rules)
+        self.register_method("indexed_balance", self.indexed_balance)
+        self.register_method("indexed_transfers", self.indexed_transfers)
+        self.register_method("balance_history", self.balance_history)
+        self.register_method("indexer_stats", self.indexer_stats)
+
+        REGISTRY.gauge("inbox_queue_depth", self.inbox_queue.qsize)
+        REGISTRY.gauge("outbox_queue_depth", self.outbox_queue.qsize)
+
     def start(self):
         logger.info("...Starting background behaviours & handlers...")
         self.behaviours.start()
@@ -36,47 +101,272 @@ class Agent(BaseAgent):
     def stop(self):
         logger.info("...Stopping background behaviours & handlers...")
         self.behaviours.stop()  # Signal the behavious to stop
+        self.handlers.stop()
 
-    def handle_request(self, request):
+    def register_method(self, name, func, raw=False):
+        """
+        Adds a method to the dispatch table, params of the call are
+        passed as positional or keyword arguments. Raw methods receive
+        the whole request object instead
+        """
+        self.rpc_methods[name] = (func, raw, inspect.signature(func))
+
+    def handle_request(self, request, client=None):
         """
         Simple Generic Router to handle JSON RPC requests
         If a request of type message is received it will be pushed
         to inbox queue
+
+        Accepts a single call or a JSON-RPC 2.0 batch, returns the
+        response, a list of responses for a batch or None when only
+        notifications were received. client is the token bucket of
+        the connection the request came in on
         """
         try:
             req_data = json.loads(request)
-            method = req_data.get("method")
-            params = req_data.get("params", [])
-            if method == "register_handler":
-                return self.register_handler(*params)
-            elif method == "register_behaviour":
-                return self.register_behaviour(*params)
-            if method == "Message":
-                self.inbox_queue.put(req_data)
-                logger.info(f"Received: {request}")
-                return {"result": "Message delivered to inbox"}
-            else:
-                return {"error": "Method not found"}
-        except queue.Full as e:
-            logger.error("inbox queue full" + str(e))
-            return {"error": "unknown error"}
         except json.JSONDecodeError as e:
             logger.error("Json Decode error" + str(e))
-            return {"error": "Invalid JSON"}
+            return self.error_response(None, JsonRpcError(PARSE_ERROR, "Invalid JSON"))
+        return self.handle_decoded(req_data, request, client)
+
+    def handle_decoded(self, req_data, json_text=None, client=None):
+        """
+        Routes a call, batch or message that was already decoded by
+        the connection codec, json_text is the text of a single call
+        """
+        if isinstance(req_data, Message):
+            try:
+                self.admission.admit("Message", client)
+                return self.deliver(req_data)
+            except JsonRpcError as e:
+                return self.error_response(None, e)
+        if isinstance(req_data, list):
+            if not req_data:
+                return self.error_response(
+                    None, JsonRpcError(INVALID_REQUEST, "Empty batch")
+                )
+            responses = [
+                self.handle_call(call, batch=True, client=client) for call in req_data
+            ]
+            return [response for response in responses if response is not None] or None
+        return self.handle_call(req_data, json_text=json_text, client=client)
+
+    def handle_call(self, req_data, batch=False, json_text=None, client=None):
+        """
+        Dispatches a single call. JSON-RPC 2.0 calls and batch entries
+        get a 2.0 response object and no reply at all when they carry
+        no id, other calls get the plain result or error object
+        """
+        try:
+            request = Request.from_dict(req_data, batch, json_text)
+        except ValueError:
+            error = JsonRpcError(INVALID_REQUEST, "Invalid Request")
+            is_dict = isinstance(req_data, dict)
+            if batch or (is_dict and req_data.get("jsonrpc") == JSONRPC_VERSION):
+                return self.error_response(
+                    req_data.get("id") if is_dict else None, error
+                )
+            return {"error": error.message}
+        try:
+            self.admission.admit(request.method, client)
+            response = self.dispatch(request)
+            if not request.is_v2:
+                return response
+            if "error" in response:
+                raise JsonRpcError(SERVER_ERROR, str(response["error"]))
+            if request.is_notification:
+                return None
+            return Response(request.id, response.get("result"))
+        except JsonRpcError as e:
+            if request.is_notification:
+                return None
+            if not request.is_v2:
+                if e.data is not None:
+                    return {"error": e.message, "data": e.data}
+                return {"error": e.message}
+            return self.error_response(request.id, e)
+
+    def dispatch(self, request):
+        method = request.method
+        if method not in self.rpc_methods:
+            raise JsonRpcError(METHOD_NOT_FOUND, "Method not found")
+        func, raw, signature = self.rpc_methods[method]
+        params = request.params
+        if raw:
+            args, kwargs = (request,), {}
+        elif isinstance(params, dict):
+            args, kwargs = (), params
+        elif isinstance(params, list):
+            args, kwargs = params, {}
+        else:
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params")
+        try:
+            signature.bind(*args, **kwargs)
+        except TypeError as e:
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params: " + str(e))
+        try:
+            return func(*args, **kwargs)
+        except JsonRpcError:
+            raise
+        except queue.Full as e:
+            logger.error("inbox queue full" + str(e))
+            raise self.overloaded()
         except Exception as e:
             logger.error("Unknown Exception" + str(e))
-            return {"error": str(e)}
+            raise JsonRpcError(INTERNAL_ERROR, str(e))
+
+    def error_response(self, request_id, error):
+        return Response(request_id, error=error.to_dict())
+
+    def deliver_message(self, request):
+        try:
+            message = message_from_dict(request.fields, request.json_text)
+        except ValueError as e:
+            raise JsonRpcError(INVALID_PARAMS, "Invalid message: " + str(e))
+        return self.deliver(message)
+
+    def deliver(self, message):
+        try:
+            if self.router is not None and self.router.is_addressed(message):
+                return {"result": self.router.route(message)}
+            self.enqueue(message)
+        except queue.Full:
+            REGISTRY.counter(
+                "rejected_calls_total", method="Message", reason="full"
+            ).inc()
+            raise self.overloaded()
+        return {"result": "Message delivered to inbox"}
 
-    def register_handler(self, message_type, url):
-        self.allowed_handlers[message_type] = url
+    def enqueue(self, message):
+        """Never blocks, raises queue.Full when the inbox is at capacity"""
+        self.inbox_queue.put_nowait(message)
+        logger.info("Received: %s", message)
+
+    def overloaded(self):
+        return JsonRpcError(
+            OVERLOADED,
+            "Inbox queue full",
+            data={"retry_after": self.admission.retry_after},
+        )
+
+    def metrics(self, format="json"):
+        if format == "prometheus":
+            return {"result": REGISTRY.prometheus()}
+        return {"result": REGISTRY.snapshot()}
+
+    def events(self, since=0, types=(), limit=100):
+        """
+        Events numbered after since, clients poll again with the returned
+        next number to follow the stream
+        """
+        last = EVENTS.last_seq()
+        events = EVENTS.since(since, types, limit)
+        return {
+            "result": {
+                "events": [event.to_dict() for event in events],
+                "next": events[-1].seq if events else max(since, last),
+            }
+        }
+
+    def receipt_stats(self):
+        return {"result": self.w3.receipt_tracker.stats()}
+
+    def transfer_stats(self):
+        return {"result": self.handlers.transfer_aggregator.stats()}
+
+    def register_handler(self, message_type, url, batch=False):
+        """
+        Forward inbox messages of message_type to url, with batch the
+        endpoint takes a JSON array of messages per POST
+        """
+        if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params: url must be http(s)")
+        self.handlers.webhooks.register(message_type, url, batch=bool(batch))
         return {"result": "handler Registered"}
 
+    def webhook_stats(self):
+        return {"result": self.handlers.webhooks.stats()}
+
+    def webhook_dead_letters(self, limit=100):
+        return {"result": list(self.handlers.webhooks.dead_letters)[-limit:]}
+
+    def add_rule(self, kind, pattern, action, field=None, params=None, id=None):
+        """
+        Run action on alphabet messages matching pattern, kind is word,
+        prefix, contains or field. A rule with the id of an existing one
+        replaces it
+        """
+        rule = {"kind": kind, "pattern": pattern, "action": action}
+        rule.update(field=field, params=params, id=id)
+        return {"result": self.add_rules([rule])["result"][0]}
+
+    def add_rules(self, rules):
+        """Adds every rule or, when one is invalid, none of them"""
+        if not isinstance(rules, list) or not all(isinstance(r, dict) for r in rules):
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params: rules must be objects")
+        try:
+            return {"result": self.handlers.add_rules(rules)}
+        except ValueError as e:
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params: " + str(e))
+
+    def remove_rule(self, id):
+        if not self.handlers.rule_engine.remove([id]):
+            return {"result": "No such rule"}
+        return {"result": "Rule removed"}
+
+    def list_rules(self):
+        return {"result": self.handlers.rule_engine.list()}
+
+    def indexer(self, address=None, limit=None):
+        if self.w3.indexer is None:
+            raise JsonRpcError(SERVER_ERROR, "Transfer indexer off, set INDEXER_DB")
+        if address is not None and not is_address(address):
+            raise JsonRpcError(INVALID_PARAMS, "Invalid params: address")
+        if limit is not None and not 0 < limit <= MAX_QUERY_LIMIT:
+            raise JsonRpcError(
+                INVALID_PARAMS, f"Invalid params: limit must be 1-{MAX_QUERY_LIMIT}"
+            )
+        return self.w3.indexer
+
+    def indexed_balance(self, address, block=None):
+        """Token base units held by address at block, from the local index"""
+        return {"result": self.indexer(address).balance_of(address, block)}
+
+    def indexed_transfers(self, address=None, from_block=0, to_block=None, limit=100):
+        indexer = self.indexer(address, limit)
+        return {"result": indexer.transfers(address, from_block, to_block, limit)}
+
+    def balance_history(self, address, from_block=0, to_block=None, limit=100):
+        indexer = self.indexer(address, limit)
+        return {"result": indexer.balance_history(address, from_block, to_block, limit)}
+
+    def indexer_stats(self):
+        return {"result": self.indexer().stats()}
+
     def register_behaviour(self, name):
-        if name in self.existing_behavious.keys():
-            if self.existing_behavious[name]["is_active"]:
+        if name in self.behaviours.existing_behavious.keys():
+            if self.behaviours.existing_behavious[name]["is_active"]:
                 return {"result": "Behaviour already active"}
             else:
-                self.existing_behavious[name]["is_active"] = True
+                self.behaviours.activate(name)
                 return {"result": "Behaviour activated"}
         else:
             return {"result": "No such existing behaviour"}
+
+    def deactivate_behaviour(self, name):
+        if name in self.behaviours.existing_behavious.keys():
+            if self.behaviours.existing_behavious[name]["is_active"]:
+                self.behaviours.deactivate(name)
+                return {"result": "Behaviour deactivated"}
+            else:
+                return {"result": "Behaviour already inactive"}
+        else:
+            return {"result": "No such existing behaviour"}
+
+    def set_behaviour_interval(self, name, interval, jitter=None):
+        if name not in self.behaviours.existing_behavious.keys():
+            return {"result": "No such existing behaviour"}
+        if interval <= 0 or (jitter is not None and jitter < 0):
+            return {"error": "Interval must be positive"}
+        self.behaviours.set_interval(name, interval, jitter)
+        return {"result": "Behaviour interval updated"}
@@ -0,0 +1,24 @@
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SERVER_ERROR = -32000
+# call rejected by admission control, data carries retry_after in seconds
+OVERLOADED = -32005
+
+
+class JsonRpcError(Exception):
+    """Error raised while dispatching a call, mapped onto a JSON-RPC error object"""
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_dict(self):
+        error = {"code": self.code, "message": self.message}
+        if self.data is not None:
+            error["data"] = self.data
+        return error
@@ -1,15 +1,25 @@
 import os
-import time
 import logging
-import queue
 import socket
 import threading
-import json
-
-from json import JSONDecodeError
 
 import utils
 from agent import Agent
+from logs import setup_logging
+from server import (
+    AsyncJsonRpcServer,
+    Connection,
+    FrameTooLarge,
+    OutboxBroker,
+    open_queue,
+)
+from server.framing import RECV_SIZE
+from server.mesh import create_router
+from server.broker import DROP_OLDEST
+
+OUTBOX_BATCH_SIZE = 64
+
+logger = logging.getLogger("App")
 
 
 class JsonRpcServer:
@@ -18,161 +28,163 @@ class JsonRpcServer:
         port,
         external_agent_port,
         host="127.0.0.1",
+        peers=(),
+        mesh_file=None,
     ):
         try:
 
-            self.inbox_queue = queue.Queue()
-            self.outbox_queue = queue.Queue()
+            self.inbox_queue = open_queue(
+                "inbox", int(os.getenv("INBOX_QUEUE_SIZE", 10000))
+            )
+            self.outbox_queue = open_queue(
+                "outbox", int(os.getenv("OUTBOX_QUEUE_SIZE", 10000))
+            )
 
             self.agent = Agent(self.inbox_queue, self.outbox_queue)
 
+            self.broker = OutboxBroker(
+                self.outbox_queue,
+                capacity=int(os.getenv("OUTBOX_BUFFER_SIZE", 1024)),
+                policy=os.getenv("OUTBOX_OVERFLOW_POLICY", DROP_OLDEST),
+            )
+            self.agent.register_method("outbox_stats", self.outbox_stats)
+
             self.host = host
-            self.port = port
             self.external_agent_port = external_agent_port
+            self.router = create_router(
+                self.agent, peers, mesh_file, host, external_agent_port
+            )
 
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.bind((self.host, port))
+            self.server_socket.listen(128)
+            # port 0 binds any free port, agents find it in the mesh file
+            self.port = self.server_socket.getsockname()[1]
             logger.info(f"JSON-RPC server listening on {self.host}:{self.port}")
         except socket.error as e:
             logger.error("Exception while initializing socket" + str(e))
         except Exception as e:
             logger.error("unknown exception while initializing" + str(e))
 
-    def handle_client(self, client_socket):
-        """Function to handle communication with a connected client."""
+    def handle_client(self, client_socket, connection, subscription, push_thread):
+        """
+        Function to handle communication with a connected client.
+        Every complete message of a recv is routed and the responses
+        are written back in a single send. Once the client is gone the
+        outbox subscription is cancelled and the push thread joined
+        before the socket is closed
+        """
         try:
-            with client_socket:
-                while True:
-                    message = client_socket.recv(1024)
-                    response = self.agent.handle_request(message.decode())
-                    client_socket.sendall(json.dumps(response).encode())
+            while True:
+                data = client_socket.recv(RECV_SIZE)
+                connection.receive(data)
+                if not data:
+                    break
+        except FrameTooLarge as e:
+            logger.error("Dropping client, " + str(e))
         except ConnectionResetError as e:
             logger.error("Connection reset by peer" + str(e))
         except socket.error as e:
             logger.error("Socket connection error" + str(e))
         finally:
+            self.broker.unsubscribe(subscription)
+            try:
+                # a push blocked on a client that stopped reading fails now
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            push_thread.join()
             client_socket.close()
 
-    def push_outbox_messages(self, client_socket):
+    def push_outbox_messages(self, subscription, connection):
         """
-        Pushing all messages on outbox queue to connected
+        Pushing all messages published by the outbox broker to the
+        connected client, buffered messages are coalesced into one write
         """
         try:
-            with client_socket:
-                while True:
-                    if not self.outbox_queue.empty():
-                        item = self.outbox_queue.get()
-                        self.outbox_queue.task_done()
-                        client_socket.sendall(json.dumps(item).encode())
-                        time.sleep(2)
+            while not subscription.closed:
+                batch = subscription.get_batch(OUTBOX_BATCH_SIZE, timeout=1)
+                if batch:
+                    connection.push(batch)
         except socket.error as e:
-            logger.error("connection lost" + str(e))
+            # writes after the reader cancelled the subscription are expected to fail
+            if not subscription.closed:
+                logger.error("connection lost" + str(e))
         finally:
-            client_socket.close()
+            self.broker.unsubscribe(subscription)
 
-    def process_inbound_messages(self, connection):
-        """ """
-        with connection:
-            try:
-                while True:
-                    message = connection.recv(1024)
-                    self.inbox_queue.put(json.loads(message))
-                    logger.info(f"Received: {message.decode('utf-8')}")
-            except JSONDecodeError as e:
-                logger.error("Invalid Json received" + str(e))
-            except queue.Full:
-                logger.error("Inbox Queue full" + str(e))
-            except socket.error as e:
-                logger.error("connection lost")
-            except Exception as e:
-                logger.error(
-                    "Unknown exception while processing inbound messages" + str(e)
-                )
-            finally:
-                connection.close()
-
-    def connect_to_external_agent(self, port, max_retries=5):
-        """
-        Trying to establish a socket client connection with agent 2
-        """
-
-        time.sleep(5)  # wait until we start agent 2
-        attempt = 0
-        while attempt < max_retries:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((self.host, port))
-                logger.info(
-                    f"Connected to {self.host}:{port} on attempt {attempt + 1}."
-                )
-                return sock
-            except socket.error as e:
-                logger.error(f"Connection attempt {attempt + 1} failed: {e}")
-                attempt += 1
-                time.sleep(3)  # Wait before retrying
-        logger.critical("Max retries reached. Could not connect.")
-        return None
+    def outbox_stats(self):
+        return {"result": self.broker.stats()}
 
     def run(self):
         """
         With each socket connection, messages will pushed out
         and incoming messages will be processed in
-        individual threads
+        individual threads, links to the peer agents are kept
+        up by the mesh router
         """
         self.agent.start()
+        self.router.start("%s:%s" % (self.host, self.port))
+        self.serve_forever()
 
-        connection = self.connect_to_external_agent(self.external_agent_port, 5)
-        if connection:
-            connection_thread = threading.Thread(
-                target=self.process_inbound_messages, args=(connection,)
-            )
-            connection_thread.start()
-
+    def serve_forever(self):
+        """
+        Accept client connections, requests are read by a single
+        thread per socket so frames are never split between readers
+        """
+        self.broker.start()
         while True:
-            connected_socket, _ = self.server_socket.accept()
-
-            # Create a new thread for each client
-            client_thread = threading.Thread(
-                target=self.handle_client, args=(connected_socket,)
-            )
-            client_thread.start()
+            connected_socket, address = self.server_socket.accept()
+            connection = Connection(self.agent, connected_socket.sendall)
+            subscription = self.broker.subscribe("%s:%s" % address)
 
             push_thread = threading.Thread(
-                target=self.push_outbox_messages, args=(connected_socket,)
+                target=self.push_outbox_messages, args=(subscription, connection)
             )
             push_thread.start()
 
-            inbox_thread = threading.Thread(
-                target=self.process_inbound_messages, args=(connected_socket,)
+            # Create a new thread for each client
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(connected_socket, connection, subscription, push_thread),
             )
-            inbox_thread.start()
+            client_thread.start()
 
 
 if __name__ == "__main__":
 
-    server1_port = int(os.getenv("SERVER_1_PORT"))
-    server2_port = int(os.getenv("SERVER_2_PORT"))
+    peers = [peer for peer in os.getenv("PEERS", "").split(",") if peer]
+    mesh_file = os.getenv("MESH_FILE")
 
-    port = (
-        server2_port
-        if utils.is_port_active(host="127.0.0.1", port=server1_port)
-        else server1_port
-    )
+    if peers or mesh_file or os.getenv("PORT"):
+        port = int(os.getenv("PORT", 0))
+        external_agent_port = None
+        log_file_name = os.getenv("LOG_FILE", f"app-{port or os.getpid()}.log")
+    else:
+        server1_port = int(os.getenv("SERVER_1_PORT"))
+        server2_port = int(os.getenv("SERVER_2_PORT"))
 
-    external_agent_port = server2_port if port == server1_port else server1_port
+        port = (
+            server2_port
+            if utils.is_port_active(host="127.0.0.1", port=server1_port, timeout=0.5)
+            else server1_port
+        )
 
-    log_file_name = "app1.log" if port == server1_port else "app2.log"
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(log_file_name, mode="w"),
-        ],
-    )
+        external_agent_port = server2_port if port == server1_port else server1_port
+
+        log_file_name = "app1.log" if port == server1_port else "app2.log"
+
+    setup_logging(log_file_name)
     logger = logging.getLogger("App")
 
-    server = JsonRpcServer(port=port, external_agent_port=external_agent_port)
+    server_class = (
+        AsyncJsonRpcServer if os.getenv("SERVER_MODE") == "asyncio" else JsonRpcServer
+    )
+    server = server_class(
+        port=port,
+        external_agent_port=external_agent_port,
+        peers=peers,
+        mesh_file=mesh_file,
+    )
     server.run()
@@ -1,10 +1,10 @@
-import time
 import random
-import threading
 import logging
 
 
-from threading import ThreadError
+from events import BALANCE_UPDATED, EVENTS
+from messages import AlphabetMessage
+from .scheduler import Scheduler
 
 logger = logging.getLogger("App.Behaviour")
 
@@ -15,8 +15,18 @@ class Behaviours:
         self.w3 = w3
 
         self.existing_behavious = {
-            "words_generator": {"is_active": True, "interval": 2},
-            "erc20_balance": {"is_active": True, "interval": 10},
+            "words_generator": {
+                "is_active": True,
+                "interval": 2,
+                "jitter": 0,
+                "run": self.run_alphabet_behaviour,
+            },
+            "erc20_balance": {
+                "is_active": True,
+                "interval": 10,
+                "jitter": 0,
+                "run": self.run_erc20_balance_behaviour,
+            },
         }
 
         self.alphabet = [
@@ -32,52 +42,60 @@ class Behaviours:
             "human",
         ]
 
-        self.threads = []
-        self.stop_event = threading.Event()
+        self.scheduler = Scheduler()
+        for name, options in self.existing_behavious.items():
+            self.scheduler.add(
+                name,
+                options["run"],
+                options["interval"],
+                options["jitter"],
+                active=options["is_active"],
+            )
 
     def start(self):
-        for behaviour, options in self.existing_behavious.items():
-            if options["is_active"]:
-                if behaviour == "words_generator":
-                    thread = threading.Thread(target=self.run_alphabet_behaviour)
-                    thread.daemon = True
-                    self.threads.append(thread)
-                    thread.start()
-                elif behaviour == "erc20_balance":
-                    thread = threading.Thread(target=self.run_erc20_balance_behaviour)
-                    thread.daemon = True
-                    self.threads.append(thread)
-                    thread.start()
+        self.scheduler.start()
 
     def stop(self):
         logger.info("Stopping Behaviours...")
-        self.stop_event.set()  # Signal the thread to stop
+        self.scheduler.stop()  # Signal the scheduler thread to stop
+
+    def register(self, name, run, interval, jitter=0, is_active=True):
+        """Add a periodic behaviour, run is called once per tick"""
+        self.existing_behavious[name] = {
+            "is_active": is_active,
+            "interval": interval,
+            "jitter": jitter,
+            "run": run,
+        }
+        self.scheduler.add(name, run, interval, jitter, active=is_active)
+
+    def activate(self, name):
+        self.existing_behavious[name]["is_active"] = True
+        return self.scheduler.activate(name)
+
+    def deactivate(self, name):
+        self.existing_behavious[name]["is_active"] = False
+        return self.scheduler.deactivate(name)
+
+    def set_interval(self, name, interval, jitter=None):
+        options = self.existing_behavious[name]
+        options["interval"] = interval
+        if jitter is not None:
+            options["jitter"] = jitter
+        self.scheduler.set_interval(name, interval, jitter)
 
     def run_erc20_balance_behaviour(self):
-        try:
-            while not self.stop_event.is_set():
-                balance = self.w3.get_balance(self.w3.from_address)
-                logger.info(f"Balance is:  {balance}")
-                time.sleep(10)
-        except ThreadError as e:
-            logger.error("Thread Exception inside balance behaviour" + str(e))
-        except Exception as e:
-            logger.error("Exception:" + str(e))
+        balance = self.w3.get_balance(self.w3.from_address)
+        logger.info("Balance is: %s", balance)
+        if balance is not None:
+            EVENTS.publish(
+                BALANCE_UPDATED,
+                address=self.w3.from_address,
+                token=self.w3.erc20_contract_address,
+                balance=balance,
+            )
 
     def run_alphabet_behaviour(self):
-        try:
-            while not self.stop_event.is_set():
-                selected_words = random.sample(self.alphabet, 2)
-                if not self.outbox_queue.full():
-                    self.outbox_queue.put(
-                        {
-                            "method": "Message",
-                            "type": "alphabet",
-                            "words": selected_words,
-                        }
-                    )
-                time.sleep(2)
-        except ThreadError as e:
-            logger.error("Thread exception inside alphabet behaviour" + str(e))
-        except Exception as e:
-            logger.error("Exception:" + str(e))
+        selected_words = random.sample(self.alphabet, 2)
+        if not self.outbox_queue.full():
+            self.outbox_queue.put(AlphabetMessage(selected_words))
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("App.Scheduler")
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.active = False
+        self.generation = 0
+        self.next_run = None
+
+
+class Scheduler:
+    """
+    Runs periodic jobs on a single thread from a heap ordered by the
+    next due time. Jobs keep their own interval and jitter and can be
+    activated, deactivated and re-timed while the scheduler is running,
+    stale heap entries are skipped through a per job generation
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, name, func, interval, jitter=0, active=True):
+        with self.condition:
+            self.jobs[name] = Job(name, func, interval, jitter)
+        if active:
+            self.activate(name)
+
+    def activate(self, name):
+        with self.condition:
+            job = self.jobs[name]
+            if job.active:
+                return False
+            job.active = True
+            self._schedule(job, time.monotonic())
+            return True
+
+    def deactivate(self, name):
+        with self.condition:
+            job = self.jobs[name]
+            if not job.active:
+                return False
+            job.active = False
+            job.generation += 1
+            return True
+
+    def set_interval(self, name, interval, jitter=None):
+        """Re-time a job, an active job is rescheduled from now"""
+        with self.condition:
+            job = self.jobs[name]
+            job.interval = interval
+            if jitter is not None:
+                job.jitter = jitter
+            if job.active:
+                self._schedule(job, time.monotonic() + interval)
+
+    def _schedule(self, job, base):
+        job.generation += 1
+        job.next_run = base
+        due = base + (random.uniform(0, job.jitter) if job.jitter else 0)
+        heapq.heappush(self.heap, (due, next(self.counter), job, job.generation))
+        self.condition.notify()
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run, name="behaviour-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                job, due = self._next_due()
+                if job is None:
+                    continue
+                base = job.next_run
+                generation = job.generation
+            self._run_job(job, due)
+            with self.condition:
+                if job.active and job.generation == generation:
+                    # Keep the cadence anchored to the schedule, an overrun
+                    # runs once right away instead of catching up every period
+                    now = time.monotonic()
+                    next_run = base + job.interval
+                    self._schedule(job, next_run if next_run > now else now)
+
+    def _next_due(self):
+        """Wait until the earliest live entry is due, called with the lock held"""
+        while self.heap and not self.stop_event.is_set():
+            due, _, job, generation = self.heap[0]
+            if generation != job.generation or not job.active:
+                heapq.heappop(self.heap)
+                continue
+            delay = due - time.monotonic()
+            if delay <= 0:
+                heapq.heappop(self.heap)
+                return job, due
+            self.condition.wait(delay)
+        if not self.heap:
+            self.condition.wait(1)
+        return None, None
+
+    def _run_job(self, job, due):
+        start = time.monotonic()
+        REGISTRY.histogram("behaviour_drift_seconds", behaviour=job.name).observe(
+            max(start - due, 0)
+        )
+        try:
+            job.func()
+        except Exception as e:
+            REGISTRY.counter("behaviour_errors_total", behaviour=job.name).inc()
+            logger.error(f"Exception in behaviour {job.name}:" + str(e))
+        finally:
+            REGISTRY.histogram("behaviour_tick_seconds", behaviour=job.name).observe(
+                time.monotonic() - start
+            )
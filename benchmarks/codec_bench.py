@@ -0,0 +1,51 @@
+"""
+Per message encode and decode cost of the JSON and binary wire codecs
+
+Alphabet messages are encoded into frames and decoded back into message
+objects, as on the peer link between two agents.
+
+    python -m benchmarks.codec_bench --messages 200000
+"""
+
+import argparse
+import json
+import time
+
+from messages import AlphabetMessage
+from server.codec import BINARY, JSON
+from server.framing import FrameDecoder
+
+WORDS = ["hello", "sun", "world", "space", "moon", "crypto", "sky", "ocean"]
+
+
+def bench_codec(codec, count):
+    messages = [
+        AlphabetMessage([WORDS[i % 8], WORDS[(i + 3) % 8]]) for i in range(count)
+    ]
+    start = time.perf_counter()
+    data = codec.encode_many(messages)
+    encoded = time.perf_counter()
+
+    decoder = FrameDecoder()
+    decoder.length_prefixed = codec.length_prefixed
+    decoded = [codec.decode_message(frame) for frame in decoder.feed(data)]
+    finished = time.perf_counter()
+    assert len(decoded) == count
+    return {
+        "codec": codec.name,
+        "messages": count,
+        "bytes_per_message": round(len(data) / count, 1),
+        "encode_us": round((encoded - start) / count * 1e6, 3),
+        "decode_us": round((finished - encoded) / count * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+    print(json.dumps([bench_codec(c, args.messages) for c in (JSON, BINARY)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def read_proc_status(pid):
+    """Resident memory in KiB and thread count of a process, linux only"""
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        return None, None
+    rss = int(status["VmRSS"].split()[0]) if "VmRSS" in status else None
+    threads = int(status["Threads"]) if "Threads" in status else None
+    return rss, threads
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def summarize(samples):
+    """Count, mean and percentiles of latency samples in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
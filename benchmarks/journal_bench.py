@@ -0,0 +1,66 @@
+"""
+Enqueue throughput of the journaled queue against the in-memory queue
+
+Messages are put by several producer threads and consumed and
+acknowledged by one consumer, as the inbox is used by the agent.
+
+    python -m benchmarks.journal_bench --messages 100000 --producers 4
+"""
+
+import argparse
+import json
+import queue
+import tempfile
+import threading
+import time
+
+from server.journal import JournalQueue
+
+MESSAGE = {"method": "Message", "type": "alphabet", "words": ["sun", "crypto"]}
+
+
+def bench_queue(name, q, messages, producers):
+    per_producer = messages // producers
+
+    def produce():
+        for _ in range(per_producer):
+            q.put(dict(MESSAGE))
+
+    threads = [threading.Thread(target=produce) for _ in range(producers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    enqueue_elapsed = time.perf_counter() - start
+    for _ in range(per_producer * producers):
+        q.get()
+        q.task_done()
+    total_elapsed = time.perf_counter() - start
+    return {
+        "queue": name,
+        "messages": per_producer * producers,
+        "enqueue_per_sec": round(per_producer * producers / enqueue_elapsed),
+        "roundtrip_per_sec": round(per_producer * producers / total_elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--producers", type=int, default=4)
+    args = parser.parse_args()
+
+    results = [bench_queue("memory", queue.Queue(), args.messages, args.producers)]
+    with tempfile.TemporaryDirectory() as directory:
+        journal = JournalQueue(directory, "bench")
+        results.append(bench_queue("journal", journal, args.messages, args.producers))
+        journal.close()
+    results[1]["slowdown"] = round(
+        results[0]["enqueue_per_sec"] / results[1]["enqueue_per_sec"], 2
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+End-to-end load benchmark of an agent backed by a local stub RPC node
+
+The agent runs in its own process with W3 pointed at a StubRpcServer.
+Concurrent clients send Message requests over the socket protocol, then
+outbox messages are published to a set of subscriber connections. The
+report is printed as JSON and can be written to a file to track
+regressions in JsonRpcServer and Handlers.
+
+    python -m benchmarks.load_bench --clients 50 --requests 200 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import threading
+import time
+
+from benchmarks.common import raise_fd_limit, read_proc_status, summarize, wait_for_port
+from messages import Message
+from server.framing import FrameDecoder, encode_message
+
+BENCH_ACCOUNT = "0x" + "11" * 20
+BENCH_TOKEN = "0x" + "22" * 20
+
+
+class TimestampQueue(queue.Queue):
+    """Inbox queue stamping every message with its enqueue time"""
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, Message):
+            item.data["_enqueued_at"] = time.perf_counter()
+        super().put(item, block, timeout)
+
+
+def stub_methods():
+    word = "0x" + "0" * 63
+    return {
+        "eth_call": lambda params: word
+        + ("12" if params[0]["data"] == "0x313ce567" else "1"),
+        "eth_getTransactionCount": "0x0",
+        "eth_gasPrice": "0x1",
+        "eth_estimateGas": "0x5208",
+    }
+
+
+def run_agent(mode, port, rpc_delay, messages, ready):
+    """Agent process, serves until terminated"""
+    raise_fd_limit()
+    from stub_rpc import StubRpcServer
+
+    node = StubRpcServer(stub_methods(), delay=rpc_delay).start()
+    os.environ.update(
+        {
+            "RPC_URL": node.url,
+            "RPC_URLS": node.url,
+            "CHAIN_ID": "1",
+            "CONTRACT_ADDRESS": BENCH_TOKEN,
+            "FROM_ADDRESS": BENCH_ACCOUNT,
+            "TO_ADDRESS": BENCH_ACCOUNT,
+            # every subscriber can buffer a whole burst, nothing is dropped
+            "OUTBOX_BUFFER_SIZE": str(max(messages, 1024)),
+        }
+    )
+    if mode == "asyncio":
+        from server import AsyncJsonRpcServer as server_class
+    else:
+        from app import JsonRpcServer as server_class
+
+    server = server_class(port=port, external_agent_port=None)
+    inbox_queue = TimestampQueue()
+    server.inbox_queue = server.agent.inbox_queue = inbox_queue
+    server.agent.handlers.inbox_queue = inbox_queue
+
+    handler_latencies = []
+
+    def bench_handler(message):
+        handler_latencies.append(time.perf_counter() - message.data["_enqueued_at"])
+
+    def bench_publish(count, size=64):
+        def publish():
+            for i in range(count):
+                server.outbox_queue.put(
+                    {"method": "Message", "type": "bench", "seq": i, "pad": "x" * size}
+                )
+
+        threading.Thread(target=publish, daemon=True).start()
+        return {"result": count}
+
+    def bench_stats():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        rss, threads = read_proc_status(os.getpid())
+        return {
+            "result": {
+                "inbox_to_handler": summarize(list(handler_latencies)),
+                "cpu_user_s": usage.ru_utime,
+                "cpu_system_s": usage.ru_stime,
+                "rss_kib": rss,
+                "max_rss_kib": usage.ru_maxrss,
+                "threads": threads,
+                "rpc_calls": dict(node.calls),
+            }
+        }
+
+    server.agent.handlers.register("bench", bench_handler)
+    server.agent.register_method("bench_publish", bench_publish)
+    server.agent.register_method("bench_stats", bench_stats)
+    server.agent.handlers.start()
+    ready.set()
+
+    if mode == "asyncio":
+        asyncio.run(server.serve_forever())
+    else:
+        server.serve_forever()
+
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.frames = []
+
+    @classmethod
+    async def open(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def next_frame(self):
+        while not self.frames:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("agent closed the connection")
+            self.frames.extend(json.loads(frame) for frame in self.decoder.feed(data))
+        return self.frames.pop(0)
+
+    async def call(self, request):
+        self.writer.write(encode_message(request))
+        await self.writer.drain()
+        while True:
+            frame = await self.next_frame()
+            # outbox pushes are interleaved with responses, skip them
+            if "method" not in frame:
+                return frame
+
+    def close(self):
+        self.writer.close()
+
+
+async def request_phase(host, port, clients, requests, words):
+    latencies = []
+    errors = 0
+
+    async def client(index):
+        nonlocal errors
+        connection = await Connection.open(host, port)
+        try:
+            for seq in range(requests):
+                message = {
+                    "method": "Message",
+                    "type": "bench",
+                    "words": words,
+                    "client": index,
+                    "seq": seq,
+                }
+                start = time.perf_counter()
+                response = await connection.call(message)
+                latencies.append(time.perf_counter() - start)
+                if "error" in response:
+                    errors += 1
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    return {
+        "clients": clients,
+        "requests": clients * requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "requests_per_sec": round(clients * requests / elapsed, 1),
+        "latency": summarize(latencies),
+    }
+
+
+async def outbox_phase(host, port, subscribers, messages, timeout):
+    connections = [await Connection.open(host, port) for _ in range(subscribers)]
+    await asyncio.sleep(0.2)  # let the agent register the subscriptions
+    control = await Connection.open(host, port)
+    received = [0] * subscribers
+    last_received = [None] * subscribers
+
+    async def receive(index, connection):
+        while received[index] < messages:
+            frame = await connection.next_frame()
+            if frame.get("type") == "bench":
+                received[index] += 1
+                last_received[index] = time.perf_counter()
+
+    start = time.perf_counter()
+    await control.call({"method": "bench_publish", "params": [messages]})
+    results = await asyncio.gather(
+        *[asyncio.wait_for(receive(i, c), timeout) for i, c in enumerate(connections)],
+        return_exceptions=True,
+    )
+    finished = [t for t in last_received if t is not None]
+    elapsed = (max(finished) if finished else time.perf_counter()) - start
+    # subscriptions are named after the address of the client socket
+    stats = (await control.call({"method": "outbox_stats"}))["result"]
+    dropped = {s["name"]: s["dropped"] for s in stats["subscribers"]}
+    per_subscriber = []
+    for i, connection in enumerate(connections):
+        name = "%s:%s" % connection.writer.get_extra_info("sockname")[:2]
+        per_subscriber.append({"received": received[i], "dropped": dropped.get(name)})
+    for connection in connections + [control]:
+        connection.close()
+    delivered = sum(received)
+    return {
+        "subscribers": subscribers,
+        "published": messages,
+        "delivered": delivered,
+        "timed_out": sum(1 for r in results if r is not None),
+        "per_subscriber": per_subscriber,
+        "elapsed_s": round(elapsed, 4),
+        "deliveries_per_sec": round(delivered / elapsed, 1) if elapsed else None,
+    }
+
+
+async def fetch_stats(host, port):
+    connection = await Connection.open(host, port)
+    try:
+        return (await connection.call({"method": "bench_stats"}))["result"]
+    finally:
+        connection.close()
+
+
+def run(args):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=run_agent,
+        args=(args.mode, args.port, args.rpc_delay, args.messages, ready),
+        daemon=True,
+    )
+    process.start()
+    try:
+        if not ready.wait(30) or not wait_for_port(args.host, args.port):
+            return {"mode": args.mode, "error": "agent did not start"}
+        loop = asyncio.new_event_loop()
+        requests = loop.run_until_complete(
+            request_phase(
+                args.host, args.port, args.clients, args.requests, ["sun", "moon"]
+            )
+        )
+        outbox = loop.run_until_complete(
+            outbox_phase(
+                args.host, args.port, args.subscribers, args.messages, args.timeout
+            )
+        )
+        agent = loop.run_until_complete(fetch_stats(args.host, args.port))
+        loop.close()
+        return {
+            "mode": args.mode,
+            "python": platform.python_version(),
+            "requests": requests,
+            "outbox": outbox,
+            "agent": agent,
+        }
+    finally:
+        process.terminate()
+        process.join(5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mode", default="threaded", choices=["threaded", "asyncio"])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--subscribers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rpc-delay", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4201)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
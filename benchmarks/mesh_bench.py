@@ -0,0 +1,160 @@
+"""
+Startup and routing of a local agent cluster
+
+Starts N agents backed by a local stub RPC node, either fully meshed
+through a discovery file or as a line where every agent only knows its
+predecessor, and reports how long it takes until every agent has a
+route to every other one. A message addressed to the farthest agent and
+a topic message are then sent from the first agent.
+
+    python -m benchmarks.mesh_bench --agents 20 --topology line
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import raise_fd_limit, wait_for_port
+from messages import AlphabetMessage
+from server.framing import FrameDecoder, encode_message
+from server.mesh import parse_address, read_mesh_file
+from stub_rpc import StubRpcServer
+
+BENCH_ACCOUNT = "0x" + "11" * 20
+BENCH_TOKEN = "0x" + "22" * 20
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def call(address, method, params=None, fields=None, timeout=5):
+    """Result of a JSON-RPC call, fields are sent next to method like Message needs"""
+    with socket.create_connection(parse_address(address), timeout=timeout) as sock:
+        request = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": 1}
+        request.update(fields or {})
+        sock.sendall(encode_message(request))
+        decoder = FrameDecoder()
+        while True:
+            for frame in decoder.recv(sock) or []:
+                response = json.loads(frame)
+                if response.get("id") == 1:
+                    return response.get("result")
+
+
+def start_agents(count, topology, directory, base_port, rpc_url):
+    env = dict(
+        os.environ,
+        RPC_URL=rpc_url,
+        RPC_URLS="",
+        CHAIN_ID="1",
+        CONTRACT_ADDRESS=BENCH_TOKEN,
+        FROM_ADDRESS=BENCH_ACCOUNT,
+        TO_ADDRESS=BENCH_ACCOUNT,
+        MESH_ANNOUNCE_INTERVAL="0.5",
+    )
+    processes = []
+    addresses = []
+    for i in range(count):
+        agent_env = dict(env, LOG_FILE=os.path.join(directory, f"agent-{i}.log"))
+        agent_env["MESH_TOPICS"] = "even" if i % 2 == 0 else "odd"
+        if topology == "full":
+            agent_env.update(MESH_FILE=os.path.join(directory, "mesh"), PORT="0")
+        else:
+            port = base_port + i
+            addresses.append(f"127.0.0.1:{port}")
+            agent_env["PORT"] = str(port)
+            agent_env["PEERS"] = f"127.0.0.1:{base_port + i - 1}" if i else ""
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "app.py"],
+                cwd=ROOT,
+                env=agent_env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+    return processes, addresses
+
+
+def wait_for_routes(addresses, timeout):
+    deadline = time.monotonic() + timeout
+    pending = set(addresses)
+    while pending and time.monotonic() < deadline:
+        for address in list(pending):
+            try:
+                routes = call(address, "mesh_routes")["routes"]
+            except (OSError, TypeError):
+                continue
+            if len(routes) == len(addresses) - 1:
+                pending.discard(address)
+        time.sleep(0.05)
+    return not pending
+
+
+def run(args):
+    raise_fd_limit()
+    word = "0x" + "0" * 63
+    node = StubRpcServer(
+        {
+            "eth_call": lambda params: word
+            + ("12" if params[0]["data"] == "0x313ce567" else "1"),
+            "eth_blockNumber": "0x1",
+        }
+    ).start()
+    directory = tempfile.mkdtemp(prefix="mesh-bench-")
+    start = time.perf_counter()
+    processes, addresses = start_agents(
+        args.agents, args.topology, directory, args.base_port, node.url
+    )
+    try:
+        if args.topology == "full":
+            mesh_file = os.path.join(directory, "mesh")
+            while len(read_mesh_file(mesh_file)) < args.agents:
+                if time.perf_counter() - start > args.timeout:
+                    return {"error": "agents did not register"}
+                time.sleep(0.05)
+            addresses = [address for _, address in read_mesh_file(mesh_file)]
+        for address in addresses:
+            wait_for_port(*parse_address(address), timeout=args.timeout)
+        listening = time.perf_counter() - start
+        converged = wait_for_routes(addresses, args.timeout)
+        elapsed = time.perf_counter() - start
+
+        first, last = addresses[0], addresses[-1]
+        hops = call(first, "mesh_routes")["routes"].get(last, {}).get("hops")
+        direct = AlphabetMessage(["hello", "direct"], data={"to": last}).to_dict()
+        topic = AlphabetMessage(["hello", "topic"], data={"topic": "odd"}).to_dict()
+        del direct["method"], topic["method"]
+        return {
+            "agents": args.agents,
+            "topology": args.topology,
+            "listening_s": round(listening, 3),
+            "routes_converged": converged,
+            "converged_s": round(elapsed, 3),
+            "hops_to_last": hops,
+            "direct_message": call(first, "Message", fields=direct),
+            "topic_message": call(first, "Message", fields=topic),
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        node.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--topology", choices=("full", "line"), default="full")
+    parser.add_argument("--base-port", type=int, default=4100)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Agent behaviour when offered more messages than its handlers can take
+
+Flooding clients send Message requests as fast as the agent answers
+them to a handler that takes a fixed time per message, while a probe
+calls a control method at a steady pace. Runs once with an unbounded
+inbox and once with admission control, reporting inbox-to-handler and
+probe latency, rejected calls and memory.
+
+    python -m benchmarks.overload_bench --clients 20 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from benchmarks.common import raise_fd_limit, read_proc_status, summarize, wait_for_port
+from benchmarks.load_bench import BENCH_ACCOUNT, BENCH_TOKEN, Connection
+
+
+def run_agent(port, settings, handler_time, ready):
+    raise_fd_limit()
+    os.environ.update(
+        {
+            "RPC_URL": "http://127.0.0.1:1",
+            "RPC_URLS": "",
+            "CHAIN_ID": "1",
+            "CONTRACT_ADDRESS": BENCH_TOKEN,
+            "FROM_ADDRESS": BENCH_ACCOUNT,
+            "TO_ADDRESS": BENCH_ACCOUNT,
+            **settings,
+        }
+    )
+    from app import JsonRpcServer
+
+    server = JsonRpcServer(port=port, external_agent_port=None)
+    latencies = []
+
+    def bench_handler(message):
+        latencies.append(time.time() - message.data["sent"])
+        time.sleep(handler_time)
+
+    def bench_stats():
+        rss, _ = read_proc_status(os.getpid())
+        return {
+            "result": {
+                "inbox_to_handler": summarize(latencies),
+                "inbox_depth": server.inbox_queue.qsize(),
+                "rss_kib": rss,
+            }
+        }
+
+    server.agent.handlers.register("bench", bench_handler)
+    server.agent.register_method("bench_stats", bench_stats)
+    server.agent.handlers.start()
+    ready.set()
+    server.serve_forever()
+
+
+async def flood(host, port, deadline, counts):
+    connection = await Connection.open(host, port)
+    try:
+        while time.monotonic() < deadline:
+            response = await connection.call(
+                {"method": "Message", "type": "bench", "sent": time.time()}
+            )
+            if "error" in response:
+                counts["rejected"] += 1
+                retry_after = (response.get("data") or {}).get("retry_after")
+                if retry_after:
+                    counts["with_retry_after"] += 1
+                    await asyncio.sleep(retry_after)
+            else:
+                counts["accepted"] += 1
+    finally:
+        connection.close()
+
+
+async def probe(host, port, deadline, latencies):
+    connection = await Connection.open(host, port)
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            await connection.call({"method": "outbox_stats"})
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.05)
+    finally:
+        connection.close()
+
+
+async def drive(host, port, clients, duration):
+    counts = {"accepted": 0, "rejected": 0, "with_retry_after": 0}
+    probe_latencies = []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(
+        probe(host, port, deadline, probe_latencies),
+        *[flood(host, port, deadline, counts) for _ in range(clients)],
+    )
+    connection = await Connection.open(host, port)
+    stats = (await connection.call({"method": "bench_stats"}))["result"]
+    connection.close()
+    return {**counts, "control_probe": summarize(probe_latencies), **stats}
+
+
+def bench(name, settings, args, port):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=run_agent, args=(port, settings, args.handler_time, ready), daemon=True
+    )
+    process.start()
+    try:
+        ready.wait(60)
+        wait_for_port(args.host, port)
+        result = asyncio.run(drive(args.host, port, args.clients, args.duration))
+        return {"setup": name, "settings": settings, **result}
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--handler-time", type=float, default=0.002)
+    parser.add_argument("--capacity", type=int, default=500)
+    parser.add_argument("--client-rate", type=float, default=200)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4251)
+    args = parser.parse_args()
+    setups = [
+        ("unbounded", {"INBOX_QUEUE_SIZE": "0"}),
+        (
+            "admission",
+            {
+                "INBOX_QUEUE_SIZE": str(args.capacity),
+                "CLIENT_RATE_LIMIT": str(args.client_rate),
+            },
+        ),
+    ]
+    print(
+        json.dumps(
+            [
+                bench(name, settings, args, args.port + i)
+                for i, (name, settings) in enumerate(setups)
+            ],
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
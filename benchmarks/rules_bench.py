@@ -0,0 +1,85 @@
+"""
+Matching cost of the compiled rule index as the rule set grows
+
+Random word, prefix and contains rules are compiled for every rule
+count and alphabet messages are matched against them, next to a loop
+checking every rule in turn as a baseline.
+
+    python -m benchmarks.rules_bench --rules 2,100,1000,10000
+"""
+
+import argparse
+import json
+import random
+import string
+import time
+
+from handlers.rules import CONTAINS, PREFIX, WORD, Rule, RuleEngine
+from messages import AlphabetMessage
+
+WORDS = ["hello", "sun", "world", "space", "moon", "crypto", "sky", "ocean"]
+KINDS = (WORD, PREFIX, CONTAINS)
+
+
+def random_rules(count):
+    return [
+        Rule(
+            KINDS[i % 3],
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(3, 8))),
+            "log",
+        )
+        for i in range(count)
+    ]
+
+
+def scan(rules, message):
+    """Baseline checking every rule against every word"""
+    matched = []
+    for rule in rules:
+        for word in message.words:
+            if (
+                (rule.kind == WORD and word == rule.pattern)
+                or (rule.kind == PREFIX and word.startswith(rule.pattern))
+                or (rule.kind == CONTAINS and rule.pattern in word)
+            ):
+                matched.append(rule)
+                break
+    return matched
+
+
+def timed(func, messages):
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    return round((time.perf_counter() - start) / len(messages) * 1e6, 2)
+
+
+def bench(count, args):
+    rules = random_rules(count)
+    engine = RuleEngine({"log": None})
+    start = time.perf_counter()
+    engine.add(rules)
+    compile_seconds = time.perf_counter() - start
+    messages = [
+        AlphabetMessage(random.sample(WORDS, args.words)) for _ in range(args.messages)
+    ]
+    return {
+        "rules": count,
+        "compile_seconds": round(compile_seconds, 3),
+        "match_us": timed(engine.match, messages),
+        "scan_us": timed(lambda message: scan(rules, message), messages[:1000]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rules", default="2,100,1000,10000")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=4)
+    args = parser.parse_args()
+    counts = [int(count) for count in args.rules.split(",")]
+    print(json.dumps([bench(count, args) for count in counts], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Compares the threaded JsonRpcServer against AsyncJsonRpcServer
+
+Every server runs in its own process, the benchmark opens a number of
+concurrent client connections, sends one Message request on each and keeps
+them open while the resident memory and thread count of the server
+process are sampled.
+
+    python -m benchmarks.server_bench --connections 1000
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from benchmarks.common import raise_fd_limit, read_proc_status, wait_for_port
+from server.framing import encode_message
+
+BENCH_ENV = {
+    "CHAIN_ID": "1",
+    "RPC_URL": "http://127.0.0.1:1",
+    "CONTRACT_ADDRESS": "0x0000000000000000000000000000000000000000",
+}
+
+CONNECT_TIMEOUT = 10
+
+
+def run_server(mode, port):
+    raise_fd_limit()
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    if mode == "asyncio":
+        from server import AsyncJsonRpcServer
+
+        server = AsyncJsonRpcServer(port=port, external_agent_port=None)
+        asyncio.run(server.serve_forever())
+    else:
+        from app import JsonRpcServer
+
+        server = JsonRpcServer(port=port, external_agent_port=None)
+        server.serve_forever()
+
+
+async def open_client(host, port, message, reply_timeout):
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), CONNECT_TIMEOUT
+    )
+    writer.write(message)
+    await writer.drain()
+    try:
+        replied = bool(await asyncio.wait_for(reader.read(1024), reply_timeout))
+    except asyncio.TimeoutError:
+        replied = False
+    return writer, replied
+
+
+async def drive_clients(host, port, connections, reply_timeout):
+    message = encode_message(
+        {"method": "Message", "type": "alphabet", "words": ["sun", "moon"]}
+    )
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[open_client(host, port, message, reply_timeout) for _ in range(connections)],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    writers = [r[0] for r in results if isinstance(r, tuple)]
+    replies = sum(1 for r in results if isinstance(r, tuple) and r[1])
+    return writers, replies, elapsed
+
+
+def bench_mode(mode, host, port, connections, reply_timeout):
+    process = multiprocessing.Process(target=run_server, args=(mode, port), daemon=True)
+    process.start()
+    try:
+        if not wait_for_port(host, port):
+            return {"mode": mode, "error": "server did not start"}
+        idle_rss, idle_threads = read_proc_status(process.pid)
+
+        loop = asyncio.new_event_loop()
+        writers, replies, elapsed = loop.run_until_complete(
+            drive_clients(host, port, connections, reply_timeout)
+        )
+        time.sleep(0.5)  # let the server settle before sampling
+        rss, threads = read_proc_status(process.pid)
+        for writer in writers:
+            writer.close()
+        loop.close()
+
+        return {
+            "mode": mode,
+            "connections": connections,
+            "connected": len(writers),
+            "replies": replies,
+            "elapsed_s": round(elapsed, 4),
+            "connections_per_sec": (
+                round(len(writers) / elapsed, 1) if elapsed else None
+            ),
+            "idle_rss_kib": idle_rss,
+            "loaded_rss_kib": rss,
+            "rss_per_connection_kib": (
+                round((rss - idle_rss) / len(writers), 2)
+                if rss and idle_rss and writers
+                else None
+            ),
+            "server_threads": threads,
+            "idle_server_threads": idle_threads,
+        }
+    finally:
+        process.terminate()
+        process.join(5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4101)
+    parser.add_argument("--reply-timeout", type=float, default=2.0)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["threaded", "asyncio"],
+        choices=["threaded", "asyncio"],
+    )
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = [
+        bench_mode(mode, args.host, args.port + i, args.connections, args.reply_timeout)
+        for i, mode in enumerate(args.modes)
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
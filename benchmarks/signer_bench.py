@@ -0,0 +1,120 @@
+"""
+Transfer signing on agent threads against signer processes
+
+Signs transfers on a pool of threads, as the chain lane did, and through
+signer processes, while a socket echo served by another thread of the
+same process is pinged to show how responsive the sockets stay.
+
+    python -m benchmarks.signer_bench --transactions 2000 --processes 2
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_account import Account
+
+from benchmarks.common import summarize
+from w3.signer import SignerPool, build_transfer
+
+TOKEN = "0x" + "22" * 20
+RECIPIENT = "0x" + "33" * 20
+
+
+def echo(sock):
+    with sock:
+        while data := sock.recv(64):
+            sock.sendall(data)
+
+
+def ping(sock, stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        sock.sendall(b"ping")
+        sock.recv(64)
+        samples.append(time.perf_counter() - start)
+        time.sleep(0.001)
+
+
+def transfer_fields(account, nonce):
+    return {
+        "from": account.address,
+        "gas": 200000,
+        "gasPrice": 50 * 10**9,
+        "nonce": nonce,
+        "chainId": 1,
+    }
+
+
+def bench(mode, account, count, workers):
+    amounts = {RECIPIENT: 10**18}
+    server, client = socket.socketpair()
+    threading.Thread(target=echo, args=(server,), daemon=True).start()
+    stop = threading.Event()
+    samples = []
+    pinger = threading.Thread(target=ping, args=(client, stop, samples))
+
+    if mode == "threads":
+        pool = ThreadPoolExecutor(workers)
+
+        def sign(nonce):
+            transaction = build_transfer(
+                TOKEN, amounts, None, transfer_fields(account, nonce)
+            )
+            return account.sign_transaction(transaction).raw_transaction
+
+        submit = lambda nonce: pool.submit(sign, nonce)  # noqa: E731
+    else:
+        pool = SignerPool([account.key], workers)
+        pool.start()
+        submit = lambda nonce: pool.submit(  # noqa: E731
+            TOKEN, amounts, None, transfer_fields(account, nonce)
+        )
+
+    pinger.start()
+    time.sleep(0.2)
+    idle = len(samples)
+    start = time.perf_counter()
+    for future in [submit(nonce) for nonce in range(count)]:
+        future.result()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    pinger.join()
+    client.close()
+    if mode == "threads":
+        pool.shutdown()
+    else:
+        pool.stop()
+    return {
+        "mode": mode,
+        "workers": workers,
+        "transactions": count,
+        "signed_per_s": round(count / elapsed),
+        "socket_ping_idle": summarize(samples[:idle]),
+        "socket_ping_while_signing": summarize(samples[idle:]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=2)
+    args = parser.parse_args()
+    account = Account.create()
+    print(
+        json.dumps(
+            [
+                bench(mode, account, args.transactions, args.processes)
+                for mode in ("threads", "processes")
+            ],
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
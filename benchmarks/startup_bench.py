@@ -0,0 +1,90 @@
+"""
+Time to listening of an agent with and without chain features
+
+Starts app.py as a fresh process, once with web3 imported and the
+provider built while the agent is constructed (W3_EAGER=1) and once with
+the default lazy W3 that waits for the first chain call, and reports
+how long it takes until the port accepts connections.
+
+    python -m benchmarks.startup_bench --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import read_proc_status, wait_for_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_ENV = {
+    "CHAIN_ID": "1",
+    "RPC_URL": "http://127.0.0.1:1",
+    "RPC_URLS": "",
+    "CONTRACT_ADDRESS": "0x" + "22" * 20,
+}
+
+
+def time_to_listening(port, eager, directory):
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        W3_EAGER="1" if eager else "0",
+        LOG_FILE=os.path.join(directory, f"agent-{port}.log"),
+        **BENCH_ENV,
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "app.py"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_for_port("127.0.0.1", port, timeout=60):
+            return None, None
+        elapsed = time.perf_counter() - start
+        rss, _ = read_proc_status(process.pid)
+        return elapsed, rss
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench(eager, runs, port, directory):
+    samples = [time_to_listening(port + i, eager, directory) for i in range(runs)]
+    times = [elapsed for elapsed, _ in samples if elapsed is not None]
+    return {
+        "chain_features": "eager" if eager else "lazy",
+        "runs": runs,
+        "listening_median_s": round(statistics.median(times), 3) if times else None,
+        "listening_min_s": round(min(times), 3) if times else None,
+        "rss_kib": samples[-1][1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=4300)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix="startup-bench-")
+    print(
+        json.dumps(
+            [
+                bench(True, args.runs, args.port, directory),
+                bench(False, args.runs, args.port + args.runs, directory),
+            ],
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
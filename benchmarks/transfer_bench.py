@@ -0,0 +1,81 @@
+"""
+Latency of sending a transfer against a node with a fixed round trip
+
+W3.transfer runs against a stub node answering every request after
+--delay seconds, once with chain params read for every transfer
+(FEE_MAX_AGE=0) and once served from the background refreshed cache,
+reporting per transfer latency and node requests.
+
+    python -m benchmarks.transfer_bench --transfers 50 --delay 0.02
+"""
+
+import argparse
+import json
+import os
+import time
+
+from eth_account import Account
+
+from benchmarks.common import summarize
+from stub_rpc import StubRpcServer
+
+
+def node_methods():
+    return {
+        "eth_feeHistory": {"baseFeePerGas": ["0x0", hex(10**9)], "reward": []},
+        "eth_gasPrice": "0x1",
+        "eth_call": lambda params: "0x"
+        + format(18 if params[0]["data"] == "0x313ce567" else 10**30, "064x"),
+        "eth_estimateGas": hex(60000),
+        "eth_getTransactionCount": "0x0",
+        "eth_sendRawTransaction": "0x" + "ab" * 32,
+        "eth_getTransactionReceipt": None,
+    }
+
+
+def bench(name, max_age, args):
+    account = Account.create()
+    with StubRpcServer(node_methods(), delay=args.delay) as node:
+        os.environ.update(
+            {
+                "RPC_URL": node.url,
+                "RPC_URLS": "",
+                "CHAIN_ID": "1",
+                "CONTRACT_ADDRESS": "0x" + "22" * 20,
+                "FROM_ADDRESS": account.address,
+                "PRIVATE_KEY": account.key.hex(),
+                "SIGNER_PROCESSES": "0",
+                "INDEXER_DB": "",
+                "FEE_MAX_AGE": str(max_age),
+            }
+        )
+        from w3 import W3
+
+        w3 = W3()
+        w3.transfer(account.address, "0x" + "11" * 20, 1)
+        w3.chain_params.refresh()
+        node.calls.clear()
+        latencies = []
+        for i in range(args.transfers):
+            start = time.perf_counter()
+            w3.transfer(account.address, "0x" + format(i + 1, "040x"), 1)
+            latencies.append(time.perf_counter() - start)
+        calls = {
+            m: n for m, n in node.calls.items() if m != "eth_getTransactionReceipt"
+        }
+        w3.receipt_tracker.stop()
+        w3.chain_params.stop()
+        w3.w3.provider.stop()
+    return {"setup": name, "latency": summarize(latencies), "node_requests": calls}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--transfers", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02)
+    args = parser.parse_args()
+    print(json.dumps([bench("uncached", 0, args), bench("cached", 30, args)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
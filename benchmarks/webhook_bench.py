@@ -0,0 +1,71 @@
+"""
+Webhook delivery rate against a local HTTP stand-in
+
+Dispatches messages to an endpoint registered one message per POST and
+to one registered with batching, reporting deliveries per second and
+POSTs made. The stand-in fails a share of the requests with 503 to
+include retries.
+
+    python -m benchmarks.webhook_bench --messages 20000 --fail-rate 0.01
+"""
+
+import argparse
+import json
+import random
+import time
+
+from handlers import WebhookDispatcher
+from messages import AlphabetMessage
+from stub_rpc import StubWebhookServer
+
+
+def bench(batch, args):
+    path = "/batch" if batch else "/single"
+    statuses = [
+        503 if random.random() < args.fail_rate else 200 for _ in range(args.messages)
+    ]
+    with StubWebhookServer(statuses={path: statuses}) as hook:
+        # room for every message, the run measures delivery and not overflow
+        dispatcher = WebhookDispatcher(
+            concurrency=args.concurrency,
+            max_batch=args.max_batch,
+            backoff=0.01,
+            queue_size=args.messages,
+        )
+        dispatcher.register("alphabet", hook.url + path, batch=batch)
+        endpoint = dispatcher.endpoints[hook.url + path]
+        start = time.perf_counter()
+        for i in range(args.messages):
+            dispatcher.dispatch(AlphabetMessage(["sun", str(i)]))
+        # dead_letters only keeps the latest entries, the counter sees all
+        while hook.count(path) + endpoint.dead < args.messages:
+            if time.perf_counter() - start > args.timeout:
+                break
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        stats = dispatcher.stats()["endpoints"][hook.url + path]
+        dispatcher.stop()
+    return {
+        "batch": batch,
+        "delivered": hook.count(path),
+        "seconds": round(elapsed, 3),
+        "deliveries_per_second": round(hook.count(path) / elapsed),
+        "posts": hook.requests[path],
+        "retries": stats["retries"],
+        "dead_lettered": stats["dead_lettered"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-batch", type=int, default=100)
+    parser.add_argument("--fail-rate", type=float, default=0.01)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    print(json.dumps([bench(False, args), bench(True, args)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from .events import (
+    BALANCE_UPDATED,
+    EVENTS,
+    HELLO_FOUND,
+    TRANSFER_CONFIRMED,
+    TRANSFER_FAILED,
+    TRANSFER_REQUESTED,
+    TRANSFER_SENT,
+    Event,
+    EventBus,
+    EventSubscription,
+)
+
+__all__ = [
+    "BALANCE_UPDATED",
+    "EVENTS",
+    "HELLO_FOUND",
+    "TRANSFER_CONFIRMED",
+    "TRANSFER_FAILED",
+    "TRANSFER_REQUESTED",
+    "TRANSFER_SENT",
+    "Event",
+    "EventBus",
+    "EventSubscription",
+]
@@ -0,0 +1,129 @@
+import collections
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+HELLO_FOUND = "hello_found"
+TRANSFER_REQUESTED = "transfer_requested"
+TRANSFER_SENT = "transfer_sent"
+TRANSFER_CONFIRMED = "transfer_confirmed"
+TRANSFER_FAILED = "transfer_failed"
+BALANCE_UPDATED = "balance_updated"
+
+
+class Event:
+    __slots__ = ("seq", "type", "time", "data")
+
+    def __init__(self, seq, type, data):
+        self.seq = seq
+        self.type = type
+        self.time = time.time()
+        self.data = data
+
+    def to_dict(self):
+        return {"seq": self.seq, "type": self.type, "time": self.time, **self.data}
+
+    def __repr__(self):
+        return f"Event({self.seq}, {self.type!r}, {self.data!r})"
+
+
+class EventSubscription:
+    """
+    Bounded queue of the events of some types, a subscriber that falls
+    behind loses the oldest events instead of slowing down the publisher
+    """
+
+    def __init__(self, types=(), maxsize=1000):
+        self.types = set(types)
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, event):
+        if self.types and event.type not in self.types:
+            return
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """Next event, raises queue.Empty after timeout"""
+        return self.queue.get(timeout=timeout)
+
+    def wait_for(self, event_type, predicate=None, timeout=5):
+        """First event of event_type matching predicate(data), None on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                event = self.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if event.type == event_type and (
+                predicate is None or predicate(event.data)
+            ):
+                return event
+
+
+class EventBus:
+    """
+    In-process stream of typed events, like a hello being found or a
+    transfer being sent. Publishing never blocks, subscribers get their
+    own bounded queue and the latest events are kept numbered for
+    clients polling over RPC
+    """
+
+    def __init__(self, history=1000):
+        self.seq = 0
+        self.history = collections.deque(maxlen=history)
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    def publish(self, event_type, **data):
+        with self.lock:
+            self.seq += 1
+            event = Event(self.seq, event_type, data)
+            self.history.append(event)
+            subscriptions = self.subscriptions
+        for subscription in subscriptions:
+            subscription.offer(event)
+        REGISTRY.counter("events_published_total", type=event_type).inc()
+        return event
+
+    def subscribe(self, types=(), maxsize=1000):
+        subscription = EventSubscription(types, maxsize)
+        with self.lock:
+            # copied on write, publish iterates without holding the lock
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions = [
+                s for s in self.subscriptions if s is not subscription
+            ]
+
+    def since(self, seq=0, types=(), limit=100):
+        """Kept events numbered after seq, oldest first"""
+        with self.lock:
+            events = [event for event in self.history if event.seq > seq]
+        if types:
+            events = [event for event in events if event.type in types]
+        return events[:limit]
+
+    def last_seq(self):
+        with self.lock:
+            return self.seq
+
+
+EVENTS = EventBus()
@@ -1,3 +1,4 @@
 from .handlers import Handlers
+from .webhooks import WebhookDispatcher
 
-__all__ = ["Handlers"]
+__all__ = ["Handlers", "WebhookDispatcher"]
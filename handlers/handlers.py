@@ -1,54 +1,274 @@
 import threading
-import json
 import logging
 import queue
+import time
 
 from threading import ThreadError
-from web3.exceptions import Web3Exception
+
+from events import EVENTS, HELLO_FOUND, TRANSFER_REQUESTED
+from metrics import REGISTRY
+from w3 import TransferAggregator, is_address, is_web3_error
+from .process_lane import ProcessLane
+from .rules import WORD, Rule, RuleEngine
+from .webhooks import WebhookDispatcher
 
 logger = logging.getLogger("App.Handler")
 
+# base units sent per crypto message, 1 token of 18 decimals
+TRANSFER_AMOUNT = 10**18
+
+# what run_alphabet_handler used to check for
+DEFAULT_RULES = (
+    Rule(WORD, "hello", "log", params={"event": HELLO_FOUND}, id="hello"),
+    Rule(WORD, "crypto", "transfer", id="crypto"),
+)
+
 
 class Handlers:
-    def __init__(self, w3, inbox_queue):
+    """
+    Consumes the inbox queue with a pool of workers and routes every
+    message by its type to the registered handler. Slow, I/O bound work
+    is submitted to a named lane with its own workers so it cannot hold
+    up cheap handlers, CPU bound handlers run in the CPU lane. Messages
+    of types registered with a webhook URL are forwarded there as well.
+    Alphabet messages are matched against the rules of the rule engine,
+    which can be changed at runtime. Transfers asked for by rules are
+    collected over a window and sent as one transaction on the chain lane
+    """
+
+    def __init__(
+        self,
+        w3,
+        inbox_queue,
+        workers=2,
+        lanes=None,
+        poll_timeout=1,
+        transfer_window=1.0,
+        transfer_window_size=50,
+        processes=2,
+        webhooks=None,
+    ):
         self.w3 = w3
         self.inbox_queue = inbox_queue
 
+        self.workers = workers
+        self.lanes = lanes if lanes is not None else {"chain": 1}
+        self.lane_queues = {lane: queue.Queue() for lane in self.lanes}
+        self.poll_timeout = poll_timeout
+        self.cpu_lane = ProcessLane(processes)
+        self.webhooks = webhooks or WebhookDispatcher()
+
+        self.transfer_aggregator = TransferAggregator(
+            lambda batch: self.submit("chain", self.w3.send_transfer_batch, batch),
+            window=transfer_window,
+            max_size=transfer_window_size,
+            group_recipients=bool(self.w3.batch_contract_address),
+        )
+
+        self.actions = {
+            "log": self.log_action,
+            "transfer": self.transfer_action,
+            "forward": self.forward_action,
+        }
+        self.rule_engine = RuleEngine(self.actions, DEFAULT_RULES, self.prepare_rule)
+
+        self.routes = {}
+        self.register("alphabet", self.run_rules)
+
         self.stop_event = threading.Event()
         self.threads = []
 
+    def register(self, message_type, handler, cpu_bound=False, on_result=None):
+        """
+        Route inbox messages of message_type to handler(message). CPU
+        bound handlers run in the CPU lane and must be module level
+        functions, their return value is passed to on_result(message, result)
+        """
+        if cpu_bound:
+            self.routes[message_type] = lambda message: self.cpu_lane.submit(
+                handler, message, on_result
+            )
+        else:
+            self.routes[message_type] = handler
+
+    def submit(self, lane, func, *args):
+        """Run func(*args) on the workers of a lane"""
+        self.lane_queues[lane].put((func, args))
+
     def start(self):
-        thread = threading.Thread(target=self.process_inbound_msgs)
+        if self.w3.signer is not None:
+            self.w3.signer.start()
+        if self.w3.indexer is not None:
+            self.w3.indexer.start()
+        for i in range(self.workers):
+            self.start_thread(self.process_inbound_msgs, f"inbox-worker-{i}")
+        for lane, workers in self.lanes.items():
+            for i in range(workers):
+                self.start_thread(self.process_lane, f"{lane}-worker-{i}", lane)
+
+    def start_thread(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
         thread.daemon = True
         self.threads.append(thread)
         thread.start()
 
     def stop(self):
         logger.info("Stopping Handlers...")
-        self.stop_event.set()  # Signal the thread to stop
+        self.transfer_aggregator.stop()
+        self.stop_event.set()  # Signal the threads to stop
+        self.cpu_lane.stop()
+        self.webhooks.stop()
+        if self.w3.signer is not None:
+            self.w3.signer.stop()
+        if self.w3.indexer is not None:
+            self.w3.indexer.stop()
+        self.w3.chain_params.stop()
 
     def process_inbound_msgs(self):
         try:
             while not self.stop_event.is_set():
-                if not self.inbox_queue.empty():
-                    req_data = self.inbox_queue.get()
-                else:
+                try:
+                    message = self.inbox_queue.get(timeout=self.poll_timeout)
+                except queue.Empty:
                     continue
-                self.inbox_queue.task_done()
-                msg_type = req_data.get("type")
-                if msg_type == "alphabet":
-                    self.run_alphabet_handler(req_data["words"], req_data)
-        except Web3Exception as e:
-            logger.error("Web3 exception occured" + str(e))
+                try:
+                    self.dispatch(message)
+                finally:
+                    self.inbox_queue.task_done()
         except ThreadError as e:
             logger.error("Thread exception while processing inbox messages" + str(e))
+
+    def process_lane(self, lane):
+        lane_queue = self.lane_queues[lane]
+        while not self.stop_event.is_set():
+            try:
+                func, args = lane_queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except Exception as e:
+                REGISTRY.counter("lane_errors_total", lane=lane).inc()
+                if is_web3_error(e):
+                    logger.error("Web3 exception occured" + str(e))
+                else:
+                    logger.error(f"Exception in {lane} lane:" + str(e))
+            finally:
+                REGISTRY.histogram("lane_task_seconds", lane=lane).observe(
+                    time.perf_counter() - start
+                )
+                lane_queue.task_done()
+
+    def dispatch(self, message):
+        try:
+            msg_type = message.type
+        except AttributeError:
+            REGISTRY.counter("unrouted_messages_total").inc()
+            logger.error("Inbox item is not a message: " + repr(message))
+            return
+        handler = self.routes.get(msg_type)
+        try:
+            forwarded = self.webhooks.dispatch(message)
+        except Exception as e:
+            # the local handler still gets the message
+            forwarded = False
+            REGISTRY.counter("webhook_errors_total").inc()
+            logger.error("Exception while forwarding to webhooks:" + str(e))
+        if handler is None:
+            if not forwarded:
+                REGISTRY.counter("unrouted_messages_total").inc()
+            return
+        start = time.perf_counter()
+        try:
+            handler(message)
         except Exception as e:
-            logger.error("Exception:" + str(e))
+            REGISTRY.counter("handler_errors_total", type=msg_type).inc()
+            if is_web3_error(e):
+                logger.error("Web3 exception occured" + str(e))
+            else:
+                logger.error("Exception:" + str(e))
+        finally:
+            REGISTRY.histogram("handler_latency_seconds", type=msg_type).observe(
+                time.perf_counter() - start
+            )
+
+    def prepare_rule(self, rule):
+        """Checks the action params of a rule before it is added"""
+        params = rule.params
+        if rule.action == "transfer":
+            if "to" in params and not is_address(params["to"]):
+                raise ValueError("transfer to must be an address")
+            amount = params.get("amount", TRANSFER_AMOUNT)
+            if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                raise ValueError("transfer amount must be a positive integer")
+        elif rule.action == "forward":
+            url = params.get("url")
+            if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+                raise ValueError("forward url must be http(s)")
+
+    def add_rules(self, rules):
+        """
+        Adds rules all or none through the rule engine, endpoints of
+        forward rules are opened once the rules are active
+        """
+        ids = self.rule_engine.add(rules)
+        for id in ids:
+            rule = self.rule_engine.rules.get(id)
+            if rule is not None and rule.action == "forward":
+                self.forward_endpoint(rule)
+        return ids
+
+    def forward_endpoint(self, rule):
+        """Endpoint of a forward rule, one registered for the url is kept as is"""
+        url = rule.params["url"]
+        endpoint = self.webhooks.endpoints.get(url)
+        if endpoint is None:
+            endpoint = self.webhooks.add_endpoint(
+                url, batch=bool(rule.params.get("batch")), override=False
+            )
+        return endpoint
+
+    def run_rules(self, message):
+        for rule in self.rule_engine.match(message):
+            try:
+                self.actions[rule.action](rule, message)
+            except Exception as e:
+                REGISTRY.counter("rule_errors_total", action=rule.action).inc()
+                logger.error(f"Exception in rule {rule.id}:" + str(e))
+            else:
+                REGISTRY.counter("rule_matches_total", action=rule.action).inc()
+
+    def log_action(self, rule, message):
+        logger.info("Rule %s matched: %s", rule.id, message)
+        event = rule.params.get("event")
+        if event:
+            EVENTS.publish(event, rule=rule.id, words=message.words)
 
-    def run_alphabet_handler(self, words, req_data):
+    def transfer_action(self, rule, message):
+        to = rule.params.get("to", self.w3.to_address)
+        amount = rule.params.get("amount", TRANSFER_AMOUNT)
+        logger.info("Rule %s initiating transfer: %s", rule.id, message)
+        EVENTS.publish(
+            TRANSFER_REQUESTED,
+            rule=rule.id,
+            words=message.words,
+            to=to,
+            amount=amount,
+        )
+        # a journaled inbox keeps the message until the transfer is sent,
+        # a crash while it waits for its window replays it
+        hold = getattr(self.inbox_queue, "hold", None)
+        self.transfer_aggregator.add(
+            self.w3.from_address,
+            to,
+            self.w3.erc20_contract_address,
+            amount,
+            source=message,
+            on_submitted=hold() if hold else None,
+        )
 
-        if "hello" in words:
-            logger.info("Found hello:" + json.dumps(req_data))
-        if "crypto" in words:
-            logger.info("Found crypto initiating transfer:" + json.dumps(req_data))
-            self.w3.transfer(self.w3.from_address, self.w3.to_address)
+    def forward_action(self, rule, message):
+        # a rule matching before add_rules opened its endpoint opens it here
+        self.forward_endpoint(rule)
+        self.webhooks.send(rule.params["url"], message)
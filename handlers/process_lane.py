@@ -0,0 +1,71 @@
+import logging
+import multiprocessing
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("App.ProcessLane")
+
+
+class ProcessLane:
+    """
+    Runs CPU bound handlers in worker processes so they do not compete
+    for the GIL with the threads serving the sockets. The slotted message
+    and the handler result cross the process boundary pickled once and
+    on_result(message, result) is called in the agent process. Handlers
+    must be picklable, module level functions. At most max_pending
+    messages are in flight, further submits block the inbox worker
+    """
+
+    def __init__(self, processes=2, max_pending=None):
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = threading.BoundedSemaphore(max_pending or processes * 4)
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, handler, message, on_result=None):
+        self.start()
+        self.pending.acquire()
+        start = time.perf_counter()
+        try:
+            future = self.executor.submit(handler, message)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(
+            lambda future: self.complete(future, message, on_result, start)
+        )
+        return future
+
+    def complete(self, future, message, on_result, start):
+        self.pending.release()
+        REGISTRY.histogram("process_lane_seconds", type=message.type).observe(
+            time.perf_counter() - start
+        )
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            REGISTRY.counter("handler_errors_total", type=message.type).inc()
+            logger.error("Exception in process lane:" + str(error))
+            return
+        if on_result is not None:
+            try:
+                on_result(message, future.result())
+            except Exception as e:
+                logger.error("Exception handling process lane result:" + str(e))
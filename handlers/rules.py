@@ -0,0 +1,235 @@
+import collections
+import itertools
+import threading
+
+WORD = "word"
+PREFIX = "prefix"
+CONTAINS = "contains"
+FIELD = "field"
+
+KINDS = (WORD, PREFIX, CONTAINS, FIELD)
+
+# joins the words scanned by the automaton, a pattern never spans two words
+WORD_SEPARATOR = "\x00"
+
+
+class Rule:
+    """
+    Matches a message and names the action taken on it. Word rules
+    match a word exactly, prefix rules the start of a word, contains
+    rules any part of a word and field rules a value of message.data
+    """
+
+    __slots__ = ("id", "kind", "pattern", "action", "field", "params", "order")
+
+    def __init__(self, kind, pattern, action, field=None, params=None, id=None):
+        self.id = id
+        self.kind = kind
+        self.pattern = pattern
+        self.action = action
+        self.field = field
+        self.params = params if params is not None else {}
+        self.order = 0
+
+    def to_dict(self):
+        fields = {
+            "id": self.id,
+            "kind": self.kind,
+            "pattern": self.pattern,
+            "action": self.action,
+        }
+        if self.field is not None:
+            fields["field"] = self.field
+        if self.params:
+            fields["params"] = self.params
+        return fields
+
+    def __repr__(self):
+        return f"Rule({self.to_dict()!r})"
+
+
+class AhoCorasick:
+    """
+    Automaton finding every pattern occurring in a text in one pass over
+    the text, however many patterns there are
+    """
+
+    def __init__(self, patterns):
+        # node 0 is the root, outputs of a node include those of its
+        # fail node once built
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [()]
+        for pattern, value in patterns:
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append(())
+                node = next_node
+            self.outputs[node] += (value,)
+        self.build()
+
+    def build(self):
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                pending.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def search(self, text):
+        """Values of the patterns found in text, once per occurrence"""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        found = []
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                found.extend(outputs[node])
+        return found
+
+
+class CompiledRules:
+    """
+    Index of a fixed set of rules. Words are looked up in a hash set,
+    prefixes by walking a trie along the word and substrings with one
+    Aho-Corasick pass over all words, so matching a message costs about
+    the same for a handful of rules as for thousands
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.words = collections.defaultdict(list)
+        self.fields = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.prefixes = {}
+        contains = []
+        for rule in rules:
+            if rule.kind == WORD:
+                self.words[rule.pattern].append(rule)
+            elif rule.kind == FIELD:
+                self.fields[rule.field][rule.pattern].append(rule)
+            elif rule.kind == PREFIX:
+                node = self.prefixes
+                for char in rule.pattern:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(rule)
+            else:
+                contains.append((rule.pattern, rule))
+        self.words = dict(self.words)
+        self.fields = {field: dict(values) for field, values in self.fields.items()}
+        self.automaton = AhoCorasick(contains) if contains else None
+
+    def match(self, message):
+        """Rules matching message in rule order, each once"""
+        matched = {}
+        words = getattr(message, "words", None) or ()
+        for word in words:
+            for rule in self.words.get(word, ()):
+                matched[rule.id] = rule
+            node = self.prefixes
+            for char in word:
+                node = node.get(char)
+                if node is None:
+                    break
+                for rule in node.get(None, ()):
+                    matched[rule.id] = rule
+        if self.automaton is not None and words:
+            for rule in self.automaton.search(WORD_SEPARATOR.join(words)):
+                matched[rule.id] = rule
+        for field, values in self.fields.items():
+            value = message.data.get(field)
+            if isinstance(value, str):
+                for rule in values.get(value, ()):
+                    matched[rule.id] = rule
+        if len(matched) > 1:
+            return sorted(matched.values(), key=lambda rule: rule.order)
+        return list(matched.values())
+
+
+class RuleEngine:
+    """
+    Holds the active rules and their compiled index. Adding or removing
+    rules compiles a new index next to the one in use and swaps it in
+    with one assignment, workers matching messages never wait for it.
+    prepare(rule) is called for every valid rule before it is added and
+    may reject it with ValueError
+    """
+
+    def __init__(self, actions, rules=(), prepare=None):
+        self.actions = actions
+        self.prepare = prepare
+        self.rules = {}
+        self.order = itertools.count()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.compiled = CompiledRules([])
+        self.add(rules)
+
+    def validate(self, rule):
+        if rule.kind not in KINDS:
+            raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+        if not isinstance(rule.pattern, str) or not rule.pattern:
+            raise ValueError("pattern must be a non empty string")
+        if WORD_SEPARATOR in rule.pattern:
+            raise ValueError("pattern must not contain NUL")
+        if rule.kind == FIELD and not isinstance(rule.field, str):
+            raise ValueError("field rules need a field name")
+        if rule.action not in self.actions:
+            raise ValueError(f"action must be one of {', '.join(self.actions)}")
+        if not isinstance(rule.params, dict):
+            raise ValueError("params must be an object")
+
+    def add(self, rules):
+        """
+        Add or replace rules given as Rule objects or dicts of Rule
+        fields, raises ValueError and adds none when one is invalid
+        """
+        try:
+            rules = [r if isinstance(r, Rule) else Rule(**r) for r in rules]
+        except TypeError as e:
+            raise ValueError("Invalid rule: " + str(e))
+        for rule in rules:
+            self.validate(rule)
+            if self.prepare is not None:
+                self.prepare(rule)
+        with self.lock:
+            active = dict(self.rules)
+            for rule in rules:
+                if rule.id is None:
+                    rule.id = f"rule-{next(self.ids)}"
+                previous = active.get(rule.id)
+                rule.order = previous.order if previous else next(self.order)
+                active[rule.id] = rule
+            self.swap(active)
+        return [rule.id for rule in rules]
+
+    def remove(self, rule_ids):
+        """Ids of the rules that were removed"""
+        with self.lock:
+            active = dict(self.rules)
+            removed = [id for id in rule_ids if active.pop(id, None) is not None]
+            if removed:
+                self.swap(active)
+        return removed
+
+    def swap(self, active):
+        compiled = CompiledRules(list(active.values()))
+        self.rules = active
+        self.compiled = compiled
+
+    def match(self, message):
+        return self.compiled.match(message)
+
+    def list(self):
+        return [rule.to_dict() for rule in self.compiled.rules]
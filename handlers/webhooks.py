@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import logging
+import random
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("App.Webhooks")
+
+# statuses worth another attempt, anything else is final
+RETRY_STATUSES = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+
+class WebhookEndpoint:
+    """Delivery queue, workers and counters of one registered URL"""
+
+    def __init__(self, url, batch=False):
+        self.url = url
+        self.batch = batch
+        self.queue = None
+        self.tasks = []
+        self.delivered = 0
+        self.requests = 0
+        self.retries = 0
+        self.dead = 0
+
+    def stats(self):
+        return {
+            "batch": self.batch,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "delivered": self.delivered,
+            "requests": self.requests,
+            "retries": self.retries,
+            "dead_lettered": self.dead,
+        }
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class WebhookDispatcher:
+    """
+    Forwards inbox messages to the URLs registered for their type. The
+    deliveries run on an event loop in a background thread with one
+    pooled keep-alive aiohttp session, every endpoint has its own
+    bounded queue and at most concurrency requests in flight. Endpoints
+    registered with batch=True get a JSON array of every message queued
+    at the time, up to max_batch, in one POST. Failed requests are
+    retried with exponential backoff and messages that still could not
+    be delivered end up in the dead letter queue
+    """
+
+    def __init__(
+        self,
+        concurrency=8,
+        max_batch=100,
+        attempts=5,
+        backoff=0.1,
+        max_backoff=5,
+        timeout=5,
+        queue_size=10000,
+        dead_letters=1000,
+    ):
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.queue_size = queue_size
+
+        self.endpoints = {}
+        self.routes = {}
+        self.dead_letters = collections.deque(maxlen=dead_letters)
+        self.lock = threading.RLock()
+        self.loop = None
+        self.thread = None
+        self.session = None
+
+    def start(self):
+        """Started by the first registration, aiohttp is only imported then"""
+        if self.thread is not None:
+            return
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.loop.call_soon(ready.set)
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="webhooks", daemon=True
+        )
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+        try:
+            future.result(self.timeout)
+        except Exception as e:
+            logger.error("Error while closing webhook session" + str(e))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.timeout)
+
+    def register(self, message_type, url, batch=False):
+        with self.lock:
+            endpoint = self.add_endpoint(url, batch)
+            endpoints = self.routes.get(message_type, [])
+            if endpoint not in endpoints:
+                # copied on write, dispatch reads routes without the lock
+                self.routes = {**self.routes, message_type: endpoints + [endpoint]}
+        logger.info(f"Forwarding {message_type} messages to {url}")
+
+    def add_endpoint(self, url, batch=False, override=True):
+        """
+        Endpoint of url, opened on the first call. Without override an
+        existing endpoint keeps its batch setting
+        """
+        with self.lock:
+            self.start()
+            endpoint = self.endpoints.get(url)
+            if endpoint is None:
+                endpoint = WebhookEndpoint(url, batch)
+                asyncio.run_coroutine_threadsafe(
+                    self.open(endpoint), self.loop
+                ).result()
+                self.endpoints = {**self.endpoints, url: endpoint}
+            elif override:
+                endpoint.batch = batch
+            return endpoint
+
+    def dispatch(self, message):
+        """
+        Queue message for the endpoints of its type without blocking the
+        calling thread, False when no endpoint is registered for it
+        """
+        endpoints = self.routes.get(message.type)
+        if not endpoints:
+            return False
+        for endpoint in endpoints:
+            self.loop.call_soon_threadsafe(self.enqueue, endpoint, message)
+        return True
+
+    def send(self, url, message):
+        """Queue message for an endpoint added with add_endpoint"""
+        self.loop.call_soon_threadsafe(self.enqueue, self.endpoints[url], message)
+
+    def enqueue(self, endpoint, message):
+        try:
+            endpoint.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dead_letter(endpoint, [message], "delivery queue full", 0)
+
+    async def open(self, endpoint):
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.concurrency, keepalive_timeout=30
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        endpoint.queue = asyncio.Queue(self.queue_size)
+        endpoint.tasks = [
+            asyncio.get_running_loop().create_task(self.work(endpoint))
+            for _ in range(self.concurrency)
+        ]
+
+    async def close(self):
+        for endpoint in self.endpoints.values():
+            for task in endpoint.tasks:
+                task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def work(self, endpoint):
+        while True:
+            messages = [await endpoint.queue.get()]
+            if endpoint.batch:
+                while len(messages) < self.max_batch and not endpoint.queue.empty():
+                    messages.append(endpoint.queue.get_nowait())
+            try:
+                await self.deliver(endpoint, messages)
+            except Exception as e:
+                self.dead_letter(endpoint, messages, str(e), 0)
+
+    async def deliver(self, endpoint, messages):
+        if endpoint.batch:
+            body = "[" + ",".join(message.to_json() for message in messages) + "]"
+        else:
+            body = messages[0].to_json()
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self.session.post(
+                    endpoint.url,
+                    data=body.encode(),
+                    headers={"Content-Type": "application/json"},
+                ) as response:
+                    await response.read()
+                    status = response.status
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                error = None if status < 300 else f"HTTP {status}"
+                retry = status in RETRY_STATUSES
+            except Exception as e:
+                status, error, retry = "error", f"{type(e).__name__} {e}", True
+            endpoint.requests += 1
+            REGISTRY.histogram("webhook_request_seconds").observe(
+                time.perf_counter() - start
+            )
+            REGISTRY.counter("webhook_requests_total", status=str(status)).inc()
+            if error is None:
+                endpoint.delivered += len(messages)
+                return
+            if not retry or attempt >= self.attempts:
+                self.dead_letter(endpoint, messages, error, attempt)
+                return
+            endpoint.retries += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            await asyncio.sleep(
+                retry_after
+                if retry_after is not None
+                else delay * random.uniform(0.5, 1)
+            )
+
+    def dead_letter(self, endpoint, messages, error, attempts):
+        endpoint.dead += len(messages)
+        REGISTRY.counter("webhook_dead_letters_total").inc(len(messages))
+        logger.error(
+            f"Giving up on {len(messages)} messages for {endpoint.url}: {error}"
+        )
+        self.dead_letters.append(
+            {
+                "url": endpoint.url,
+                "messages": [message.to_dict() for message in messages],
+                "error": error,
+                "attempts": attempts,
+                "time": time.time(),
+            }
+        )
+
+    def stats(self):
+        return {
+            "endpoints": {
+                url: endpoint.stats() for url, endpoint in list(self.endpoints.items())
+            },
+            "routes": {
+                message_type: [endpoint.url for endpoint in endpoints]
+                for message_type, endpoints in self.routes.items()
+            },
+            "dead_letters": len(self.dead_letters),
+        }
@@ -0,0 +1,3 @@
+from .logs import JsonLinesFormatter, LazyQueueHandler, setup_logging
+
+__all__ = ["JsonLinesFormatter", "LazyQueueHandler", "setup_logging"]
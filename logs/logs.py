@@ -0,0 +1,77 @@
+import atexit
+import json
+import logging
+import queue
+
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import REGISTRY
+
+TEXT_FORMAT = "%(name)s - %(levelname)s - %(message)s"
+
+# attributes of every LogRecord, anything else was passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "taskName",
+}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record, fields passed with extra= are kept"""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread as they are, the message is
+    only rendered from its arguments there. A full queue drops the record
+    instead of blocking the logging thread
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            REGISTRY.counter("log_records_dropped_total").inc()
+
+
+def setup_logging(log_file=None, level=logging.INFO, queue_size=10000):
+    """
+    Route every logger through a bounded queue to a listener thread
+    writing readable lines to stderr and JSON lines to log_file
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers = [stream_handler]
+    if log_file:
+        file_handler = logging.FileHandler(log_file, mode="w")
+        file_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue(queue_size)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [LazyQueueHandler(log_queue)]
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
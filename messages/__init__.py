@@ -0,0 +1,25 @@
+from .messages import (
+    MESSAGE_METHOD,
+    MESSAGE_TYPE_IDS,
+    MESSAGE_TYPES,
+    AlphabetMessage,
+    Message,
+    Request,
+    Response,
+    json_default,
+    message_from_dict,
+    register_message_type,
+)
+
+__all__ = [
+    "MESSAGE_METHOD",
+    "MESSAGE_TYPE_IDS",
+    "MESSAGE_TYPES",
+    "AlphabetMessage",
+    "Message",
+    "Request",
+    "Response",
+    "json_default",
+    "message_from_dict",
+    "register_message_type",
+]
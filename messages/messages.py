@@ -0,0 +1,203 @@
+import json
+import struct
+
+JSONRPC_VERSION = "2.0"
+MESSAGE_METHOD = "Message"
+
+# keys of the call that carried a message, not part of the message itself
+ENVELOPE_KEYS = frozenset(("method", "type", "jsonrpc", "id"))
+
+SHORT = struct.Struct(">H")
+
+
+def json_default(obj):
+    """json.dumps hook serializing messages and envelopes"""
+    try:
+        return obj.to_dict()
+    except AttributeError:
+        raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+class Message:
+    """
+    Message passed between agents and through the inbox and outbox
+    queues. Fields of message types without a dedicated class are kept
+    in data. The JSON text a message was decoded from is kept so logging
+    it does not serialize the message again
+    """
+
+    __slots__ = ("type", "data", "json_text")
+
+    TYPE_ID = 0
+
+    def __init__(self, type, data=None, json_text=None):
+        self.type = type
+        self.data = data if data is not None else {}
+        self.json_text = json_text
+
+    @classmethod
+    def from_data(cls, msg_type, data, json_text=None):
+        return cls(msg_type, data, json_text)
+
+    def to_dict(self):
+        fields = {"method": MESSAGE_METHOD, "type": self.type}
+        fields.update(self.data)
+        return fields
+
+    def pack(self):
+        """Binary layout of the fields, None when the type has none"""
+        return None
+
+    def to_json(self):
+        if self.json_text is None:
+            self.json_text = json.dumps(self.to_dict(), separators=(",", ":"))
+        return self.json_text
+
+    def __str__(self):
+        return self.to_json()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+
+class AlphabetMessage(Message):
+    """Words drawn from the alphabet by the words_generator behaviour"""
+
+    __slots__ = ("words",)
+
+    TYPE = "alphabet"
+    TYPE_ID = 1
+
+    def __init__(self, words, data=None, json_text=None):
+        super().__init__(self.TYPE, data, json_text)
+        self.words = words
+
+    @classmethod
+    def from_data(cls, msg_type, data, json_text=None):
+        words = data.pop("words", None)
+        if not isinstance(words, list) or not all(isinstance(w, str) for w in words):
+            raise ValueError("alphabet message needs a list of words")
+        return cls(words, data, json_text)
+
+    @classmethod
+    def unpack(cls, view, position):
+        (count,) = SHORT.unpack_from(view, position)
+        position += SHORT.size
+        words = []
+        for _ in range(count):
+            (size,) = SHORT.unpack_from(view, position)
+            position += SHORT.size
+            words.append(str(view[position : position + size], "utf-8"))
+            position += size
+        return cls(words)
+
+    def pack(self):
+        """Word count followed by the length prefixed utf-8 words"""
+        words = [word.encode() for word in self.words]
+        if len(words) > 0xFFFF or any(len(word) > 0xFFFF for word in words):
+            return None
+        parts = [SHORT.pack(len(words))]
+        for word in words:
+            parts.append(SHORT.pack(len(word)))
+            parts.append(word)
+        return b"".join(parts)
+
+    def to_dict(self):
+        fields = {"method": MESSAGE_METHOD, "type": self.TYPE, "words": self.words}
+        fields.update(self.data)
+        return fields
+
+
+MESSAGE_TYPES = {AlphabetMessage.TYPE: AlphabetMessage}
+MESSAGE_TYPE_IDS = {AlphabetMessage.TYPE_ID: AlphabetMessage}
+
+
+def register_message_type(message_class):
+    """
+    Decode messages of message_class.TYPE into message_class, a non
+    zero TYPE_ID gives it a packed binary layout
+    """
+    MESSAGE_TYPES[message_class.TYPE] = message_class
+    if message_class.TYPE_ID:
+        MESSAGE_TYPE_IDS[message_class.TYPE_ID] = message_class
+
+
+def message_from_dict(fields, json_text=None):
+    """
+    Build the typed message of a decoded call or pushed message,
+    raises ValueError when the fields do not fit the message type
+    """
+    if not isinstance(fields, dict):
+        raise ValueError("message must be an object")
+    msg_type = fields.get("type")
+    data = {k: v for k, v in fields.items() if k not in ENVELOPE_KEYS}
+    if fields.get("method") != MESSAGE_METHOD or "jsonrpc" in fields or "id" in fields:
+        # the text carries more than the message, to_json must not return it
+        json_text = None
+    message_class = MESSAGE_TYPES.get(msg_type, Message)
+    return message_class.from_data(msg_type, data, json_text)
+
+
+class Request:
+    """
+    A decoded JSON-RPC call. is_v2 tells JSON-RPC 2.0 calls and batch
+    entries apart from the plain calls of the original protocol, fields
+    holds the whole call for methods that take the request itself
+    """
+
+    __slots__ = ("method", "params", "id", "is_v2", "has_id", "fields", "json_text")
+
+    def __init__(
+        self, method, params=None, id=None, is_v2=False, has_id=False, fields=None
+    ):
+        self.method = method
+        self.params = params if params is not None else []
+        self.id = id
+        self.is_v2 = is_v2
+        self.has_id = has_id
+        self.fields = fields if fields is not None else {}
+        self.json_text = None
+
+    @classmethod
+    def from_dict(cls, fields, batch=False, json_text=None):
+        """Raises ValueError for anything that is not a call object"""
+        if not isinstance(fields, dict) or not isinstance(fields.get("method"), str):
+            raise ValueError("Invalid Request")
+        request = cls(
+            fields["method"],
+            fields.get("params", []),
+            fields.get("id"),
+            batch or fields.get("jsonrpc") == JSONRPC_VERSION,
+            "id" in fields,
+            fields,
+        )
+        request.json_text = json_text
+        return request
+
+    @property
+    def is_notification(self):
+        return self.is_v2 and not self.has_id
+
+    def to_dict(self):
+        return self.fields or {"method": self.method, "params": self.params}
+
+
+class Response:
+    """JSON-RPC 2.0 response, error is an error object"""
+
+    __slots__ = ("id", "result", "error")
+
+    def __init__(self, id, result=None, error=None):
+        self.id = id
+        self.result = result
+        self.error = error
+
+    def to_dict(self):
+        if self.error is not None:
+            return {"jsonrpc": JSONRPC_VERSION, "error": self.error, "id": self.id}
+        return {"jsonrpc": JSONRPC_VERSION, "result": self.result, "id": self.id}
@@ -0,0 +1,3 @@
+from .metrics import REGISTRY, Counter, Gauge, Histogram, MetricsRegistry
+
+__all__ = ["REGISTRY", "Counter", "Gauge", "Histogram", "MetricsRegistry"]
@@ -0,0 +1,178 @@
+import bisect
+import threading
+
+# Latency buckets in seconds, from 100us up to 30s
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Set explicitly or read from a callable at snapshot time"""
+
+    kind = "gauge"
+
+    def __init__(self, func=None):
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.func() if self.func else self.value
+
+
+class Histogram:
+    """Fixed bucket histogram, observing is a bisect and one locked update"""
+
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            count, total, maximum = self.count, self.sum, self.max
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": maximum,
+        }
+
+
+class MetricsRegistry:
+    """
+    Process wide registry of named, labelled metrics. Lookups of an
+    existing metric are a dict get, so hot paths can fetch and update
+    a metric on every call
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, labels, *args):
+        items = tuple(labels.items())
+        key = (name, items if len(items) < 2 else tuple(sorted(items)))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(*args)
+        return metric
+
+    def counter(self, name, **labels):
+        return self.get(Counter, name, labels)
+
+    def gauge(self, name, func=None, **labels):
+        gauge = self.get(Gauge, name, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, **labels):
+        return self.get(Histogram, name, labels)
+
+    def snapshot(self):
+        """Nested dict of metric name to labelled values"""
+        snapshot = {}
+        for (name, labels), metric in list(self.metrics.items()):
+            key = ",".join(f"{k}={v}" for k, v in labels) or "value"
+            snapshot.setdefault(name, {})[key] = metric.snapshot()
+        return snapshot
+
+    def prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self.metrics.items(), key=lambda i: i[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {metric.kind}")
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    counts = list(metric.counts)
+                    count, total = metric.count, metric.sum
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    bucket_labels = labels + (("le", bound),)
+                    lines.append(
+                        f"{name}_bucket{format_labels(bucket_labels)} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {metric.snapshot()}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,25 @@
+from .async_server import AsyncJsonRpcServer
+from .broker import OutboxBroker, Subscription
+from .codec import BINARY, JSON
+from .connection import Connection, PeerLink
+from .framing import FrameDecoder, FrameTooLarge, encode_message, encode_messages
+from .journal import JournalQueue, open_queue
+from .mesh import PeerClient, Router
+
+__all__ = [
+    "AsyncJsonRpcServer",
+    "BINARY",
+    "Connection",
+    "FrameDecoder",
+    "FrameTooLarge",
+    "JSON",
+    "JournalQueue",
+    "OutboxBroker",
+    "PeerClient",
+    "PeerLink",
+    "Router",
+    "Subscription",
+    "encode_message",
+    "encode_messages",
+    "open_queue",
+]
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+
+from agent import Agent
+from .broker import DROP_OLDEST, OutboxBroker
+from .connection import Connection
+from .framing import RECV_SIZE, FrameTooLarge
+from .journal import open_queue
+from .mesh import create_router
+
+OUTBOX_BATCH_SIZE = 64
+
+logger = logging.getLogger("App.AsyncServer")
+
+
+class AsyncJsonRpcServer:
+    """
+    Single event loop variant of JsonRpcServer built on asyncio streams.
+    Every accepted connection is served by coroutines instead of
+    dedicated threads, requests are routed through Agent.handle_request
+    and outbox messages are pushed to connected clients
+    """
+
+    def __init__(
+        self,
+        port,
+        external_agent_port,
+        host="127.0.0.1",
+        peers=(),
+        mesh_file=None,
+    ):
+        self.inbox_queue = open_queue(
+            "inbox", int(os.getenv("INBOX_QUEUE_SIZE", 10000))
+        )
+        self.outbox_queue = open_queue(
+            "outbox", int(os.getenv("OUTBOX_QUEUE_SIZE", 10000))
+        )
+
+        self.agent = Agent(self.inbox_queue, self.outbox_queue)
+
+        self.broker = OutboxBroker(
+            self.outbox_queue,
+            capacity=int(os.getenv("OUTBOX_BUFFER_SIZE", 1024)),
+            policy=os.getenv("OUTBOX_OVERFLOW_POLICY", DROP_OLDEST),
+        )
+        self.agent.register_method("outbox_stats", self.outbox_stats)
+
+        self.host = host
+        self.port = port
+        self.external_agent_port = external_agent_port
+        self.router = create_router(
+            self.agent, peers, mesh_file, host, external_agent_port
+        )
+
+        self.loop = None
+        self.server = None
+
+    async def handle_client(self, reader, writer):
+        """Coroutine serving a single connected client."""
+        connection = Connection(self.agent, writer.write)
+        push_task = self.loop.create_task(self.push_outbox_messages(writer, connection))
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                connection.receive(data)
+                await writer.drain()
+                if not data:
+                    break
+        except FrameTooLarge as e:
+            logger.error("Dropping client, " + str(e))
+        except ConnectionResetError as e:
+            logger.error("Connection reset by peer" + str(e))
+        except OSError as e:
+            logger.error("Socket connection error" + str(e))
+        finally:
+            push_task.cancel()
+            writer.close()
+
+    async def push_outbox_messages(self, writer, connection):
+        """
+        Pushing messages published by the outbox broker to a connected
+        client, the broker pump thread wakes the task up through the
+        event loop and buffered messages are coalesced into one write
+        """
+        ready = asyncio.Event()
+        subscription = self.broker.subscribe(
+            "%s:%s" % writer.get_extra_info("peername")[:2],
+            on_ready=lambda: self.loop.call_soon_threadsafe(ready.set),
+        )
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                batch = subscription.drain(OUTBOX_BATCH_SIZE)
+                while batch:
+                    connection.push(batch)
+                    await writer.drain()
+                    batch = subscription.drain(OUTBOX_BATCH_SIZE)
+        except OSError as e:
+            logger.error("connection lost" + str(e))
+        finally:
+            self.broker.unsubscribe(subscription)
+
+    def outbox_stats(self):
+        return {"result": self.broker.stats()}
+
+    async def listen(self):
+        """Bind the server, port 0 binds any free port"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, reuse_address=True, backlog=1024
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Async JSON-RPC server listening on {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        """Accept connections and push outbox messages until cancelled."""
+        if self.server is None:
+            await self.listen()
+        self.broker.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def main(self):
+        self.agent.start()
+        await self.listen()
+        # links to the peer agents run on threads of the router
+        self.router.start("%s:%s" % (self.host, self.port))
+        await self.serve_forever()
+
+    def run(self):
+        asyncio.run(self.main())
@@ -0,0 +1,181 @@
+import collections
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("App.Broker")
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class Subscription:
+    """
+    Bounded ring buffer of outbox messages for one subscriber.
+    When the buffer is full the overflow policy either drops the oldest
+    buffered message, drops the new one or blocks the publisher until
+    the subscriber catches up
+    """
+
+    def __init__(self, name, capacity, policy, on_ready=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.on_ready = on_ready
+
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def offer(self, item, block_timeout=None):
+        """Buffer a message, returns False when it was dropped"""
+        with self.condition:
+            if self.closed:
+                return False
+            self.published += 1
+            if len(self.buffer) >= self.capacity:
+                if self.policy == BLOCK:
+                    self.condition.wait_for(
+                        lambda: len(self.buffer) < self.capacity or self.closed,
+                        block_timeout,
+                    )
+                if self.policy == DROP_OLDEST:
+                    self.buffer.popleft()
+                    self.dropped += 1
+                elif len(self.buffer) >= self.capacity or self.closed:
+                    self.dropped += 1
+                    return False
+            self.buffer.append(item)
+            self.condition.notify_all()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def get_batch(self, max_items, timeout=None):
+        """
+        Wait for buffered messages and take up to max_items of them,
+        returns an empty list on timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.buffer or self.closed, timeout)
+            return self._take(max_items)
+
+    def drain(self, max_items):
+        """Take up to max_items buffered messages without waiting"""
+        with self.condition:
+            return self._take(max_items)
+
+    def _take(self, max_items):
+        batch = []
+        while self.buffer and len(batch) < max_items:
+            batch.append(self.buffer.popleft())
+        if batch:
+            self.delivered += len(batch)
+            self.condition.notify_all()
+        return batch
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "name": self.name,
+                "policy": self.policy,
+                "capacity": self.capacity,
+                "lag": len(self.buffer),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+            }
+
+
+class OutboxBroker:
+    """
+    Fans every message of the outbox queue out to all subscribers,
+    one pump thread moves messages from the queue into the ring
+    buffers of the subscribers
+    """
+
+    def __init__(
+        self,
+        outbox_queue,
+        capacity=1024,
+        policy=DROP_OLDEST,
+        block_timeout=1,
+        poll_timeout=1,
+    ):
+        self.outbox_queue = outbox_queue
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.poll_timeout = poll_timeout
+
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.published = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def subscribe(self, name, capacity=None, policy=None, on_ready=None):
+        subscription = Subscription(
+            name,
+            capacity or self.capacity,
+            policy or self.policy,
+            on_ready,
+        )
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def publish(self, item):
+        self.published += 1
+        for subscription in self.subscriptions:
+            subscription.offer(item, self.block_timeout)
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.pump, name="outbox-broker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        logger.info("Stopping outbox broker...")
+        self.stop_event.set()
+
+    def pump(self):
+        while not self.stop_event.is_set():
+            try:
+                item = self.outbox_queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                continue
+            try:
+                self.publish(item)
+            except Exception as e:
+                logger.error("Exception while publishing outbox message" + str(e))
+            finally:
+                self.outbox_queue.task_done()
+
+    def stats(self):
+        """Published count and per subscriber lag"""
+        return {
+            "published": self.published,
+            "subscribers": [s.stats() for s in self.subscriptions],
+        }
@@ -0,0 +1,131 @@
+import json
+import os
+import struct
+
+from messages import MESSAGE_TYPE_IDS, Message, json_default, message_from_dict
+from .framing import encode_message, encode_messages
+
+NEGOTIATE_METHOD = "negotiate_codec"
+NEGOTIATE_TAG = NEGOTIATE_METHOD.encode()
+
+LENGTH = struct.Struct(">I")
+
+# first byte of a binary frame body, message classes use their TYPE_ID
+JSON_BODY = 0
+
+
+class JsonCodec:
+    """Newline delimited compact JSON, the default wire format"""
+
+    name = "json"
+    length_prefixed = False
+
+    def encode(self, obj):
+        return encode_message(obj)
+
+    def encode_many(self, objs):
+        return encode_messages(objs)
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+    def decode_message(self, frame):
+        return message_from_dict(json.loads(frame), frame.decode())
+
+
+class BinaryCodec:
+    """
+    Length prefixed frames. Messages with a registered class are struct
+    packed field by field without keys, everything else is carried as a
+    compact JSON body. The bodies double as the journal record format
+    """
+
+    name = "binary"
+    length_prefixed = True
+
+    def encode(self, obj):
+        body = self.encode_body(obj)
+        return LENGTH.pack(len(body)) + body
+
+    def encode_many(self, objs):
+        return b"".join(self.encode(obj) for obj in objs)
+
+    def encode_body(self, obj):
+        if isinstance(obj, Message) and obj.TYPE_ID and not obj.data:
+            packed = obj.pack()
+            if packed is not None:
+                return bytes((obj.TYPE_ID,)) + packed
+        return (
+            bytes((JSON_BODY,))
+            + json.dumps(obj, separators=(",", ":"), default=json_default).encode()
+        )
+
+    def decode(self, frame):
+        return self.decode_body(frame)
+
+    def decode_body(self, body):
+        """Message or decoded JSON of a body, raises ValueError on garbage"""
+        try:
+            type_id = body[0]
+            if type_id == JSON_BODY:
+                return json.loads(body[1:])
+            return MESSAGE_TYPE_IDS[type_id].unpack(memoryview(body), 1)
+        except (IndexError, KeyError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError("Invalid binary message " + str(e))
+
+    def decode_message(self, frame):
+        message = self.decode_body(frame)
+        if isinstance(message, Message):
+            return message
+        return message_from_dict(message)
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY, JSON)}
+
+
+def offered_codecs():
+    """Codecs offered to peers in order of preference, WIRE_CODECS=json disables binary"""
+    names = os.getenv("WIRE_CODECS", "binary,json").split(",")
+    return [name.strip() for name in names if name.strip() in CODECS]
+
+
+def negotiation_request(codecs):
+    return {
+        "jsonrpc": "2.0",
+        "method": NEGOTIATE_METHOD,
+        "params": [list(codecs)],
+        "id": NEGOTIATE_METHOD,
+    }
+
+
+def parse_negotiation(frame):
+    """Decoded negotiation request or reply, None for any other frame"""
+    if NEGOTIATE_TAG not in frame:
+        return None
+    try:
+        call = json.loads(frame)
+    except ValueError:
+        return None
+    if not isinstance(call, dict):
+        return None
+    if call.get("method") == NEGOTIATE_METHOD or call.get("id") == NEGOTIATE_METHOD:
+        return call
+    return None
+
+
+def negotiate(call):
+    """Reply to a negotiation request and the codec picked from the offer"""
+    params = call.get("params")
+    offered = params[0] if isinstance(params, list) and params else []
+    codec = next(
+        (CODECS[name] for name in offered if isinstance(name, str) and name in CODECS),
+        JSON,
+    )
+    return {"jsonrpc": "2.0", "result": codec.name, "id": call.get("id")}, codec
+
+
+def negotiated_codec(reply):
+    """Codec accepted by the peer, servers that do not negotiate keep JSON"""
+    return CODECS.get(reply.get("result"), JSON)
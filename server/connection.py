@@ -0,0 +1,148 @@
+import logging
+import threading
+
+from agent.errors import PARSE_ERROR, JsonRpcError
+from messages import Message, message_from_dict
+from .codec import (
+    JSON,
+    NEGOTIATE_TAG,
+    negotiate,
+    negotiated_codec,
+    negotiation_request,
+    offered_codecs,
+    parse_negotiation,
+)
+from .framing import FrameDecoder
+
+logger = logging.getLogger("App.Connection")
+
+
+def has_negotiation_tag(frame):
+    return NEGOTIATE_TAG in frame
+
+
+class Connection:
+    """
+    Wire state of one accepted client connection. Requests are decoded
+    with the codec negotiated with the client and routed through the
+    agent. Replies and pushed messages are passed to write under a lock,
+    so they never interleave and the codec only changes between writes
+    """
+
+    def __init__(self, agent, write):
+        self.agent = agent
+        self.write = write
+        self.decoder = FrameDecoder()
+        self.codec = JSON
+        self.lock = threading.Lock()
+        # rate limit of this connection, None when unlimited
+        self.client = agent.admission.client()
+
+    @property
+    def until(self):
+        return None if self.decoder.length_prefixed else has_negotiation_tag
+
+    def receive(self, data):
+        """Handle received bytes, empty data once the client closed"""
+        if not data:
+            self.handle(self.decoder.close())
+            return
+        frames = self.decoder.feed(data, self.until)
+        while frames:
+            self.handle(frames)
+            frames = self.decoder.feed(b"", self.until)
+
+    def handle(self, frames):
+        negotiation = None
+        if frames and self.until is not None:
+            negotiation = parse_negotiation(frames[-1])
+            if negotiation is not None:
+                frames = frames[:-1]
+        responses = self.route(frames)
+        with self.lock:
+            if responses:
+                self.write(self.codec.encode_many(responses))
+            if negotiation is not None:
+                reply, codec = negotiate(negotiation)
+                self.write(JSON.encode(reply))
+                self.codec = codec
+                self.decoder.length_prefixed = codec.length_prefixed
+
+    def route(self, frames):
+        """Route every frame, notifications produce no response"""
+        responses = []
+        for frame in frames:
+            if self.codec is JSON:
+                response = self.agent.handle_request(frame.decode(), self.client)
+            else:
+                try:
+                    response = self.agent.handle_decoded(
+                        self.codec.decode(frame), client=self.client
+                    )
+                except ValueError:
+                    response = self.agent.error_response(
+                        None, JsonRpcError(PARSE_ERROR, "Invalid message")
+                    )
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def push(self, messages):
+        with self.lock:
+            self.write(self.codec.encode_many(messages))
+
+
+class PeerLink:
+    """
+    Client side of the link to the external agent. hello() is sent right
+    after connecting to offer the binary codec, pushed frames are
+    decoded into messages with the codec the agent accepted and replies
+    to calls made over the link are returned as plain dicts
+    """
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.codec = JSON
+        self.negotiating = False
+
+    def hello(self):
+        """Negotiation request, None when only JSON is configured"""
+        codecs = offered_codecs()
+        if not codecs or codecs == [JSON.name]:
+            return None
+        self.negotiating = True
+        return JSON.encode(negotiation_request(codecs))
+
+    def feed(self, data):
+        """Messages and replies of the received bytes, raises ValueError on garbage"""
+        messages = []
+        until = has_negotiation_tag if self.negotiating else None
+        frames = self.decoder.feed(data, until)
+        while frames:
+            for frame in frames:
+                if self.negotiating:
+                    reply = parse_negotiation(frame)
+                    if reply is not None and "method" not in reply:
+                        self.switch(negotiated_codec(reply))
+                        continue
+                messages.append(self.decode(frame))
+            until = has_negotiation_tag if self.negotiating else None
+            frames = self.decoder.feed(b"", until)
+        return messages
+
+    def decode(self, frame):
+        decoded = self.codec.decode(frame)
+        if isinstance(decoded, Message):
+            return decoded
+        if isinstance(decoded, dict) and "method" not in decoded:
+            if "result" in decoded or "error" in decoded:
+                return decoded
+        return message_from_dict(
+            decoded, frame.decode() if self.codec is JSON else None
+        )
+
+    def switch(self, codec):
+        logger.info(f"Peer link uses the {codec.name} codec")
+        self.negotiating = False
+        self.codec = codec
+        self.decoder.length_prefixed = codec.length_prefixed
@@ -0,0 +1,120 @@
+import json
+import struct
+
+from messages import Message, json_default
+
+DELIMITER = b"\n"
+MAX_FRAME_SIZE = 1024 * 1024
+RECV_SIZE = 64 * 1024
+LENGTH_PREFIX = struct.Struct(">I")
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def encode_message(message):
+    """
+    Newline delimited JSON framing, json.dumps escapes control
+    characters so the delimiter never occurs inside a message
+    """
+    if isinstance(message, Message):
+        return message.to_json().encode() + DELIMITER
+    return (
+        json.dumps(message, separators=(",", ":"), default=json_default).encode()
+        + DELIMITER
+    )
+
+
+def encode_messages(messages):
+    """Coalesce several messages into a single write"""
+    return b"".join(encode_message(message) for message in messages)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for newline delimited messages.
+    Received bytes are read into a reusable buffer and every complete
+    frame is returned per recv, partial frames are kept until the
+    rest of the message arrives. Once a binary codec is negotiated
+    length_prefixed switches to 4 byte big endian length prefixes
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, recv_size=RECV_SIZE):
+        self.max_frame_size = max_frame_size
+        self.length_prefixed = False
+        self.buffer = bytearray()
+        self.recv_buffer = bytearray(recv_size)
+        self.recv_view = memoryview(self.recv_buffer)
+
+    def feed(self, data, until=None):
+        """
+        Append received bytes and return all complete frames. Splitting
+        stops after a frame for which until(frame) is true, the rest
+        stays buffered so the framing can be switched before it is read
+        """
+        self.buffer += data
+        if self.length_prefixed:
+            return self.feed_length_prefixed()
+        frames = []
+        start = 0
+        while True:
+            end = self.buffer.find(DELIMITER, start)
+            if end == -1:
+                break
+            if end > start:
+                frames.append(bytes(self.buffer[start:end]))
+            start = end + 1
+            if until is not None and frames and until(frames[-1]):
+                del self.buffer[:start]
+                return frames
+        if start:
+            del self.buffer[:start]
+        if len(self.buffer) > self.max_frame_size:
+            self.buffer.clear()
+            raise FrameTooLarge(
+                f"frame exceeds {self.max_frame_size} bytes without delimiter"
+            )
+        return frames
+
+    def feed_length_prefixed(self):
+        frames = []
+        start = 0
+        buffered = len(self.buffer)
+        while buffered - start >= LENGTH_PREFIX.size:
+            (size,) = LENGTH_PREFIX.unpack_from(self.buffer, start)
+            if size > self.max_frame_size:
+                self.buffer.clear()
+                raise FrameTooLarge(
+                    f"frame of {size} bytes exceeds {self.max_frame_size}"
+                )
+            end = start + LENGTH_PREFIX.size + size
+            if end > buffered:
+                break
+            frames.append(bytes(self.buffer[start + LENGTH_PREFIX.size : end]))
+            start = end
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def recv(self, sock, until=None):
+        """
+        Read once from a blocking socket, returns the complete frames
+        or None once the peer closed the connection
+        """
+        size = sock.recv_into(self.recv_buffer)
+        if not size:
+            return None
+        return self.feed(self.recv_view[:size], until)
+
+    def close(self):
+        """
+        Remaining bytes once the peer closed the connection, lets
+        clients that send a single unterminated message and
+        disconnect still be served
+        """
+        frames = []
+        if not self.length_prefixed and self.buffer.strip():
+            frames.append(bytes(self.buffer))
+        self.buffer.clear()
+        return frames
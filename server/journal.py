@@ -0,0 +1,349 @@
+import functools
+import heapq
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from messages import MESSAGE_METHOD, message_from_dict
+
+from .codec import BINARY
+
+logger = logging.getLogger("App.Journal")
+
+# length, crc32 of the payload, sequence number
+RECORD_HEADER = struct.Struct("<IIQ")
+SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_SUFFIX = ".seg"
+
+
+class Segment:
+    """Preallocated, memory mapped journal file starting at first_seq"""
+
+    def __init__(self, path, first_seq, size):
+        self.path = path
+        self.first_seq = first_seq
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.position = 0
+
+    def records(self):
+        """Yield (seq, payload) of every intact record, stops at a torn write"""
+        position = 0
+        while position + RECORD_HEADER.size <= self.size:
+            length, crc, seq = RECORD_HEADER.unpack_from(self.map, position)
+            end = position + RECORD_HEADER.size + length
+            if not length or end > self.size:
+                break
+            payload = self.map[position + RECORD_HEADER.size : end]
+            if zlib.crc32(payload) != crc:
+                logger.error(f"Corrupt record {seq} in {self.path}, truncating")
+                break
+            yield seq, payload
+            position = end
+        self.position = position
+
+    def fits(self, payload):
+        return self.position + RECORD_HEADER.size + len(payload) <= self.size
+
+    def append(self, seq, payload):
+        RECORD_HEADER.pack_into(
+            self.map, self.position, len(payload), zlib.crc32(payload), seq
+        )
+        start = self.position + RECORD_HEADER.size
+        self.map[start : start + len(payload)] = payload
+        self.position = start + len(payload)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class JournalQueue:
+    """
+    queue.Queue compatible queue backed by an append-only journal of
+    memory mapped segments. Every put is appended to the journal as a
+    binary codec body before it becomes visible to consumers, a background thread msyncs dirty
+    segments in groups and persists the consumer checkpoint. A consumer
+    acknowledges the item it got with task_done from the same thread,
+    so a restart replays only items that were never acknowledged. A
+    consumer handing the item on to later work calls hold first, the
+    item is then acknowledged once that work released it as well.
+    Records written to the mapping survive a process crash right away,
+    sync_interval bounds what an OS crash can lose
+    """
+
+    def __init__(
+        self,
+        directory,
+        name,
+        maxsize=0,
+        segment_size=SEGMENT_SIZE,
+        sync_interval=0.005,
+        checkpoint_interval=0.5,
+    ):
+        self.directory = directory
+        self.name = name
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # unbounded while replaying, a backlog larger than maxsize must not block
+        self.queue = queue.Queue()
+        self.write_lock = threading.Lock()
+        self.ack_lock = threading.Lock()
+        self.local = threading.local()
+
+        self.segments = []
+        self.next_seq = 1
+        self.dirty = False
+        self.acked = self.read_checkpoint()
+        self.saved_ack = self.acked
+        self.early_acks = []
+        # seq -> [unreleased holds, task_done called]
+        self.holds = {}
+
+        self.replay()
+        self.queue.maxsize = maxsize
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"journal-{name}")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, f"{self.name}.checkpoint")
+
+    def segment_path(self, first_seq):
+        return os.path.join(
+            self.directory, f"{self.name}-{first_seq:020d}{SEGMENT_SUFFIX}"
+        )
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)["acked"]
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Unreadable journal checkpoint, replaying all" + str(e))
+            return 0
+
+    def write_checkpoint(self, acked):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"acked": acked}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def replay(self):
+        """Load unacknowledged records of existing segments into the queue"""
+        prefix = self.name + "-"
+        names = sorted(
+            n
+            for n in os.listdir(self.directory)
+            if n.startswith(prefix) and n.endswith(SEGMENT_SUFFIX)
+        )
+        replayed = 0
+        for file_name in names:
+            first_seq = int(file_name[len(prefix) : -len(SEGMENT_SUFFIX)])
+            segment = Segment(
+                os.path.join(self.directory, file_name), first_seq, self.segment_size
+            )
+            self.segments.append(segment)
+            for seq, payload in segment.records():
+                self.next_seq = seq + 1
+                if seq > self.acked:
+                    self.queue.put((seq, self.decode(payload)))
+                    replayed += 1
+        self.next_seq = max(self.next_seq, self.acked + 1)
+        if replayed:
+            logger.info(f"Replayed {replayed} unacknowledged {self.name} messages")
+        self.remove_acked_segments()
+        if not self.segments:
+            self.segments.append(
+                Segment(
+                    self.segment_path(self.next_seq), self.next_seq, self.segment_size
+                )
+            )
+
+    def decode(self, payload):
+        """
+        Item of a record, messages stored as JSON bodies are rebuilt as
+        the Message they were put as
+        """
+        item = BINARY.decode_body(payload)
+        if isinstance(item, dict) and item.get("method") == MESSAGE_METHOD:
+            return message_from_dict(item)
+        return item
+
+    def put(self, item, block=True, timeout=None):
+        if not block and self.full():
+            raise queue.Full
+        payload = BINARY.encode_body(item)
+        with self.write_lock:
+            segment = self.segments[-1]
+            if not segment.fits(payload):
+                segment.flush()
+                segment = Segment(
+                    self.segment_path(self.next_seq),
+                    self.next_seq,
+                    max(self.segment_size, RECORD_HEADER.size * 2 + len(payload)),
+                )
+                self.segments.append(segment)
+            seq = self.next_seq
+            self.next_seq += 1
+            segment.append(seq, payload)
+            self.dirty = True
+        try:
+            self.queue.put((seq, item), block, timeout)
+        except queue.Full:
+            # journaled but never queued, the checkpoint must move past it
+            self.ack(seq)
+            raise
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        seq, item = self.queue.get(block, timeout)
+        self.local.seq = seq
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        """Acknowledge the item last taken by this thread unless it is held"""
+        seq = getattr(self.local, "seq", None)
+        if seq is not None:
+            self.local.seq = None
+            with self.ack_lock:
+                hold = self.holds.get(seq)
+                if hold is not None:
+                    hold[1] = True
+            if hold is None:
+                self.ack(seq)
+        self.queue.task_done()
+
+    def hold(self):
+        """
+        Keep the item last taken by this thread unacknowledged after
+        task_done, returns the callable releasing it. The item is
+        acknowledged once every hold on it was released
+        """
+        seq = getattr(self.local, "seq", None)
+        if seq is None:
+            return None
+        with self.ack_lock:
+            self.holds.setdefault(seq, [0, False])[0] += 1
+        return functools.partial(self.release, seq)
+
+    def release(self, seq):
+        with self.ack_lock:
+            hold = self.holds[seq]
+            hold[0] -= 1
+            if hold[0]:
+                return
+            del self.holds[seq]
+            if not hold[1]:
+                # task_done is still to come and acknowledges it
+                return
+        self.ack(seq)
+
+    def ack(self, seq):
+        with self.ack_lock:
+            heapq.heappush(self.early_acks, seq)
+            while self.early_acks and self.early_acks[0] <= self.acked + 1:
+                self.acked = max(self.acked, heapq.heappop(self.early_acks))
+
+    @property
+    def maxsize(self):
+        return self.queue.maxsize
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def full(self):
+        return self.queue.full()
+
+    def join(self):
+        self.queue.join()
+
+    def run(self):
+        checkpoint_wait = 0
+        while not self.stop_event.wait(self.sync_interval):
+            self.sync()
+            checkpoint_wait += self.sync_interval
+            if checkpoint_wait >= self.checkpoint_interval:
+                checkpoint_wait = 0
+                self.checkpoint()
+
+    def sync(self):
+        """Group commit of everything appended since the last sync"""
+        with self.write_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            segment = self.segments[-1]
+        segment.flush()
+
+    def checkpoint(self):
+        acked = self.acked
+        if acked == self.saved_ack:
+            return
+        try:
+            self.write_checkpoint(acked)
+            self.saved_ack = acked
+        except OSError as e:
+            logger.error("Could not write journal checkpoint" + str(e))
+            return
+        with self.write_lock:
+            self.remove_acked_segments()
+
+    def remove_acked_segments(self):
+        """Drop segments whose records are all acknowledged, never the active one"""
+        while (
+            len(self.segments) > 1 and self.segments[1].first_seq - 1 <= self.saved_ack
+        ):
+            self.segments.pop(0).remove()
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sync()
+        self.checkpoint()
+        for segment in self.segments:
+            segment.close()
+
+
+def open_queue(name, maxsize=0):
+    """
+    Journaled queue when JOURNAL_DIR is configured, plain in-memory
+    queue otherwise
+    """
+    directory = os.getenv("JOURNAL_DIR")
+    if directory:
+        return JournalQueue(directory, name, maxsize)
+    return queue.Queue(maxsize)
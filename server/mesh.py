@@ -0,0 +1,452 @@
+import logging
+import os
+import queue
+import random
+import socket
+import threading
+import time
+
+from messages import Message
+from metrics import REGISTRY
+from .connection import PeerLink
+from .framing import RECV_SIZE
+
+logger = logging.getLogger("App.Mesh")
+
+ANNOUNCE_METHOD = "peer_announce"
+MAX_HOPS = 16
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def read_mesh_file(path):
+    """(agent_id, address) of every agent registered in a discovery file"""
+    entries = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    entries.append((parts[0], parts[1]))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class PeerClient:
+    """
+    Persistent link to a peer agent. Connects with exponential backoff,
+    negotiates the codec and announces the local routes with a
+    peer_announce call, the reply carries the routes of the peer.
+    Pushed outbox messages of the peer are handed to the router and
+    messages routed through the peer are written by a writer thread
+    """
+
+    def __init__(
+        self, address, router, min_backoff=0.05, max_backoff=5, connect_timeout=2
+    ):
+        self.address = address
+        self.router = router
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+
+        self.peer_id = None
+        self.ready = False
+        self.sock = None
+        self.link = None
+        self.outgoing = queue.Queue()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for target, name in (
+            (self.run, f"peer-{self.address}"),
+            (self.write_loop, f"peer-writer-{self.address}"),
+        ):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.outgoing.put(None)
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        backoff = self.min_backoff
+        while not self.stop_event.is_set():
+            try:
+                sock = socket.create_connection(
+                    parse_address(self.address), timeout=self.connect_timeout
+                )
+            except OSError:
+                # jittered so agents started together do not retry in lockstep
+                self.stop_event.wait(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.min_backoff
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self.serve(sock)
+            except (OSError, ValueError) as e:
+                logger.error(f"Link to {self.address} lost " + str(e))
+            finally:
+                self.sock = None
+                sock.close()
+                self.router.link_down(self)
+
+    def serve(self, sock):
+        self.link = PeerLink()
+        hello = self.link.hello()
+        if hello:
+            sock.sendall(hello)
+        self.sock = sock
+        if not self.link.negotiating:
+            self.announce()
+        while not self.stop_event.is_set():
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                break
+            negotiating = self.link.negotiating
+            for item in self.link.feed(data):
+                if isinstance(item, Message):
+                    self.router.receive(item)
+                elif item.get("id") == ANNOUNCE_METHOD:
+                    self.on_announce_reply(item)
+            if negotiating and not self.link.negotiating:
+                self.announce()
+
+    def announce(self):
+        """Send the local routes, nothing is written while negotiating"""
+        if self.sock is None or self.link.negotiating:
+            return
+        self.outgoing.put(
+            {
+                "jsonrpc": "2.0",
+                "method": ANNOUNCE_METHOD,
+                "params": [self.router.announcement(self.peer_id)],
+                "id": ANNOUNCE_METHOD,
+            }
+        )
+
+    def on_announce_reply(self, reply):
+        if "error" in reply:
+            logger.error(f"{self.address} does not take part in the mesh")
+            return
+        announcement = reply["result"]
+        first = self.peer_id is None
+        self.router.link_up(self, announcement)
+        if first:
+            logger.info(f"Linked to agent {self.peer_id} at {self.address}")
+
+    def send(self, fields):
+        """Queue a routed message as a notification to the peer"""
+        fields["jsonrpc"] = "2.0"
+        self.outgoing.put(fields)
+
+    def write_loop(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            batch = [item]
+            while True:
+                try:
+                    item = self.outgoing.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    return
+                batch.append(item)
+            sock = self.sock
+            if sock is None:
+                REGISTRY.counter("mesh_dropped_total").inc(len(batch))
+                continue
+            try:
+                sock.sendall(self.link.codec.encode_many(batch))
+            except OSError as e:
+                logger.error(f"Could not write to {self.address} " + str(e))
+
+
+class Router:
+    """
+    Routing table of the agent mesh. Every agent announces the agents
+    it reaches, with hop counts and topics, to its direct peers and
+    keeps the shortest path to each agent (distance vector with split
+    horizon). Messages carrying "to" (agent ids) or "topic" are sent
+    to the peer on the shortest path, one copy per next hop
+    """
+
+    def __init__(
+        self,
+        deliver,
+        agent_id=None,
+        topics=(),
+        peers=(),
+        mesh_file=None,
+        announce_interval=1.0,
+    ):
+        self.deliver = deliver
+        self.agent_id = agent_id
+        self.address = None
+        self.topics = set(topics)
+        self.peers = list(peers)
+        self.mesh_file = mesh_file
+        self.mesh_file_mtime = None
+        self.announce_interval = announce_interval
+
+        self.clients = {}
+        self.vectors = {}
+        self.routes = {}
+        self.lock = threading.RLock()
+        self.changed = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def attach(self, agent):
+        """Route addressed messages of the agent and add the mesh methods"""
+        agent.router = self
+        agent.register_method(ANNOUNCE_METHOD, self.on_announce)
+        agent.register_method("mesh_routes", self.mesh_routes)
+        agent.register_method("subscribe_topic", self.subscribe_topic)
+        agent.register_method("unsubscribe_topic", self.unsubscribe_topic)
+
+    def start(self, address):
+        """Start once the server is bound, address is its host:port"""
+        self.address = address
+        self.agent_id = self.agent_id or address
+        if self.mesh_file:
+            with open(self.mesh_file, "a") as f:
+                f.write(f"{self.agent_id} {address}\n")
+        for peer in self.peers:
+            self.add_peer(peer)
+        self.thread = threading.Thread(target=self.run, name="mesh-router")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Agent {self.agent_id} joined the mesh at {address}")
+
+    def stop(self):
+        self.stop_event.set()
+        self.changed.set()
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.stop()
+
+    def add_peer(self, address):
+        with self.lock:
+            if address == self.address or address in self.clients:
+                return
+            client = PeerClient(address, self)
+            self.clients[address] = client
+        client.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.changed.wait(self.announce_interval)
+            self.changed.clear()
+            if self.stop_event.is_set():
+                return
+            self.discover()
+            self.expire()
+            with self.lock:
+                clients = list(self.clients.values())
+            for client in clients:
+                client.announce()
+
+    def discover(self):
+        if not self.mesh_file:
+            return
+        try:
+            mtime = os.stat(self.mesh_file).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self.mesh_file_mtime:
+            return
+        self.mesh_file_mtime = mtime
+        for agent_id, address in read_mesh_file(self.mesh_file):
+            self.add_peer(address)
+
+    def expire(self):
+        """Forget vectors of peers that stopped announcing"""
+        deadline = time.monotonic() - 3.5 * self.announce_interval
+        with self.lock:
+            stale = [p for p, (_, seen) in self.vectors.items() if seen < deadline]
+            for peer_id in stale:
+                del self.vectors[peer_id]
+            if stale:
+                self.recompute()
+
+    def links(self):
+        """Ready links by peer agent id"""
+        return {c.peer_id: c for c in self.clients.values() if c.ready}
+
+    def announcement(self, peer_id=None):
+        """Local routes as announced to peer_id, routes through it are left out"""
+        with self.lock:
+            routes = {self.agent_id: [0, sorted(self.topics)]}
+            for dest, (hops, next_hop, topics) in self.routes.items():
+                if next_hop != peer_id:
+                    routes[dest] = [hops, topics]
+            return {"id": self.agent_id, "address": self.address, "routes": routes}
+
+    def on_announce(self, announcement):
+        """peer_announce method, a peer sending its routes over its own link"""
+        self.add_peer(announcement["address"])
+        self.update(announcement["id"], announcement)
+        return {"result": self.announcement(announcement["id"])}
+
+    def update(self, peer_id, announcement):
+        with self.lock:
+            self.vectors[peer_id] = (announcement["routes"], time.monotonic())
+            self.recompute()
+
+    def link_up(self, client, announcement):
+        with self.lock:
+            client.peer_id = announcement["id"]
+            client.ready = True
+            self.update(client.peer_id, announcement)
+
+    def link_down(self, client):
+        """Routes through a lost link are dropped before it can be used again"""
+        with self.lock:
+            client.ready = False
+            if client.peer_id in self.vectors:
+                del self.vectors[client.peer_id]
+            self.recompute()
+
+    def recompute(self):
+        links = self.links()
+        best = {}
+        for peer_id, (routes, _) in self.vectors.items():
+            if peer_id not in links:
+                continue
+            for dest, (hops, topics) in routes.items():
+                hops += 1
+                if dest == self.agent_id or hops > MAX_HOPS:
+                    continue
+                current = best.get(dest)
+                if current is None or (hops, peer_id) < current[:2]:
+                    best[dest] = (hops, peer_id, topics)
+        if best != self.routes:
+            self.routes = best
+            self.changed.set()
+
+    def is_addressed(self, message):
+        return "to" in message.data or "topic" in message.data
+
+    def receive(self, message):
+        """Message pushed by a peer"""
+        try:
+            self.route(message)
+        except queue.Full as e:
+            logger.error("Inbox Queue full" + str(e))
+
+    def route(self, message):
+        """
+        Deliver a local copy when this agent is addressed and forward
+        one copy per next hop, returns where the message went
+        """
+        if not self.is_addressed(message):
+            self.deliver(message)
+            return {"delivered": True}
+        to = message.data.get("to") or []
+        targets = {to} if isinstance(to, str) else set(to)
+        topic = message.data.get("topic")
+        ttl = message.data.get("ttl", MAX_HOPS)
+
+        with self.lock:
+            if topic is not None:
+                if topic in self.topics:
+                    targets.add(self.agent_id)
+                for dest, (_, _, topics) in self.routes.items():
+                    if topic in topics:
+                        targets.add(dest)
+            links = self.links()
+            by_hop = {}
+            unreachable = []
+            for dest in targets - {self.agent_id}:
+                route = self.routes.get(dest)
+                # a link lost since the last recompute is as good as no route
+                if route is None or ttl <= 0 or route[1] not in links:
+                    unreachable.append(dest)
+                else:
+                    by_hop.setdefault(route[1], []).append(dest)
+
+        for next_hop, dests in by_hop.items():
+            fields = message.to_dict()
+            fields.pop("topic", None)
+            fields.update(to=sorted(dests), ttl=ttl - 1)
+            fields.setdefault("from", self.agent_id)
+            links[next_hop].send(fields)
+            REGISTRY.counter("mesh_forwarded_total").inc()
+        if unreachable:
+            REGISTRY.counter("mesh_unreachable_total").inc(len(unreachable))
+            logger.error(f"No route to {sorted(unreachable)}")
+        delivered = self.agent_id in targets
+        if delivered:
+            self.deliver(message)
+        return {
+            "delivered": delivered,
+            "forwarded": {hop: sorted(dests) for hop, dests in by_hop.items()},
+            "unreachable": sorted(unreachable),
+        }
+
+    def mesh_routes(self):
+        with self.lock:
+            return {
+                "result": {
+                    "id": self.agent_id,
+                    "topics": sorted(self.topics),
+                    "routes": {
+                        dest: {"hops": hops, "via": next_hop, "topics": topics}
+                        for dest, (hops, next_hop, topics) in self.routes.items()
+                    },
+                }
+            }
+
+    def subscribe_topic(self, topic):
+        with self.lock:
+            self.topics.add(topic)
+        self.changed.set()
+        return {"result": sorted(self.topics)}
+
+    def unsubscribe_topic(self, topic):
+        with self.lock:
+            self.topics.discard(topic)
+        self.changed.set()
+        return {"result": sorted(self.topics)}
+
+
+def create_router(
+    agent, peers=(), mesh_file=None, host="127.0.0.1", external_agent_port=None
+):
+    """
+    Router of a server attached to its agent, the external agent of the
+    two agent setup is one more peer
+    """
+    peers = list(peers)
+    if external_agent_port is not None:
+        peers.append(f"{host}:{external_agent_port}")
+    topics = [topic for topic in os.getenv("MESH_TOPICS", "").split(",") if topic]
+    router = Router(
+        agent.enqueue,
+        agent_id=os.getenv("AGENT_ID"),
+        topics=topics,
+        peers=peers,
+        mesh_file=mesh_file,
+        announce_interval=float(os.getenv("MESH_ANNOUNCE_INTERVAL", 1)),
+    )
+    router.attach(agent)
+    return router
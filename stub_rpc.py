@@ -0,0 +1,205 @@
+import collections
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# fields of a call object a node only takes as hex strings
+QUANTITY_FIELDS = (
+    "value",
+    "gas",
+    "gasPrice",
+    "maxFeePerGas",
+    "maxPriorityFeePerGas",
+    "nonce",
+)
+
+
+class StubRpcHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, without this the body
+    # waits for the delayed ack of the client on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if stub.delay:
+            time.sleep(stub.delay)
+        if stub.failing:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        request = json.loads(body)
+        if isinstance(request, list):
+            response = [stub.handle(call) for call in request]
+        else:
+            response = stub.handle(request)
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubRpcServer:
+    """
+    Local JSON-RPC node for tests and benchmarks. Methods answer with
+    a fixed value or a callable taking the params, delay and failing
+    simulate slow or broken nodes
+
+        with StubRpcServer({"eth_blockNumber": "0x10"}) as node:
+            provider = PooledHTTPProvider([node.url])
+    """
+
+    def __init__(self, methods=None, host="127.0.0.1", port=0, delay=0):
+        self.methods = {
+            "web3_clientVersion": "stub/1.0",
+            "eth_chainId": "0x1",
+            "eth_blockNumber": "0x1",
+        }
+        self.methods.update(methods or {})
+        self.delay = delay
+        self.failing = False
+        self.calls = collections.Counter()
+
+        self.server = ThreadingHTTPServer((host, port), StubRpcHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = "http://%s:%s" % self.server.server_address
+        self.thread = None
+
+    def handle(self, call):
+        method = call.get("method")
+        self.calls[method] += 1
+        response = {"jsonrpc": "2.0", "id": call.get("id")}
+        if method not in self.methods:
+            response["error"] = {"code": -32601, "message": "Method not found"}
+            return response
+        if not self.valid_quantities(call.get("params", [])):
+            response["error"] = {
+                "code": -32602,
+                "message": "invalid argument 0: json: cannot unmarshal number "
+                "into Go struct field TransactionArgs of type *hexutil.Big",
+            }
+            return response
+        result = self.methods[method]
+        try:
+            response["result"] = (
+                result(call.get("params", [])) if callable(result) else result
+            )
+        except Exception as e:
+            response["error"] = {"code": -32000, "message": str(e)}
+        return response
+
+    def valid_quantities(self, params):
+        """Call objects carry quantities as hex strings, like geth requires"""
+        call_object = params[0] if params and isinstance(params[0], dict) else {}
+        return all(
+            isinstance(call_object[key], str) and call_object[key].startswith("0x")
+            for key in QUANTITY_FIELDS
+            if key in call_object
+        )
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = stub.next_status(self.path)
+        if status < 300:
+            stub.receive(self.path, json.loads(body))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubWebhookServer:
+    """
+    Local webhook receiver. POSTed bodies are kept per path, statuses
+    maps a path to the status codes of its next requests, 200 once they
+    are used up
+
+        with StubWebhookServer(statuses={"/flaky": [503]}) as hook:
+            dispatcher.register("alphabet", hook.url + "/flaky")
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, statuses=None):
+        self.statuses = {
+            path: collections.deque(codes) for path, codes in (statuses or {}).items()
+        }
+        self.received = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), StubWebhookHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = "http://%s:%s" % self.server.server_address
+        self.thread = None
+
+    def next_status(self, path):
+        with self.lock:
+            self.requests[path] += 1
+            codes = self.statuses.get(path)
+            return codes.popleft() if codes else 200
+
+    def receive(self, path, body):
+        with self.lock:
+            self.received[path].extend(body if isinstance(body, list) else [body])
+
+    def count(self, path):
+        with self.lock:
+            return len(self.received[path])
+
+    def valid_quantities(self, params):
+        """Call objects carry quantities as hex strings, like geth requires"""
+        call_object = params[0] if params and isinstance(params[0], dict) else {}
+        return all(
+            isinstance(call_object[key], str) and call_object[key].startswith("0x")
+            for key in QUANTITY_FIELDS
+            if key in call_object
+        )
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
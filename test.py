@@ -1,11 +1,63 @@
+import collections
 import socket
 import os
+import queue
 import time
+import asyncio
 import json
 import pytest
 import random
+import logging
+import operator
+import subprocess
+import threading
+import sys
+import types
 
-from w3 import W3
+from agent import Agent
+from agent.admission import AdmissionControl, TokenBucket
+from events import EVENTS, HELLO_FOUND, EventBus
+from logs import JsonLinesFormatter, LazyQueueHandler
+from eth_abi import decode as abi_decode, encode as abi_encode
+from eth_account import Account
+from eth_account.typed_transactions import TypedTransaction
+from hexbytes import HexBytes
+from behaviours.scheduler import Scheduler
+from handlers import Handlers, WebhookDispatcher
+from handlers.process_lane import ProcessLane
+from metrics import REGISTRY, MetricsRegistry
+from w3 import (
+    W3,
+    BalanceCache,
+    NonceManager,
+    PooledHTTPProvider,
+    TransferAggregator,
+    TransferIndexer,
+)
+from w3.calls import (
+    TRANSFER_TOPIC,
+    decode_transfer_log,
+    encode_address,
+    encode_transfer,
+)
+from w3.chain_params import COLD_RECIPIENT_GAS
+from w3.receipts import PendingTransaction, ReceiptTracker
+from w3.signer import SignerPool, build_transfer
+from stub_rpc import StubRpcServer, StubWebhookServer
+from messages import AlphabetMessage, Message, message_from_dict
+from server import (
+    BINARY,
+    AsyncJsonRpcServer,
+    JSON,
+    Connection,
+    FrameDecoder,
+    JournalQueue,
+    OutboxBroker,
+    PeerLink,
+    Router,
+    encode_message,
+    encode_messages,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -45,35 +97,60 @@ def test_alphabet_behaviour():
         pytest.fail(
             "Connection failed: Please run agent app, Integration tests will fail"
         )
-    response = connection.recv(1024)
+    decoder = FrameDecoder()
+    frames = []
+    while not frames:
+        frames = decoder.recv(connection)
     connection.close()
-    res_json = json.loads(response.decode("utf-8"))
+    res_json = json.loads(frames[0])
     for word in res_json["words"]:
         assert word in alphabet
 
 
+def call_agent(method, params=None, port=server1_port):
+    """Result of a JSON-RPC call, pushed outbox messages are skipped"""
+    connection = get_socket_connection(host, port)
+    if not connection:
+        pytest.fail(
+            "Connection failed: Please run agent app, Integration tests will fail"
+        )
+    request = {"jsonrpc": "2.0", "method": method, "params": params or {}, "id": 1}
+    connection.sendall(encode_message(request))
+    decoder = FrameDecoder()
+    try:
+        while True:
+            for frame in decoder.recv(connection) or []:
+                response = json.loads(frame)
+                if response.get("id") == 1:
+                    return response["result"]
+    finally:
+        connection.close()
+
+
+def wait_for_event(event_type, predicate=None, since=0, timeout=5):
+    """First event of the agent stream matching predicate, fails on timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = call_agent("events", {"since": since, "types": [event_type]})
+        for event in result["events"]:
+            if predicate is None or predicate(event):
+                return event
+        since = result["next"]
+        time.sleep(0.1)
+    pytest.fail(f"No {event_type} event")
+
+
 def test_balance_behaviour():
     w3 = W3()
-    with open("app1.log", "r") as f:
-        lines = f.readlines()
-        total_lines = len(lines)
-        found = 0
-        if total_lines > 0:
-            last_20_lines = lines[-(total_lines if total_lines < 20 else 20) :]
-            for line in last_20_lines:
-                if "Balance is:" in line:
-                    line = line.split(":", 1)[1]
-                    balance = float(line)
-                    assert w3.get_balance(from_address) == balance
-                    found = 1
-                    f.close()
-                    break
-        if not found:
-            pytest.fail("Could not find Balance keyword")
+    event = wait_for_event(
+        "balance_updated", lambda event: event["address"] == from_address, timeout=15
+    )
+    assert w3.get_balance(from_address) == event["balance"]
 
 
 def test_hello_alphabet_behaviour():
     test_word = str(random.random())
+    since = call_agent("events", {"types": ["hello_found"]})["next"]
     message = {
         "method": "Message",
         "type": "alphabet",
@@ -85,56 +162,1108 @@ def test_hello_alphabet_behaviour():
             "Connection failed: Please run agent app, Integration tests will fail"
         )
 
-    connection.send(json.dumps(message).encode("utf-8"))
+    connection.sendall(encode_message(message))
     connection.close()
-    time.sleep(3)  # wait until file stream gets updated
-
-    with open("app1.log", "r") as f:
-        msg = {}
-        found = 0
-        lines = f.readlines()
-        total_lines = len(lines)
-        if total_lines > 0:
-            last_10_lines = lines[-(total_lines if total_lines < 10 else 10) :]
-            for line in last_10_lines:
-                if test_word in line and "Found hello:" in line:
-                    msg = json.loads(line.split(":", 1)[1])
-                    assert test_word in msg["words"]
-                    found = 1
-                    f.close()
-                    break
-        if not found:
-            pytest.fail("Could not find logged in sent word")
+
+    event = wait_for_event(
+        "hello_found", lambda event: test_word in event["words"], since=since
+    )
+    assert event["words"] == ["hello", test_word]
 
 
 def test_crypto_behaviour():
-    with open("app1.log", "r") as f:
-        test_word = str(random.random())
-        message = {
-            "method": "Message",
-            "type": "alphabet",
-            "words": ["crypto", test_word],
+    test_word = str(random.random())
+    since = call_agent("events", {"types": ["transfer_requested"]})["next"]
+    message = {
+        "method": "Message",
+        "type": "alphabet",
+        "words": ["crypto", test_word],
+    }
+
+    connection = get_socket_connection(host, server1_port)
+    if not connection:
+        pytest.fail(
+            "Connection failed: Please run agent app, Integration tests will fail"
+        )
+    connection.sendall(encode_message(message))
+    connection.close()
+
+    wait_for_event(
+        "transfer_requested", lambda event: test_word in event["words"], since=since
+    )
+
+
+def test_frame_decoder_split_and_coalesced_messages():
+    messages = [{"method": "Message", "words": ["hello", "x" * 4096]}] + [
+        {"method": "Message", "words": [str(i)]} for i in range(100)
+    ]
+    data = encode_messages(messages)
+    decoder = FrameDecoder()
+    decoded = []
+    for i in range(0, len(data), 1000):
+        decoded.extend(json.loads(frame) for frame in decoder.feed(data[i : i + 1000]))
+    assert decoded == messages
+    assert not decoder.buffer
+
+
+def test_batch_request_replies_only_to_calls_with_id():
+    agent = Agent(queue.Queue(), queue.Queue())
+    message = {"jsonrpc": "2.0", "method": "Message", "type": "alphabet"}
+    batch = [
+        dict(message, words=["sun", "moon"]),
+        dict(message, words=["sky", "ocean"], id=7),
+        {"jsonrpc": "2.0", "method": "unknown", "id": 8},
+    ]
+    responses = agent.handle_request(json.dumps(batch))
+    assert [response.id for response in responses] == [7, 8]
+    assert responses[0].result == "Message delivered to inbox"
+    assert responses[1].error["code"] == -32601
+    assert agent.inbox_queue.qsize() == 2
+    assert agent.inbox_queue.get().words == ["sun", "moon"]
+
+
+def test_message_json_never_carries_the_call_envelope():
+    agent = Agent(queue.Queue(), queue.Queue())
+    call = {"jsonrpc": "2.0", "method": "Message", "type": "bench", "n": 1, "id": 3}
+    plain = {"method": "Message", "type": "bench", "n": 2}
+    agent.handle_request(json.dumps(call))
+    agent.handle_request(json.dumps(plain))
+    agent.handle_request(json.dumps([dict(call, n=3)]))
+    texts = [agent.inbox_queue.get().to_json() for _ in range(3)]
+    assert [json.loads(text) for text in texts] == [
+        {"method": "Message", "type": "bench", "n": n} for n in (1, 2, 3)
+    ]
+    # text holding only the message is reused as is
+    assert texts[1] == json.dumps(plain)
+
+
+def test_async_server_routes_requests_and_pushes_outbox_messages():
+    server = AsyncJsonRpcServer(port=0, external_agent_port=None)
+
+    def serve():
+        try:
+            asyncio.run(server.serve_forever())
+        except asyncio.CancelledError:
+            pass  # the server was closed
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    assert wait_until(lambda: server.server is not None and server.port)
+
+    decoder = FrameDecoder()
+    frames = []
+
+    def next_frame():
+        while not frames:
+            frames.extend(json.loads(f) for f in decoder.feed(client.recv(65536)))
+        return frames.pop(0)
+
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as client:
+        message = {"jsonrpc": "2.0", "method": "Message", "type": "alphabet"}
+        client.sendall(encode_message(dict(message, words=["sun"], id=1)))
+        assert next_frame() == {
+            "jsonrpc": "2.0",
+            "result": "Message delivered to inbox",
+            "id": 1,
         }
-        found = 0
+        assert server.inbox_queue.get(timeout=1).words == ["sun"]
+
+        batch = [
+            dict(message, words=["moon"]),
+            {"jsonrpc": "2.0", "method": "outbox_stats", "id": 2},
+            {"jsonrpc": "2.0", "method": "unknown", "id": 3},
+        ]
+        client.sendall(encode_message(batch))
+        replies = next_frame()
+        assert [reply["id"] for reply in replies] == [2, 3]
+        assert len(replies[0]["result"]["subscribers"]) == 1
+        assert replies[1]["error"]["code"] == -32601
+
+        server.outbox_queue.put(AlphabetMessage(["pushed"]))
+        pushed = next_frame()
+        assert (pushed["type"], pushed["words"]) == ("alphabet", ["pushed"])
+
+    server.broker.stop()
+    server.loop.call_soon_threadsafe(server.server.close)
+    thread.join(5)
+    assert server.broker.stats()["subscribers"] == []
+
+
+def test_binary_codec_roundtrip_and_json_fallback():
+    messages = [
+        AlphabetMessage(["hello", "crypto"]),
+        AlphabetMessage(["sun"], data={"ttl": 3}),
+        message_from_dict({"method": "Message", "type": "bench", "seq": 1}),
+        {"jsonrpc": "2.0", "result": "ok", "id": 1},
+    ]
+    decoder = FrameDecoder()
+    decoder.length_prefixed = True
+    data = BINARY.encode_many(messages)
+    frames = []
+    for i in range(0, len(data), 7):
+        frames.extend(decoder.feed(data[i : i + 7]))
+    assert [BINARY.decode_message(frame) for frame in frames[:3]] == messages[:3]
+    assert BINARY.decode(frames[3]) == messages[3]
+    assert len(frames[0]) < len(JSON.encode(messages[0]))
+
+
+def test_connection_negotiates_binary_codec():
+    agent = Agent(queue.Queue(), queue.Queue())
+    written = []
+    connection = Connection(agent, written.append)
+    link = PeerLink()
+    hello = link.hello()
+    message = encode_message(
+        {"method": "Message", "type": "alphabet", "words": ["sky"]}
+    )
+    connection.receive(message + hello)
+    connection.push([AlphabetMessage(["moon", "human"])])
+
+    # the reply to the plain call comes before the negotiation reply
+    received = link.feed(b"".join(written))
+    assert link.codec is BINARY and connection.codec is BINARY
+    assert received[0] == {"result": "Message delivered to inbox"}
+    assert received[1].words == ["moon", "human"]
+    assert agent.inbox_queue.get().words == ["sky"]
+
+
+def test_outbox_broker_fans_out_with_overflow_policies():
+    broker = OutboxBroker(queue.Queue(), capacity=2)
+    oldest = broker.subscribe("oldest", policy="drop-oldest")
+    newest = broker.subscribe("newest", policy="drop-newest")
+    for i in range(3):
+        broker.publish(i)
+    assert oldest.drain(10) == [1, 2]
+    assert newest.drain(10) == [0, 1]
+    stats = {s["name"]: s for s in broker.stats()["subscribers"]}
+    assert stats["oldest"]["dropped"] == stats["newest"]["dropped"] == 1
+    assert stats["oldest"]["lag"] == 0
+
+
+def test_scheduler_runtime_activation_and_retiming():
+    runs = {"fast": 0, "idle": 0}
+    scheduler = Scheduler()
+    scheduler.add("fast", lambda: runs.update(fast=runs["fast"] + 1), 0.05)
+    scheduler.add("idle", lambda: runs.update(idle=runs["idle"] + 1), 0.05, active=False)
+    scheduler.start()
+    time.sleep(0.3)
+    assert runs["fast"] >= 4 and runs["idle"] == 0
+
+    scheduler.deactivate("fast")
+    scheduler.set_interval("idle", 10)
+    scheduler.activate("idle")
+    fast_runs = runs["fast"]
+    time.sleep(0.3)
+    scheduler.stop()
+    assert runs["fast"] == fast_runs
+    assert runs["idle"] == 1
+
+
+def test_transfer_aggregator_sums_intents_per_window():
+    submitted = []
+    aggregator = TransferAggregator(submitted.append, window=0.2, max_size=3)
+    for i in range(4):
+        aggregator.add("0xa", "0xb", "token", 10, source=f"message {i}")
+    aggregator.add("0xa", "0xc", "token", 5, source="other recipient")
+    assert [batch.sources for batch in submitted] == [
+        ["message 0", "message 1", "message 2"]
+    ]
+    assert submitted[0].amounts == {"0xb": 30}
+
+    time.sleep(0.5)
+    assert sorted(list(batch.amounts.items()) for batch in submitted[1:]) == [
+        [("0xb", 10)],
+        [("0xc", 5)],
+    ]
+    assert aggregator.stats()["batches"] == 3
+    aggregator.stop()
+
+
+def test_nonce_manager_allocates_locally_and_recovers():
+    chain = {"nonce": 5, "fetches": 0}
+
+    def fetch_nonce(address):
+        chain["fetches"] += 1
+        return chain["nonce"]
+
+    nonces = NonceManager(fetch_nonce)
+    assert [nonces.allocate("0xa") for _ in range(3)] == [5, 6, 7]
+    assert chain["fetches"] == 1
+
+    nonces.release("0xa", 6)  # never broadcast, handed out again
+    assert nonces.allocate("0xa") == 6
+
+    chain["nonce"] = 9  # another wallet sent from the same account
+    assert nonces.handle_error("0xa", 8, Exception("nonce too low"))
+    assert nonces.allocate("0xa") == 9
+
+
+def test_failed_transfer_leaves_no_nonce_gap():
+    chain = {"nonce": 3}
+    nonces = NonceManager(lambda address: chain["nonce"])
+    assert [nonces.allocate("0xa") for _ in range(3)] == [3, 4, 5]
+    chain["nonce"] = 4  # 3 was mined, 4 dropped from the mempool, 5 pending
+
+    tx = PendingTransaction("0x01", "0xa", 4)
+    tx.future.set_exception(TimeoutError("receipt not found"))
+    w3 = types.SimpleNamespace(nonce_manager=nonces)
+    W3.on_transfer_complete(w3, tx, "0xtoken", {"0xb": 1})
+
+    assert nonces.account("0xa").in_flight == {5}
+    assert [nonces.allocate("0xa") for _ in range(2)] == [4, 6]
+
+
+def test_balance_cache_invalidates_on_new_head_and_applies_own_transfers():
+    cache = BalanceCache()
+    cache.put("token", "0xa", 10, 5.0)
+    cache.put("token", "0xb", 10, 1.0)
+    assert cache.get("token", "0xa", 10) == 5.0
+
+    cache.apply_transfer("token", "0xa", "0xb", 1.0, 11)
+    assert cache.get("token", "0xa", 11) == 4.0
+    assert cache.get("token", "0xb", 11) == 2.0
+
+    cache.new_head(12)
+    assert cache.get("token", "0xa", 12) is None
+
+
+def test_provider_pool_prefers_fast_endpoint_and_skips_failing_one():
+    slow = StubRpcServer({"eth_blockNumber": "0x1"}, delay=0.2)
+    fast = StubRpcServer({"eth_blockNumber": "0x2"})
+    failing = StubRpcServer()
+    failing.failing = True
+    with slow, fast, failing:
+        provider = PooledHTTPProvider(
+            [failing.url, slow.url, fast.url], hedge_after=0.05
+        )
+        for _ in range(10):
+            response = provider.make_request("eth_blockNumber", [])
+            assert response["result"] in ("0x1", "0x2")
+        assert fast.calls["eth_blockNumber"] >= 8
+        assert not provider.stats()["endpoints"][0]["healthy"]
+        provider.stop()
+
+
+def test_provider_pool_keeps_writes_on_one_endpoint():
+    first = StubRpcServer({"eth_getTransactionCount": "0x7"})
+    second = StubRpcServer({"eth_getTransactionCount": "0x7"})
+    with first, second:
+        provider = PooledHTTPProvider([first.url, second.url])
+        for _ in range(5):
+            provider.make_request("eth_getTransactionCount", ["0x0", "pending"])
+        counts = (
+            first.calls["eth_getTransactionCount"],
+            second.calls["eth_getTransactionCount"],
+        )
+        assert sorted(counts) == [0, 5]
+        provider.stop()
+
+
+def test_metrics_registry_snapshot_and_prometheus_dump():
+    registry = MetricsRegistry()
+    depth = queue.Queue()
+    depth.put(1)
+    registry.gauge("inbox_queue_depth", depth.qsize)
+    registry.counter("rpc_calls_total", method="eth_call").inc(3)
+    for latency in (0.001, 0.002, 0.2):
+        registry.histogram("handler_latency_seconds", type="alphabet").observe(latency)
+
+    snapshot = registry.snapshot()
+    assert snapshot["inbox_queue_depth"]["value"] == 1
+    assert snapshot["rpc_calls_total"]["method=eth_call"] == 3
+    assert snapshot["handler_latency_seconds"]["type=alphabet"]["count"] == 3
+
+    text = registry.prometheus()
+    assert 'rpc_calls_total{method="eth_call"} 3' in text
+    assert 'handler_latency_seconds_bucket{type="alphabet",le="+Inf"} 3' in text
+
+
+def test_journal_queue_replays_unacknowledged_messages(tmp_path):
+    journal = JournalQueue(str(tmp_path), "inbox", segment_size=256)
+    for i in range(10):
+        journal.put({"type": "alphabet", "n": i})
+    for _ in range(4):
+        journal.get()
+        journal.task_done()
+    journal.close()
+
+    journal = JournalQueue(str(tmp_path), "inbox", segment_size=256)
+    assert journal.qsize() == 6
+    assert journal.get()["n"] == 4
+    journal.task_done()
+    journal.put({"type": "alphabet", "n": 10})
+    journal.close()
+
+    journal = JournalQueue(str(tmp_path), "inbox", segment_size=256)
+    assert [journal.get_nowait()["n"] for _ in range(journal.qsize())] == list(
+        range(5, 11)
+    )
+    journal.close()
+
+
+def test_journal_queue_replays_messages_the_handlers_can_dispatch(tmp_path):
+    journal = JournalQueue(str(tmp_path), "inbox")
+    journal.put(Message("other", {"n": 1}))
+    journal.put(AlphabetMessage(["hello"], data={"lang": "en"}))
+    journal.put(AlphabetMessage(["sun"]))
+    journal.close()
+
+    journal = JournalQueue(str(tmp_path), "inbox")
+    handlers = Agent(journal, queue.Queue()).handlers
+    others = []
+    handlers.register("other", others.append)
+    replayed = [journal.get_nowait() for _ in range(journal.qsize())]
+    assert replayed == [
+        Message("other", {"n": 1}),
+        AlphabetMessage(["hello"], data={"lang": "en"}),
+        AlphabetMessage(["sun"]),
+    ]
+    assert all(isinstance(m, Message) for m in replayed)
+    assert replayed[1].words == ["hello"]
+    for message in replayed:
+        handlers.dispatch(message)
+    handlers.dispatch({"type": "other"})
+    assert others == [Message("other", {"n": 1})]
+    journal.close()
+
+
+def test_journal_queue_checkpoint_moves_past_rejected_puts(tmp_path):
+    journal = JournalQueue(str(tmp_path), "inbox", maxsize=2)
+    journal.put({"type": "alphabet", "n": 0})
+    journal.put({"type": "alphabet", "n": 1})
+    with pytest.raises(queue.Full):
+        journal.put({"type": "alphabet", "n": 2}, timeout=0.01)
+    for i in range(3, 8):
+        journal.get()
+        journal.task_done()
+        journal.put({"type": "alphabet", "n": i})
+    assert journal.acked == 6 and journal.next_seq == 9
+    journal.close()
+
+    journal = JournalQueue(str(tmp_path), "inbox", maxsize=2)
+    assert [journal.get_nowait()["n"] for _ in range(journal.qsize())] == [6, 7]
+    journal.close()
+
+
+def test_journaled_transfer_is_acknowledged_once_submitted(tmp_path):
+    journal = JournalQueue(str(tmp_path), "inbox")
+    w3 = Agent(queue.Queue(), queue.Queue()).w3
+    handlers = Handlers(w3, journal, transfer_window=60)
+    batches = []
+    handlers.transfer_aggregator.submit = batches.append
+
+    journal.put(AlphabetMessage(["crypto"]))
+    journal.put(AlphabetMessage(["sun"]))
+    for _ in range(2):
+        handlers.dispatch(journal.get())
+        journal.task_done()
+    # the transfer waits for its window, nothing may be acknowledged
+    assert journal.acked == 0
+
+    handlers.transfer_aggregator.stop()
+    [batch] = batches
+    assert journal.acked == 0
+    batch.sent("0x" + "ab" * 32, None)
+    assert journal.acked == 2
+
+    # released before task_done, the item is acknowledged by task_done
+    journal.put(AlphabetMessage(["moon"]))
+    journal.get()
+    journal.hold()()
+    assert journal.acked == 2
+    journal.task_done()
+    assert journal.acked == 3
+    journal.close()
+
+
+class FakeLink:
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.ready = True
+        self.sent = []
+
+    def send(self, fields):
+        self.sent.append(fields)
+
+
+def test_router_forwards_on_shortest_path_with_split_horizon():
+    delivered = []
+    router = Router(delivered.append, agent_id="a", topics=["news"])
+    router.clients = {peer: FakeLink(peer) for peer in ("b", "c")}
+    router.update("b", {"routes": {"b": [0, []], "d": [1, ["news"]]}})
+    router.update("c", {"routes": {"c": [0, []], "d": [3, []], "e": [0, []]}})
+
+    assert router.routes["d"] == (2, "b", ["news"])
+    # routes learned from b are not announced back to it
+    assert set(router.announcement("b")["routes"]) == {"a", "c", "e"}
+
+    message = AlphabetMessage(["hello"], data={"topic": "news", "to": ["e", "x"]})
+    result = router.route(message)
+    assert result == {
+        "delivered": True,
+        "forwarded": {"b": ["d"], "c": ["e"]},
+        "unreachable": ["x"],
+    }
+    assert delivered == [message]
+    [forwarded] = router.clients["b"].sent
+    assert forwarded["to"] == ["d"] and forwarded["ttl"] == 15
+    assert "topic" not in forwarded and forwarded["from"] == "a"
+
+    # c dropped without the routes being recomputed yet
+    router.clients["c"].ready = False
+    assert router.route(AlphabetMessage(["hi"], data={"to": ["e"]})) == {
+        "delivered": False,
+        "forwarded": {},
+        "unreachable": ["e"],
+    }
+    router.clients["c"].ready = True
+
+    router.link_down(router.clients["b"])
+    assert not router.clients["b"].ready
+    assert router.routes["d"] == (4, "c", [])
+
+
+class CountingQueue(queue.Queue):
+    """Inbox counting the gets of the workers"""
+
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    def get(self, block=True, timeout=None):
+        self.gets += 1
+        return super().get(block, timeout)
 
-        connection = get_socket_connection(host, server1_port)
-        if not connection:
-            pytest.fail(
-                "Connection failed: Please run agent app, Integration tests will fail"
+
+def start_handlers(inbox_queue, **options):
+    w3 = Agent(queue.Queue(), queue.Queue()).w3
+    handlers = Handlers(w3, inbox_queue, poll_timeout=0.2, **options)
+    handlers.start()
+    return handlers
+
+
+def test_inbox_workers_block_instead_of_spinning():
+    inbox_queue = CountingQueue()
+    handlers = start_handlers(inbox_queue, workers=2)
+    time.sleep(1)
+    handlers.stop()
+    # one get per poll_timeout and worker, a busy loop makes thousands
+    assert inbox_queue.gets <= 2 * (1 / 0.2 + 2)
+
+
+def test_inbox_workers_route_by_type_and_lanes_do_not_block_handlers():
+    inbox_queue = queue.Queue()
+    handlers = start_handlers(inbox_queue, workers=2, lanes={"chain": 1})
+    seen = []
+    release = threading.Event()
+
+    def chain_task():
+        seen.append(("chain", threading.current_thread().name))
+        release.wait(5)
+
+    def slow(message):
+        handlers.submit("chain", chain_task)
+        seen.append(("slow", threading.current_thread().name))
+
+    handlers.register("slow", slow)
+    handlers.register("fast", lambda m: seen.append(("fast", m.data["n"])))
+    hellos = EVENTS.subscribe([HELLO_FOUND])
+    try:
+        inbox_queue.put(Message("slow"))
+        inbox_queue.put(Message("fast", {"n": 1}))
+        inbox_queue.put(AlphabetMessage(["hello"]))
+        # the chain lane is busy until release, hello is handled meanwhile
+        assert hellos.wait_for(HELLO_FOUND, timeout=2) is not None
+        assert not release.is_set()
+        assert wait_until(lambda: len(seen) == 3)
+        threads = dict(seen)
+        assert threads["fast"] == 1
+        assert threads["slow"].startswith("inbox-worker-")
+        assert threads["chain"] == "chain-worker-0"
+    finally:
+        release.set()
+        EVENTS.unsubscribe(hellos)
+        handlers.stop()
+
+
+def test_inbox_worker_survives_a_failing_handler():
+    inbox_queue = queue.Queue()
+    handlers = start_handlers(inbox_queue, workers=1)
+    handled = []
+
+    def fail(message):
+        raise RuntimeError("broken handler")
+
+    handlers.register("broken", fail)
+    handlers.register("ok", handled.append)
+    try:
+        inbox_queue.put(Message("broken"))
+        inbox_queue.put(Message("ok"))
+        assert wait_until(lambda: handled == [Message("ok")])
+        assert all(t.is_alive() for t in handlers.threads)
+    finally:
+        handlers.stop()
+
+
+def test_process_lane_returns_results_of_cpu_bound_handlers():
+    lane = ProcessLane(processes=1)
+    results = []
+    futures = [
+        lane.submit(
+            operator.attrgetter("words"),
+            AlphabetMessage(["hello", str(i)]),
+            on_result=lambda message, words: results.append(words),
+        )
+        for i in range(3)
+    ]
+    assert [future.result(timeout=30) for future in futures] == [
+        ["hello", "0"],
+        ["hello", "1"],
+        ["hello", "2"],
+    ]
+    assert len(results) == 3
+    lane.stop()
+
+
+def test_signer_process_signs_like_the_local_account():
+    account = Account.create()
+    token = "0x" + "22" * 20
+    fields = {
+        "from": account.address,
+        "gas": 200000,
+        "gasPrice": 50 * 10**9,
+        "nonce": 7,
+        "chainId": 1,
+    }
+    amounts = {"0x" + "33" * 20: 10**18}
+    signer = SignerPool([account.key], processes=1)
+    signer.start()
+    raw = signer.sign_transfer(token, amounts, None, fields)
+    signer.stop()
+
+    local = account.sign_transaction(build_transfer(token, amounts, None, fields))
+    assert raw == bytes(local.raw_transaction)
+    assert Account.recover_transaction(raw) == account.address
+    with pytest.raises(ValueError):
+        build_transfer(token, dict(amounts, **{"0x" + "44" * 20: 1}), None, fields)
+
+
+def test_agent_starts_without_importing_web3():
+    code = (
+        "import sys, app; "
+        "print([m for m in ('web3', 'eth_abi', 'eth_account') if m in sys.modules])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_event_bus_subscriptions_and_history():
+    bus = EventBus(history=3)
+    subscription = bus.subscribe(["hello_found"], maxsize=2)
+    for i in range(4):
+        bus.publish("hello_found", words=["hello", str(i)])
+    bus.publish("balance_updated", balance=1.5)
+
+    # the subscriber fell behind and kept the newest events
+    assert subscription.dropped == 2
+    assert subscription.get(timeout=1).data["words"] == ["hello", "2"]
+    assert subscription.wait_for("hello_found", timeout=1).seq == 4
+    assert subscription.wait_for("hello_found", timeout=0.1) is None
+
+    assert [event.seq for event in bus.since(0)] == [3, 4, 5]
+    assert bus.since(3, types=["balance_updated"])[0].to_dict()["balance"] == 1.5
+    bus.unsubscribe(subscription)
+    bus.publish("hello_found", words=[])
+    assert subscription.queue.empty()
+
+
+def test_queue_logging_formats_json_lines_lazily():
+    log_queue = queue.Queue(1)
+    logger = logging.getLogger("App.Test")
+    handler = LazyQueueHandler(log_queue)
+    logger.addHandler(handler)
+    try:
+        message = AlphabetMessage(["hello", "sun"])
+        logger.warning("Found hello: %s", message, extra={"source": "test"})
+        logger.warning("dropped, the queue is full")
+    finally:
+        logger.removeHandler(handler)
+
+    record = log_queue.get_nowait()
+    assert log_queue.empty() and record.args == (message,)
+    line = json.loads(JsonLinesFormatter().format(record))
+    assert line["message"] == "Found hello: " + message.to_json()
+    assert line["source"] == "test" and line["logger"] == "App.Test"
+
+
+def test_admission_control_sheds_load_but_not_control_methods():
+    agent = Agent(queue.Queue(maxsize=4), queue.Queue())
+    agent.admission = AdmissionControl(
+        agent.inbox_queue,
+        client_rate=1000,
+        method_limits={"metrics_probe": (1, 1), "list_rules": (1, 1)},
+        methods=agent.rpc_methods,
+    )
+    agent.register_method("metrics_probe", lambda: {"result": "ok"})
+    client = TokenBucket(0.01, burst=6)
+
+    def call(method, **fields):
+        request = {"jsonrpc": "2.0", "method": method, "id": 1, **fields}
+        return agent.handle_request(json.dumps(request), client).to_dict()
+
+    responses = [call("Message", type="alphabet", words=["sun"]) for _ in range(6)]
+    assert [r.get("result") for r in responses[:4]] == [
+        "Message delivered to inbox"
+    ] * 4
+    # shed at 90% of the inbox before the queue itself rejects
+    assert responses[4]["error"]["code"] == -32005
+    assert responses[4]["error"]["data"]["retry_after"] > 0
+
+    assert call("register_behaviour", params=["words_generator"])["result"]
+    assert call("metrics_probe")["result"] == "ok"
+    limited = call("metrics_probe")["error"]
+    assert limited["message"] == "Method rate limit exceeded"
+    assert 0 < limited["data"]["retry_after"] <= 1
+
+    # the connection bucket is empty after 6 calls, control calls still pass
+    while not agent.inbox_queue.empty():
+        agent.inbox_queue.get_nowait()
+    assert call("Message", type="alphabet", words=["sun"])["error"]["message"] == (
+        "Client rate limit exceeded"
+    )
+    assert "result" in call("metrics")
+    # a configured method limit applies to control methods too
+    assert "result" in call("list_rules")
+    assert call("list_rules")["error"]["message"] == "Method rate limit exceeded"
+
+    # unknown methods share one label in the metrics
+    assert call("made_up_method")["error"]["message"] == "Client rate limit exceeded"
+    text = REGISTRY.prometheus()
+    assert 'rejected_calls_total{method="other",reason="client"}' in text
+    assert "made_up_method" not in text
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_webhooks_batch_retry_and_dead_letter():
+    statuses = {"/flaky": [503, 503], "/gone": [410]}
+    with StubWebhookServer(statuses=statuses) as hook:
+        dispatcher = WebhookDispatcher(concurrency=2, attempts=3, backoff=0.01)
+        dispatcher.register("alphabet", hook.url + "/batch", batch=True)
+        dispatcher.register("alphabet", hook.url + "/flaky")
+        dispatcher.register("other", hook.url + "/gone")
+        messages = [AlphabetMessage(["sun", str(i)]) for i in range(50)]
+        for message in messages:
+            assert dispatcher.dispatch(message)
+        dispatcher.dispatch(Message("other", {"n": 1}))
+        assert not dispatcher.dispatch(Message("unrouted"))
+
+        assert wait_until(lambda: hook.count("/batch") == 50)
+        assert wait_until(lambda: hook.count("/flaky") == 50)
+        assert wait_until(lambda: len(dispatcher.dead_letters) == 1)
+        stats = dispatcher.stats()["endpoints"]
+        dispatcher.stop()
+
+    assert sorted(m["words"][1] for m in hook.received["/batch"]) == sorted(
+        str(i) for i in range(50)
+    )
+    assert hook.requests["/batch"] < 50
+    assert stats[hook.url + "/flaky"]["retries"] == 2
+    [dead] = dispatcher.dead_letters
+    assert dead["error"] == "HTTP 410" and dead["attempts"] == 1
+    assert [(m["type"], m["n"]) for m in dead["messages"]] == [("other", 1)]
+
+
+def test_dispatch_survives_a_failing_webhook_dispatcher():
+    handlers = Agent(queue.Queue(), queue.Queue()).handlers
+    handled = []
+    handlers.register("probe", handled.append)
+
+    def broken(message):
+        raise RuntimeError("dispatcher closed")
+
+    handlers.webhooks.dispatch = broken
+    message = Message("probe")
+    handlers.dispatch(message)
+    handlers.dispatch(Message("unrouted"))
+    assert handled == [message]
+
+
+def test_rule_engine_matches_and_swaps_rules_while_matching():
+    agent = Agent(queue.Queue(), queue.Queue())
+    engine = agent.handlers.rule_engine
+
+    def call(method, params):
+        request = {"jsonrpc": "2.0", "method": method, "params": params, "id": 1}
+        return agent.handle_request(json.dumps(request)).to_dict()
+
+    rules = [
+        {"kind": "prefix", "pattern": "moon", "action": "log", "id": "moon"},
+        {"kind": "contains", "pattern": "uni", "action": "log", "id": "uni"},
+        {"kind": "field", "field": "lang", "pattern": "en", "action": "log"},
+    ]
+    assert call("add_rules", [rules])["result"] == ["moon", "uni", "rule-1"]
+    invalid = call("add_rule", {"kind": "regex", "pattern": "x", "action": "log"})
+    assert invalid["error"]["code"] == -32602
+    assert len(call("list_rules", [])["result"]) == 5
+
+    message = AlphabetMessage(["hello", "moonlight", "community"], data={"lang": "en"})
+    assert [rule.id for rule in engine.match(message)] == [
+        "hello",
+        "moon",
+        "uni",
+        "rule-1",
+    ]
+    assert [r.id for r in engine.match(AlphabetMessage(["mo", "un", "i"]))] == []
+
+    # workers keep matching against the old index while a new one is built
+    stop = threading.Event()
+    seen = []
+
+    def match():
+        while not stop.is_set():
+            seen.append([rule.id for rule in engine.match(message)][:2])
+
+    thread = threading.Thread(target=match)
+    thread.start()
+    engine.add(
+        {"kind": "contains", "pattern": f"w{i}x", "action": "log"} for i in range(2000)
+    )
+    assert call("remove_rule", ["moon"])["result"] == "Rule removed"
+    stop.set()
+    thread.join()
+    assert seen and all(ids in (["hello", "moon"], ["hello", "uni"]) for ids in seen)
+    assert [r.id for r in engine.match(AlphabetMessage(["aw1999xb"]))] == ["rule-2001"]
+
+
+def test_forward_rules_open_endpoints_only_once_added():
+    with StubWebhookServer() as hook:
+        agent = Agent(queue.Queue(), queue.Queue())
+        webhooks = agent.handlers.webhooks
+        webhooks.register("alphabet", hook.url + "/batch", batch=True)
+
+        def forward(path, batch=False):
+            params = {"url": hook.url + path, "batch": batch}
+            return {
+                "kind": "word",
+                "pattern": "sun",
+                "action": "forward",
+                "params": params,
+            }
+
+        invalid = {"kind": "word", "pattern": "moon", "action": "nope"}
+        with pytest.raises(ValueError):
+            agent.handlers.add_rules([forward("/new"), invalid])
+        assert hook.url + "/new" not in webhooks.endpoints
+
+        agent.handlers.add_rules([forward("/batch"), forward("/new", batch=True)])
+        assert webhooks.endpoints[hook.url + "/batch"].batch
+        assert webhooks.endpoints[hook.url + "/new"].batch
+        agent.handlers.stop()
+
+
+def test_receipt_tracker_polls_in_batches_and_backs_off():
+    receipts = {}
+    with StubRpcServer(
+        {"eth_getTransactionReceipt": lambda params: receipts.get(params[0])}
+    ) as node:
+        provider = PooledHTTPProvider([node.url])
+        batches = []
+
+        def make_batch_request(requests):
+            batches.append(len(requests))
+            return provider.make_batch_request(requests)
+
+        tracker = ReceiptTracker(
+            make_batch_request,
+            batch_size=2,
+            min_interval=0.02,
+            max_interval=0.16,
+            timeout=1,
+        )
+        completed = []
+        futures = {
+            txn_hash: tracker.track(
+                txn_hash, on_complete=lambda tx: completed.append(tx.txn_hash)
             )
-        connection.sendall(json.dumps(message).encode("utf-8"))
-        connection.close()
-        time.sleep(3)  # wait until file stream gets updated
-
-        lines = f.readlines()
-        total_lines = len(lines)
-
-        if total_lines > 0:
-            last_10_lines = lines[-(total_lines if total_lines < 10 else 10) :]
-            for line in last_10_lines:
-                if test_word in line and "Found crypto initiating transfer:" in line:
-                    found = 1
-                    f.close()
-                    break
-        if not found:
-            pytest.fail("Could not find logged in sent word")
+            for txn_hash in ("0x1", "0x2", "0x3")
+        }
+        # nothing mined, the interval doubles up to max_interval
+        assert wait_until(lambda: tracker.interval == 0.16)
+        assert batches[:2] == [2, 1]
+        futures["0x4"] = tracker.track(
+            "0x4", on_complete=lambda tx: completed.append(tx.txn_hash)
+        )
+        assert tracker.interval == 0.02
+        assert tracker.stats()["pending"] == 4
+
+        receipts.update(
+            {
+                "0x1": {"status": "0x1", "blockNumber": "0x5"},
+                "0x2": {"status": "0x0", "blockNumber": "0x5"},
+                "0x4": {"status": "0x1", "blockNumber": "0x6"},
+            }
+        )
+        assert futures["0x1"].result(2)["blockNumber"] == "0x5"
+        assert futures["0x2"].result(2)["status"] == "0x0"
+        assert futures["0x4"].result(2)
+        with pytest.raises(TimeoutError):
+            futures["0x3"].result(3)
+        assert wait_until(lambda: len(completed) == 4)
+        assert sorted(completed) == ["0x1", "0x2", "0x3", "0x4"]
+
+        stats = tracker.stats()
+        assert (stats["pending"], stats["confirmed"], stats["failed"]) == (0, 2, 1)
+        assert stats["timed_out"] == 1
+        assert 0 < stats["latency"]["p50"] <= stats["latency"]["max"] < 1
+        tracker.stop()
+        provider.stop()
+
+
+class StubChain:
+    """Blocks and Transfer logs served by a stub node, fork replaces a tail"""
+
+    def __init__(self, token, blocks, max_range):
+        self.token = token
+        self.max_range = max_range
+        self.hashes = {}
+        self.logs = {}
+        self.fork(0, blocks, "a")
+
+    def fork(self, start, end, tag):
+        accounts = ["0x" + f"{i:040x}" for i in range(1, 6)]
+        for number in range(start, end):
+            self.hashes[number] = "0x" + tag * 2 + f"{number:062x}"
+            self.logs[number] = [
+                {
+                    "address": self.token,
+                    "topics": [
+                        TRANSFER_TOPIC,
+                        "0x" + encode_address(accounts[(number + i) % 5]),
+                        "0x" + encode_address(accounts[(number * 3 + i) % 5]),
+                    ],
+                    "data": hex(number * 10 + i),
+                    "blockNumber": hex(number),
+                    "blockHash": self.hashes[number],
+                    "logIndex": hex(i),
+                    "transactionHash": "0x" + tag + f"{number:063x}",
+                }
+                for i in range(number % 3)
+            ]
+
+    def methods(self):
+        return {
+            "eth_blockNumber": lambda params: hex(len(self.hashes) - 1),
+            "eth_getBlockByNumber": lambda params: self.block(int(params[0], 16)),
+            "eth_getLogs": self.get_logs,
+        }
+
+    def block(self, number):
+        if number in self.hashes:
+            return {"number": hex(number), "hash": self.hashes[number]}
+
+    def get_logs(self, params):
+        start, end = int(params[0]["fromBlock"], 16), int(params[0]["toBlock"], 16)
+        if end - start + 1 > self.max_range:
+            raise ValueError("block range too large")
+        return [log for n in range(start, end + 1) for log in self.logs[n]]
+
+    def balances(self):
+        balances = collections.Counter()
+        for logs in self.logs.values():
+            for log in logs:
+                from_address, to_address, value = decode_transfer_log(log)
+                balances[from_address] -= value
+                balances[to_address] += value
+        return balances
+
+
+def test_transfer_indexer_adapts_ranges_and_rolls_back_reorgs(tmp_path):
+    token = "0x" + "ab" * 20
+    chain = StubChain(token, 300, max_range=40)
+    with StubRpcServer(chain.methods()) as node:
+        provider = PooledHTTPProvider([node.url])
+        indexer = TransferIndexer(
+            provider.make_batch_request,
+            token,
+            str(tmp_path / "index.db"),
+            max_range=500,
+        )
+        assert indexer.poll() == 299
+        assert indexer.range <= 40
+        # rejected ranges are halved once, not retried at sizes that failed
+        assert node.calls["eth_getLogs"] <= 300 // 20 + 5
+        for address, balance in chain.balances().items():
+            assert indexer.balance_of(address) == balance
+
+        address = "0x" + f"{2:040x}"
+        history = indexer.balance_history(address, limit=1000)
+        assert history[-1]["balance"] == indexer.balance_of(address)
+        assert (
+            indexer.balance_of(address, 150)
+            == [entry["balance"] for entry in history if entry["block"] <= 150][-1]
+        )
+        transfers = indexer.transfers(address, from_block=100, to_block=120)
+        assert transfers and all(
+            address in (t["from"], t["to"]) and 100 <= t["block"] <= 120
+            for t in transfers
+        )
+
+        # the last 10 blocks are replaced and the chain grows by 5
+        chain.fork(290, 305, "b")
+        assert indexer.poll() == 304
+        assert indexer.reorgs == 1
+        for address, balance in chain.balances().items():
+            assert indexer.balance_of(address) == balance
+        assert indexer.transfers(from_block=290)[0]["txn_hash"].startswith("0xb")
+        provider.stop()
+
+
+def balance_node(tokens, multicall):
+    """Stub node answering balanceOf, decimals and Multicall3 aggregate3"""
+    reads = collections.Counter()
+
+    def call(to, data):
+        if data == "0x313ce567":
+            reads["decimals"] += 1
+            return "0x" + format(tokens[to], "064x")
+        index = int(data[-40:], 16)
+        if to == list(tokens)[1] and index == 7:
+            return "0x"  # reverted balanceOf
+        scale = list(tokens).index(to) + 1
+        return "0x" + format(index * scale * 10 ** tokens[to], "064x")
+
+    def eth_call(params):
+        to, data = params[0]["to"], params[0]["data"]
+        if to != multicall:
+            return call(to, data)
+        reads["aggregate3"] += 1
+        (calls,) = abi_decode(["(address,bool,bytes)[]"], bytes.fromhex(data[10:]))
+        results = []
+        for target, _, calldata in calls:
+            returned = call(target.lower(), "0x" + calldata.hex())
+            results.append((returned != "0x", bytes.fromhex(returned[2:])))
+        return "0x" + abi_encode(["(bool,bytes)[]"], [results]).hex()
+
+    return StubRpcServer({"eth_call": eth_call}), reads
+
+
+def test_get_balances_batches_calls_in_order_and_caches_decimals(monkeypatch):
+    tokens = {"0x" + "aa" * 20: 6, "0x" + "bb" * 20: 18}
+    multicall = "0x" + "cc" * 20
+    node, reads = balance_node(tokens, multicall)
+    with node:
+        for name, value in {
+            "RPC_URL": node.url,
+            "RPC_URLS": "",
+            "CHAIN_ID": "1",
+            "CONTRACT_ADDRESS": list(tokens)[0],
+            "INDEXER_DB": "",
+            "MULTICALL_ADDRESS": "",
+        }.items():
+            monkeypatch.setenv(name, value)
+        w3 = W3()
+        batches = []
+        make_batch_request = w3.make_batch_request
+
+        def record(requests):
+            batches.append(len(requests))
+            return make_batch_request(requests)
+
+        w3.make_batch_request = record
+
+        def expected(addresses):
+            return [
+                [None if (i == 7 and j == 1) else i * (j + 1) for j in range(2)]
+                for i in addresses
+            ]
+
+        addresses = range(1, 151)
+        balances = w3.get_balances(["0x%040x" % i for i in addresses], list(tokens))
+        assert balances == expected(addresses)
+        # decimals of both tokens in one batch, 300 balanceOf calls in three
+        assert batches == [2, 100, 100, 100]
+        assert reads["decimals"] == 2
+
+        w3.multicall_address = multicall
+        batches.clear()
+        addresses = range(201, 501)
+        balances = w3.get_balances(["0x%040x" % i for i in addresses], list(tokens))
+        assert balances == expected(addresses)
+        # 600 calls aggregated 500 at a time, decimals were not read again
+        assert batches == [2] and reads["aggregate3"] == 2
+        assert reads["decimals"] == 2
+        assert w3.get_balances(["0x%040x" % 7], list(tokens)) == [[7, None]]
+        w3.head_tracker.stop()
+        w3.receipt_tracker.stop()
+        w3.chain_params.stop()
+        w3.w3.provider.stop()
+
+
+def test_transfers_are_built_from_cached_chain_params(monkeypatch):
+    account = Account.create()
+    fee_history = {"baseFeePerGas": ["0x0", hex(2 * 10**9)], "reward": [["0x5f5e100"]]}
+    sent = []
+    estimated = []
+    node = StubRpcServer(
+        {
+            "eth_feeHistory": lambda params: fee_history,
+            "eth_gasPrice": "0x1",
+            "eth_call": lambda params: "0x"
+            + format(18 if params[0]["data"] == "0x313ce567" else 10**24, "064x"),
+            "eth_estimateGas": lambda params: estimated.append(params[0]) or hex(60000),
+            "eth_getTransactionCount": "0x0",
+            "eth_sendRawTransaction": lambda params: sent.append(params[0])
+            or "0x" + "ab" * 32,
+            "eth_getTransactionReceipt": None,
+        }
+    )
+    with node:
+        for name, value in {
+            "RPC_URL": node.url,
+            "RPC_URLS": "",
+            "CHAIN_ID": "1",
+            "CONTRACT_ADDRESS": "0x" + "22" * 20,
+            "FROM_ADDRESS": account.address,
+            "PRIVATE_KEY": account.key.hex(),
+            "SIGNER_PROCESSES": "0",
+            "INDEXER_DB": "",
+            "FEE_REFRESH_INTERVAL": "3600",
+            "FEE_MAX_AGE": "0.5",
+        }.items():
+            monkeypatch.setenv(name, value)
+        w3 = W3()
+        to_address = "0x" + "11" * 20
+
+        def send():
+            node.calls.clear()
+            w3.transfer(account.address, to_address, 5)
+            return TypedTransaction.from_bytes(HexBytes(sent[-1])).as_dict()
+
+        send()
+        # the background refresh reads the estimate queued by the first send
+        w3.chain_params.refresh()
+        transaction = send()
+        assert set(node.calls) == {"eth_sendRawTransaction"}
+        # the stub rejects estimates with integer quantities like geth does
+        assert [call["value"] for call in estimated] == ["0x0"]
+        assert transaction["gas"] == 60000 + COLD_RECIPIENT_GAS
+        assert transaction["maxFeePerGas"] == 2 * 2 * 10**9 + 0x5F5E100
+        assert transaction["data"] == HexBytes(encode_transfer(to_address, 5))
+
+        # fees older than FEE_MAX_AGE are read again before sending
+        fee_history["baseFeePerGas"][-1] = hex(3 * 10**9)
+        time.sleep(0.6)
+        transaction = send()
+        assert node.calls["eth_feeHistory"] == 1
+        assert transaction["maxFeePerGas"] == 2 * 3 * 10**9 + 0x5F5E100
+        w3.receipt_tracker.stop()
+        w3.chain_params.stop()
+        w3.w3.provider.stop()
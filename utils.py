@@ -1,9 +1,9 @@
 import socket
 
-def is_port_active(host, port):
+def is_port_active(host, port, timeout=5):
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(5)
+            s.settimeout(timeout)
             s.connect((host, port))            
         return True
     except ConnectionRefusedError:
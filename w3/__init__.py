@@ -1,3 +1,28 @@
 from .w3 import W3
+from .aggregator import TransferAggregator, TransferBatch
+from .balance_cache import BalanceCache
+from .calls import is_address
+from .errors import is_web3_error
+from .indexer import TransferIndexer
+from .nonce import NonceManager
 
-__all__ = ["W3"]
\ No newline at end of file
+__all__ = [
+    "W3",
+    "BalanceCache",
+    "NonceManager",
+    "PooledHTTPProvider",
+    "TransferAggregator",
+    "TransferBatch",
+    "TransferIndexer",
+    "is_address",
+    "is_web3_error",
+]
+
+
+def __getattr__(name):
+    # the provider subclasses a web3 class, web3 is only imported on use
+    if name == "PooledHTTPProvider":
+        from .provider_pool import PooledHTTPProvider
+
+        return PooledHTTPProvider
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
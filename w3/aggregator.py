@@ -0,0 +1,187 @@
+import collections
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("App.Aggregator")
+
+
+class TransferBatch:
+    """
+    Transfer intents of one window, amounts are summed per recipient.
+    sources holds whatever each intent was created for, the alphabet
+    message for transfers of the crypto handler. on_submitted callbacks
+    of the intents run once the transaction was sent or failed to be
+    """
+
+    def __init__(self, from_address, token, deadline):
+        self.from_address = from_address
+        self.token = token
+        self.deadline = deadline
+        self.amounts = {}
+        self.sources = []
+        self.on_submitted = []
+        self.txn_hash = None
+        self.future = None
+        self.error = None
+
+    def add(self, to_address, amount, source=None, on_submitted=None):
+        self.amounts[to_address] = self.amounts.get(to_address, 0) + amount
+        self.sources.append(source)
+        if on_submitted is not None:
+            self.on_submitted.append(on_submitted)
+
+    def sent(self, txn_hash, future):
+        """Hash and receipt future of the transaction covering the batch"""
+        self.txn_hash = txn_hash
+        self.future = future
+        self.submitted()
+
+    def failed(self, error):
+        self.error = error
+        self.submitted()
+
+    def submitted(self):
+        callbacks, self.on_submitted = self.on_submitted, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Exception in transfer submitted callback" + str(e))
+
+    @property
+    def status(self):
+        if self.error:
+            return "failed"
+        if self.future is None:
+            return "submitting"
+        if not self.future.done():
+            return "pending"
+        if self.future.exception():
+            return "failed"
+        return "confirmed" if int(self.future.result()["status"], 16) else "reverted"
+
+    def to_dict(self):
+        return {
+            "txn_hash": self.txn_hash,
+            "status": self.status,
+            "error": self.error,
+            "from": self.from_address,
+            "token": self.token,
+            "amounts": dict(self.amounts),
+            "messages": [str(source) for source in self.sources],
+        }
+
+
+class TransferAggregator:
+    """
+    Collects transfer intents over a time or size window and submits
+    each window as one TransferBatch. Intents are grouped per
+    (from, to, token), with group_recipients per (from, token) so one
+    batching contract call can pay several recipients. A window of 0
+    submits every intent on its own
+    """
+
+    def __init__(
+        self, submit, window=1.0, max_size=50, group_recipients=False, history=100
+    ):
+        self.submit = submit
+        self.window = window
+        self.max_size = max_size
+        self.group_recipients = group_recipients
+
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.batches = collections.deque(maxlen=history)
+        self.intents = 0
+        self.submitted = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(
+        self, from_address, to_address, token, amount, source=None, on_submitted=None
+    ):
+        """
+        Queue a transfer intent, returns the batch it joined.
+        on_submitted() is called once the batch was sent or failed to be
+        """
+        if self.group_recipients:
+            key = (from_address, token)
+        else:
+            key = (from_address, to_address, token)
+        full = None
+        with self.condition:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = TransferBatch(
+                    from_address, token, time.monotonic() + self.window
+                )
+                self.pending[key] = batch
+                self.condition.notify()
+            batch.add(to_address, amount, source, on_submitted)
+            self.intents += 1
+            if len(batch.sources) >= self.max_size or self.window <= 0:
+                full = self.pending.pop(key)
+        REGISTRY.counter("transfer_intents_total").inc()
+        if full is not None:
+            self.flush_batch(full)
+        self.start()
+        return batch
+
+    def flush_batch(self, batch):
+        with self.condition:
+            self.submitted += 1
+            self.batches.append(batch)
+        REGISTRY.counter("transfer_batches_total").inc()
+        logger.info(
+            f"Submitting transfer of {len(batch.sources)} intents to "
+            f"{len(batch.amounts)} recipients from {batch.from_address}"
+        )
+        self.submit(batch)
+
+    def start(self):
+        with self.condition:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="transfer-aggregator")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stops the window thread and submits what is still collected"""
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+            due = list(self.pending.values())
+            self.pending.clear()
+        for batch in due:
+            self.flush_batch(batch)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                now = time.monotonic()
+                due = [k for k, b in self.pending.items() if b.deadline <= now]
+                if not due:
+                    deadlines = [b.deadline for b in self.pending.values()]
+                    timeout = min(deadlines) - now if deadlines else None
+                    self.condition.wait(timeout)
+                    continue
+                batches = [self.pending.pop(key) for key in due]
+            for batch in batches:
+                try:
+                    self.flush_batch(batch)
+                except Exception as e:
+                    logger.error("Could not submit transfer batch" + str(e))
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending_intents": sum(len(b.sources) for b in self.pending.values()),
+                "intents": self.intents,
+                "batches": self.submitted,
+                "recent": [batch.to_dict() for batch in self.batches],
+            }
@@ -0,0 +1,73 @@
+import logging
+import threading
+
+logger = logging.getLogger("App.BalanceCache")
+
+
+class BalanceCache:
+    """
+    Token balances keyed by (token, address, block). Only the newest
+    block is kept, a new head drops every older entry so reads between
+    blocks are served from memory
+    """
+
+    def __init__(self):
+        self.block = None
+        self.balances = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token, address, block):
+        with self.lock:
+            value = self.balances.get((token, address, block))
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, token, address, block, value):
+        with self.lock:
+            if self.block is None or block > self.block:
+                self._advance(block)
+            if block == self.block:
+                self.balances[(token, address, block)] = value
+
+    def new_head(self, block):
+        with self.lock:
+            if self.block is None or block > self.block:
+                self._advance(block)
+
+    def apply_transfer(self, token, from_address, to_address, amount, block):
+        """
+        Carry the balances touched by one of our own transfers, mined
+        in block, forward instead of waiting for the next read
+        """
+        with self.lock:
+            if self.block is None or block <= self.block:
+                # balances read at the mined block already include the transfer
+                return
+            previous = self.block
+            carried = {
+                address: self.balances.get((token, address, previous))
+                for address in (from_address, to_address)
+            }
+            self._advance(block)
+            for address, delta in ((from_address, -amount), (to_address, amount)):
+                if carried[address] is not None:
+                    self.balances[(token, address, block)] = carried[address] + delta
+
+    def _advance(self, block):
+        self.block = block
+        self.balances = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "block": self.block,
+                "entries": len(self.balances),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
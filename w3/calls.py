@@ -0,0 +1,88 @@
+import functools
+import re
+
+ADDRESS = re.compile(r"0x[0-9a-fA-F]{40}")
+
+# selectors are precomputed, eth_abi is only imported by the calls that
+# need a full ABI encoder
+BALANCE_OF_SELECTOR = "0x70a08231"
+DECIMALS_SELECTOR = "0x313ce567"
+AGGREGATE3_SELECTOR = "0x82ad56cb"
+TRANSFER_SELECTOR = "0xa9059cbb"
+# disperseToken(address,address[],uint256[]) of the batching contract
+DISPERSE_TOKEN_SELECTOR = "0xc73a2d60"
+# keccak of Transfer(address,address,uint256), topic 0 of ERC-20 transfer logs
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+
+def is_address(value):
+    return isinstance(value, str) and ADDRESS.fullmatch(value) is not None
+
+
+def encode_address(address):
+    """Left pad an address to a 32 byte ABI word, without 0x"""
+    return address.lower().removeprefix("0x").rjust(64, "0")
+
+
+def encode_balance_of(address):
+    return BALANCE_OF_SELECTOR + encode_address(address)
+
+
+@functools.lru_cache(maxsize=4096)
+def transfer_template(to_address):
+    """transfer calldata up to the amount, encoded once per recipient"""
+    return TRANSFER_SELECTOR + encode_address(to_address)
+
+
+def encode_transfer(to_address, amount):
+    return transfer_template(to_address) + format(amount, "064x")
+
+
+def encode_disperse_token(token, recipients, values):
+    from eth_abi import encode
+
+    return (
+        DISPERSE_TOKEN_SELECTOR
+        + encode(
+            ["address", "address[]", "uint256[]"], [token, recipients, values]
+        ).hex()
+    )
+
+
+def decode_uint256(data):
+    if not data or data == "0x":
+        return None
+    return int(data, 16)
+
+
+def decode_transfer_log(log):
+    """(from, to, value) of a Transfer log, None when it is not one"""
+    topics = log.get("topics") or []
+    if len(topics) != 3 or topics[0].lower() != TRANSFER_TOPIC:
+        return None
+    value = decode_uint256(log.get("data"))
+    return "0x" + topics[1][-40:].lower(), "0x" + topics[2][-40:].lower(), value or 0
+
+
+def encode_aggregate3(calls):
+    """
+    Calldata of Multicall3.aggregate3 for (target, calldata) pairs,
+    failing calls are allowed and reported per call
+    """
+    from eth_abi import encode
+
+    return (
+        AGGREGATE3_SELECTOR
+        + encode(
+            ["(address,bool,bytes)[]"],
+            [[(target, True, bytes.fromhex(data[2:])) for target, data in calls]],
+        ).hex()
+    )
+
+
+def decode_aggregate3(data):
+    """List of returned data per call, None for failed calls"""
+    from eth_abi import decode
+
+    (results,) = decode(["(bool,bytes)[]"], bytes.fromhex(data[2:]))
+    return ["0x" + returned.hex() if success else None for success, returned in results]
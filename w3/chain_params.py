@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+from .calls import decode_uint256, encode_balance_of
+
+logger = logging.getLogger("App.ChainParams")
+
+# storage write of a recipient holding no tokens yet, estimates taken
+# against a funded recipient do not include it
+COLD_RECIPIENT_GAS = 25000
+# tip used when the fee history holds no rewards
+DEFAULT_PRIORITY_FEE = 10**9
+
+
+def rpc_call_object(transaction):
+    """Transaction with its integer fields as hex quantities, as nodes expect"""
+    return {
+        key: (
+            hex(value)
+            if isinstance(value, int) and not isinstance(value, bool)
+            else value
+        )
+        for key, value in transaction.items()
+    }
+
+
+class ChainParams:
+    """
+    Fees, gas estimates and spendable token balances kept in memory by
+    a background thread, so a transfer is built and signed without a
+    round trip to the node. Fees come from eth_feeHistory as EIP-1559
+    fields, or from eth_gasPrice on chains without it. Everything is
+    refreshed in one batch every refresh_interval seconds, a read finding
+    the values older than max_age refreshes them first so fees never lag
+    the market by more than that. Gas is estimated in the background per
+    call shape, the fallback limit is used until an estimate exists
+    """
+
+    def __init__(
+        self,
+        make_batch_request,
+        chain_id=None,
+        refresh_interval=5,
+        max_age=30,
+        fee_blocks=5,
+        priority_percentile=50,
+    ):
+        self.make_batch_request = make_batch_request
+        self.chain_id = chain_id
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.fee_blocks = fee_blocks
+        self.priority_percentile = priority_percentile
+
+        self.fields = None
+        self.updated = None
+        self.estimates = {}
+        self.pending_estimates = {}
+        # (token, address) -> raw balance at the pending block and the
+        # amounts sent since it was read
+        self.balances = {}
+        self.debits = {}
+
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="chain-params")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                REGISTRY.counter("chain_params_errors_total").inc()
+                logger.error("Could not refresh chain params" + str(e))
+
+    def fresh(self):
+        return self.updated is not None and (
+            time.monotonic() - self.updated <= self.max_age
+        )
+
+    def ensure_fresh(self):
+        if not self.fresh():
+            REGISTRY.counter("chain_params_sync_refreshes_total").inc()
+            self.refresh()
+            self.start()
+
+    def refresh(self):
+        """Read fees, queued gas estimates and watched balances in one batch"""
+        with self.refresh_lock:
+            with self.lock:
+                watched = list(self.balances)
+                estimates = list(self.pending_estimates.items())
+            calls = [
+                ("eth_chainId", []),
+                (
+                    "eth_feeHistory",
+                    [hex(self.fee_blocks), "latest", [self.priority_percentile]],
+                ),
+                ("eth_gasPrice", []),
+            ]
+            calls += [
+                (
+                    "eth_call",
+                    [{"to": token, "data": encode_balance_of(address)}, "pending"],
+                )
+                for token, address in watched
+            ]
+            calls += [
+                ("eth_estimateGas", [rpc_call_object(transaction)])
+                for _, transaction in estimates
+            ]
+            started = time.monotonic()
+            responses = self.make_batch_request(calls)
+
+            chain_id, fee_history, gas_price = responses[:3]
+            self.check_chain_id(chain_id.get("result"))
+            fields = self.fee_fields(fee_history.get("result"), gas_price.get("result"))
+            balances = responses[3 : 3 + len(watched)]
+            gas = responses[3 + len(watched) :]
+
+            with self.lock:
+                self.fields = fields
+                self.updated = started
+                for key, response in zip(watched, balances):
+                    self.balances[key] = decode_uint256(response.get("result"))
+                    # sends before the read are part of the pending balance
+                    self.debits[key] = [
+                        (at, amount)
+                        for at, amount in self.debits.get(key, [])
+                        if at >= started
+                    ]
+                for (key, _), response in zip(estimates, gas):
+                    self.pending_estimates.pop(key, None)
+                    estimate = response.get("result")
+                    if estimate is None:
+                        logger.error(f"Gas estimate failed: {response.get('error')}")
+                        continue
+                    self.estimates[key] = int(estimate, 16)
+
+    def check_chain_id(self, result):
+        if result is None:
+            return
+        chain_id = int(result, 16)
+        if self.chain_id is None:
+            self.chain_id = chain_id
+        elif chain_id != self.chain_id:
+            logger.error(f"Node is on chain {chain_id}, configured {self.chain_id}")
+
+    def fee_fields(self, fee_history, gas_price):
+        """EIP-1559 fee fields when the node reports base fees, else gasPrice"""
+        base_fees = (fee_history or {}).get("baseFeePerGas") or []
+        if base_fees and int(base_fees[-1], 16):
+            # the last entry is the base fee of the next block
+            base_fee = int(base_fees[-1], 16)
+            rewards = sorted(
+                int(reward[0], 16) for reward in fee_history.get("reward") or []
+            )
+            priority = rewards[len(rewards) // 2] if rewards else DEFAULT_PRIORITY_FEE
+            return {
+                "maxFeePerGas": 2 * base_fee + priority,
+                "maxPriorityFeePerGas": priority,
+            }
+        if gas_price is None:
+            raise ValueError("Node reported neither fee history nor gas price")
+        return {"gasPrice": int(gas_price, 16)}
+
+    def fees(self):
+        """Fee fields of a transaction, at most max_age seconds old"""
+        self.ensure_fresh()
+        with self.lock:
+            return dict(self.fields)
+
+    def gas(self, key, recipients, fallback, estimate_transaction):
+        """
+        Gas limit of a call shape, the fallback until its estimate has
+        been read. estimate_transaction() builds the call to estimate
+        """
+        with self.lock:
+            estimate = self.estimates.get(key)
+            if estimate is None:
+                if key not in self.pending_estimates:
+                    self.pending_estimates[key] = estimate_transaction()
+                return fallback
+        return estimate + COLD_RECIPIENT_GAS * recipients
+
+    def balance(self, token, address):
+        """Raw token balance of address less what was sent since it was read"""
+        key = (token, address)
+        with self.lock:
+            watched = key in self.balances
+            if not watched:
+                self.balances[key] = None
+        if not watched:
+            self.refresh()
+            self.start()
+        else:
+            self.ensure_fresh()
+        with self.lock:
+            balance = self.balances.get(key)
+            if balance is None:
+                return None
+            return balance - sum(amount for _, amount in self.debits.get(key, []))
+
+    def debit(self, token, address, amount):
+        with self.lock:
+            self.debits.setdefault((token, address), []).append(
+                (time.monotonic(), amount)
+            )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "chain_id": self.chain_id,
+                "fees": self.fields,
+                "age": time.monotonic() - self.updated if self.updated else None,
+                "estimates": len(self.estimates),
+                "watched_balances": len(self.balances),
+            }
@@ -0,0 +1,10 @@
+import sys
+
+
+def is_web3_error(error):
+    """
+    Whether error was raised by web3, checked without importing web3 as
+    nothing can raise its exceptions before it was imported
+    """
+    exceptions = sys.modules.get("web3.exceptions")
+    return exceptions is not None and isinstance(error, exceptions.Web3Exception)
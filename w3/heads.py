@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+
+logger = logging.getLogger("App.Heads")
+
+
+class HeadTracker:
+    """
+    Follows the chain head from a background thread, through a
+    websocket newHeads subscription when WS_RPC_URL is configured
+    and a cheap eth_blockNumber poll otherwise
+    """
+
+    def __init__(self, fetch_block_number, on_head, ws_url=None, poll_interval=2):
+        self.fetch_block_number = fetch_block_number
+        self.on_head = on_head
+        self.ws_url = ws_url
+        self.poll_interval = poll_interval
+
+        self.block_number = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="head-tracker")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def current(self):
+        """Latest known head, read from the chain until the tracker has one"""
+        if self.block_number is None:
+            self.set_head(self.fetch_block_number())
+            self.start()
+        return self.block_number
+
+    def set_head(self, block_number):
+        with self.lock:
+            if self.block_number is not None and block_number <= self.block_number:
+                return
+            self.block_number = block_number
+        self.on_head(block_number)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.ws_url:
+                try:
+                    self.subscribe()
+                except Exception as e:
+                    logger.error("newHeads subscription failed" + str(e))
+            try:
+                self.set_head(self.fetch_block_number())
+            except Exception as e:
+                logger.error("Could not fetch block number" + str(e))
+            self.stop_event.wait(self.poll_interval)
+
+    def subscribe(self):
+        from websockets.sync.client import connect
+
+        with connect(self.ws_url) as ws:
+            ws.send(
+                json.dumps(
+                    {
+                        "jsonrpc": "2.0",
+                        "id": 1,
+                        "method": "eth_subscribe",
+                        "params": ["newHeads"],
+                    }
+                )
+            )
+            logger.info("Subscribed to newHeads")
+            while not self.stop_event.is_set():
+                try:
+                    message = json.loads(ws.recv(timeout=self.poll_interval))
+                except TimeoutError:
+                    continue
+                if message.get("method") == "eth_subscription":
+                    self.set_head(int(message["params"]["result"]["number"], 16))
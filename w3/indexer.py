@@ -0,0 +1,368 @@
+import logging
+import sqlite3
+import threading
+
+from metrics import REGISTRY
+
+from .calls import TRANSFER_TOPIC, decode_transfer_log
+
+logger = logging.getLogger("App.Indexer")
+
+ZERO_ADDRESS = "0x" + "0" * 40
+
+# values are uint256 and kept as decimal text, sqlite integers are 64 bit
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    block INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    txn_hash TEXT NOT NULL,
+    from_address TEXT NOT NULL,
+    to_address TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (block, log_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transfers_from ON transfers (from_address, block);
+CREATE INDEX IF NOT EXISTS transfers_to ON transfers (to_address, block);
+CREATE TABLE IF NOT EXISTS balances (
+    address TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    balance TEXT NOT NULL,
+    PRIMARY KEY (address, block)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blocks (
+    number INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# successful ranges after which a rejected range size is tried again
+RANGE_CEILING_RESET = 32
+
+TRANSFER_COLUMNS = "block, log_index, txn_hash, from_address, to_address, value"
+
+
+class TransferIndexer:
+    """
+    Indexes the Transfer logs of one ERC-20 token into SQLite from a
+    background thread. Logs are fetched with eth_getLogs over block
+    ranges that grow while they return few logs and shrink when they
+    return many or the node rejects them. Every transfer moves the
+    balances of its two addresses, kept per block so balance history is
+    a local read. The hash of the last indexed block is checked with
+    every range, when it changed the index is rolled back to the newest
+    block still on the chain, at most reorg_depth blocks
+    """
+
+    def __init__(
+        self,
+        make_batch_request,
+        token,
+        path,
+        start_block=0,
+        confirmations=0,
+        max_range=2000,
+        max_logs=10000,
+        reorg_depth=64,
+        poll_interval=2,
+    ):
+        self.make_batch_request = make_batch_request
+        self.token = token.lower()
+        self.start_block = start_block
+        self.confirmations = confirmations
+        self.max_range = max_range
+        self.max_logs = max_logs
+        self.reorg_depth = reorg_depth
+        self.poll_interval = poll_interval
+
+        # ranges stay below one the node rejected for a while
+        self.range = max_range
+        self.ceiling = max_range
+        self.ranges_since_error = 0
+        self.head = None
+        self.indexed = 0
+        self.reorgs = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.check_token()
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def check_token(self):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT value FROM state WHERE key = 'token'")
+            row = row.fetchone()
+            if row is None:
+                self.db.execute("INSERT INTO state VALUES ('token', ?)", (self.token,))
+            elif row[0] != self.token:
+                raise ValueError(f"Index database holds transfers of token {row[0]}")
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run, name="transfer-indexer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                REGISTRY.counter("indexer_errors_total").inc()
+                logger.error("Exception while indexing transfers" + str(e))
+            self.stop_event.wait(self.poll_interval)
+
+    def request(self, method, params):
+        response = self.make_batch_request([(method, params)])[0]
+        if "error" in response:
+            raise ValueError(f"{method} failed: {response['error']}")
+        return response["result"]
+
+    def poll(self):
+        """Index up to the head less confirmations, returns the last indexed block"""
+        self.head = int(self.request("eth_blockNumber", []), 16)
+        target = self.head - self.confirmations
+        while not self.stop_event.is_set():
+            last = self.last_block()
+            if last >= target:
+                break
+            self.index_range(last, min(target, last + self.range))
+        return self.last_block()
+
+    def index_range(self, last, to):
+        calls = [
+            (
+                "eth_getLogs",
+                [
+                    {
+                        "address": self.token,
+                        "topics": [TRANSFER_TOPIC],
+                        "fromBlock": hex(last + 1),
+                        "toBlock": hex(to),
+                    }
+                ],
+            ),
+            ("eth_getBlockByNumber", [hex(to), False]),
+        ]
+        last_hash = self.block_hash(last)
+        if last_hash is not None:
+            calls.append(("eth_getBlockByNumber", [hex(last), False]))
+        responses = self.make_batch_request(calls)
+
+        if last_hash is not None:
+            parent = responses[2].get("result")
+            if not parent or parent["hash"] != last_hash:
+                self.rollback(last)
+                return
+
+        if "error" in responses[0]:
+            if self.range == 1:
+                raise ValueError(f"eth_getLogs failed: {responses[0]['error']}")
+            self.range = max(1, (to - last) // 2)
+            self.ceiling = self.range
+            self.ranges_since_error = 0
+            REGISTRY.counter("indexer_range_shrinks_total").inc()
+            return
+        block = responses[1].get("result")
+        if not block:
+            raise ValueError(f"Block {to} is not available yet")
+        logs = [log for log in responses[0]["result"] if not log.get("removed")]
+        if any(
+            int(log["blockNumber"], 16) == to and log["blockHash"] != block["hash"]
+            for log in logs
+        ):
+            raise ValueError(f"Block {to} changed while indexing")
+
+        self.store(to, block["hash"], logs)
+        self.ranges_since_error += 1
+        if self.ranges_since_error % RANGE_CEILING_RESET == 0:
+            self.ceiling = self.max_range
+        if len(logs) > self.max_logs // 2:
+            self.range = max(1, (to - last) // 2)
+        elif len(logs) < self.max_logs // 8:
+            self.range = min(self.ceiling, self.range * 2)
+
+    def store(self, to, to_hash, logs):
+        logs.sort(
+            key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"], 16))
+        )
+        transfers = []
+        hashes = {}
+        balances = {}
+        changes = {}
+        with self.lock, self.db:
+            for log in logs:
+                decoded = decode_transfer_log(log)
+                if decoded is None:
+                    continue
+                from_address, to_address, value = decoded
+                block = int(log["blockNumber"], 16)
+                transfers.append(
+                    (
+                        block,
+                        int(log["logIndex"], 16),
+                        log["transactionHash"],
+                        from_address,
+                        to_address,
+                        str(value),
+                    )
+                )
+                hashes[block] = log["blockHash"]
+                for address, delta in ((from_address, -value), (to_address, value)):
+                    if address == ZERO_ADDRESS:
+                        continue
+                    if address not in balances:
+                        balances[address] = self.read_balance(address)
+                    balances[address] += delta
+                    changes[(address, block)] = str(balances[address])
+            hashes[to] = to_hash
+
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO transfers ({TRANSFER_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                transfers,
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO balances VALUES (?, ?, ?)",
+                [(address, block, b) for (address, block), b in changes.items()],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?)", hashes.items()
+            )
+            self.db.execute(
+                "DELETE FROM blocks WHERE number < ?", (to - self.reorg_depth,)
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO state VALUES ('last_block', ?)", (to,)
+            )
+        self.indexed += len(transfers)
+        REGISTRY.counter("indexed_transfers_total").inc(len(transfers))
+
+    def rollback(self, last):
+        """Drop the blocks after the newest stored block still on the chain"""
+        with self.lock:
+            stored = self.db.execute(
+                "SELECT number, hash FROM blocks WHERE number <= ? ORDER BY number DESC",
+                (last,),
+            ).fetchall()
+        responses = self.make_batch_request(
+            [("eth_getBlockByNumber", [hex(number), False]) for number, _ in stored]
+        )
+        ancestor = None
+        for (number, stored_hash), response in zip(stored, responses):
+            block = response.get("result")
+            if block and block["hash"] == stored_hash:
+                ancestor = number
+                break
+        if ancestor is None:
+            ancestor = max(self.start_block - 1, last - self.reorg_depth)
+            logger.error(f"Reorg deeper than {self.reorg_depth} blocks at {last}")
+        logger.warning(f"Chain reorganized, rolling back from {last} to {ancestor}")
+        self.truncate(ancestor)
+        self.reorgs += 1
+        REGISTRY.counter("indexer_reorgs_total").inc()
+
+    def truncate(self, block):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM transfers WHERE block > ?", (block,))
+            self.db.execute("DELETE FROM balances WHERE block > ?", (block,))
+            self.db.execute("DELETE FROM blocks WHERE number > ?", (block,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO state VALUES ('last_block', ?)", (block,)
+            )
+
+    def last_block(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM state WHERE key = 'last_block'"
+            ).fetchone()
+        return int(row[0]) if row else self.start_block - 1
+
+    def block_hash(self, number):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash FROM blocks WHERE number = ?", (number,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def read_balance(self, address, block=None):
+        row = self.db.execute(
+            "SELECT balance FROM balances WHERE address = ? AND block <= ? "
+            "ORDER BY block DESC LIMIT 1",
+            (address, block if block is not None else 2**62),
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def balance_of(self, address, block=None):
+        """Base units held at the end of block, the last indexed one by default"""
+        with self.lock:
+            return self.read_balance(address.lower(), block)
+
+    def balance_history(self, address, from_block=0, to_block=None, limit=100):
+        """Balance after every indexed block that changed it, oldest first"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT block, balance FROM balances WHERE address = ? "
+                "AND block BETWEEN ? AND ? ORDER BY block LIMIT ?",
+                (address.lower(), from_block, self.upper(to_block), limit),
+            ).fetchall()
+        return [{"block": block, "balance": int(balance)} for block, balance in rows]
+
+    def transfers(self, address=None, from_block=0, to_block=None, limit=100):
+        """Indexed transfers from or to address, all of them without one"""
+        bounds = (from_block, self.upper(to_block))
+        if address is None:
+            query = (
+                f"SELECT {TRANSFER_COLUMNS} FROM transfers WHERE block BETWEEN ? AND ?"
+            )
+            params = bounds
+        else:
+            query = (
+                f"SELECT {TRANSFER_COLUMNS} FROM transfers "
+                "WHERE from_address = ? AND block BETWEEN ? AND ? UNION "
+                f"SELECT {TRANSFER_COLUMNS} FROM transfers "
+                "WHERE to_address = ? AND block BETWEEN ? AND ?"
+            )
+            params = (address.lower(), *bounds, address.lower(), *bounds)
+        with self.lock:
+            rows = self.db.execute(
+                query + " ORDER BY block, log_index LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [
+            {
+                "block": block,
+                "log_index": log_index,
+                "txn_hash": txn_hash,
+                "from": from_address,
+                "to": to_address,
+                "value": int(value),
+            }
+            for block, log_index, txn_hash, from_address, to_address, value in rows
+        ]
+
+    def upper(self, to_block):
+        return to_block if to_block is not None else 2**62
+
+    def stats(self):
+        last = self.last_block()
+        return {
+            "token": self.token,
+            "last_block": last,
+            "head": self.head,
+            "lag": self.head - last if self.head is not None else None,
+            "range": self.range,
+            "indexed": self.indexed,
+            "reorgs": self.reorgs,
+        }
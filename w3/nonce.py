@@ -0,0 +1,126 @@
+import asyncio
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger("App.Nonce")
+
+NONCE_USED_ERRORS = ("nonce too low", "replacement transaction underpriced")
+NONCE_GAP_ERRORS = ("nonce too high",)
+ALREADY_KNOWN_ERRORS = ("already known", "known transaction")
+
+
+class AccountNonces:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_nonce = None
+        self.released = []
+        self.in_flight = set()
+
+
+class NonceManager:
+    """
+    Hands out transaction nonces per account locally. The pending
+    transaction count is read from the chain once per account, later
+    allocations only take a lock so many transfers can be in flight.
+    Nonces of transactions that were never broadcast are handed out
+    again to close gaps, nonce errors from the node trigger a resync
+    """
+
+    def __init__(self, fetch_nonce):
+        self.fetch_nonce = fetch_nonce
+        self.accounts = {}
+        self.lock = threading.Lock()
+
+    def account(self, address):
+        with self.lock:
+            if address not in self.accounts:
+                self.accounts[address] = AccountNonces()
+            return self.accounts[address]
+
+    def allocate(self, address):
+        state = self.account(address)
+        with state.lock:
+            if state.next_nonce is None:
+                state.next_nonce = self.fetch_nonce(address)
+            if state.released:
+                nonce = heapq.heappop(state.released)
+            else:
+                nonce = state.next_nonce
+                state.next_nonce += 1
+            state.in_flight.add(nonce)
+            return nonce
+
+    async def allocate_async(self, address):
+        """
+        Same as allocate, the chain sync of an unsynced account runs
+        in the default executor so the event loop is never blocked
+        """
+        state = self.account(address)
+        if state.next_nonce is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.allocate, address)
+        return self.allocate(address)
+
+    def release(self, address, nonce):
+        """Return the nonce of a transaction that was never broadcast"""
+        state = self.account(address)
+        with state.lock:
+            if nonce not in state.in_flight:
+                return
+            state.in_flight.discard(nonce)
+            if nonce == state.next_nonce - 1:
+                state.next_nonce = nonce
+            else:
+                heapq.heappush(state.released, nonce)
+
+    def confirm(self, address, nonce):
+        """The transaction using nonce was mined"""
+        state = self.account(address)
+        with state.lock:
+            state.in_flight.discard(nonce)
+
+    def abandon(self, address, nonce):
+        """
+        The transaction using nonce failed or was not mined in time, it
+        may have been dropped. The account is resynced so its nonce is
+        handed out again unless the node still holds the transaction
+        """
+        state = self.account(address)
+        with state.lock:
+            state.in_flight.discard(nonce)
+        return self.resync(address)
+
+    def resync(self, address):
+        """
+        Re-read the pending transaction count from the chain. Nonces
+        still being sent by other callers are kept, every nonce between
+        the chain count and those is handed out again to fill the gap
+        """
+        state = self.account(address)
+        with state.lock:
+            chain_nonce = self.fetch_nonce(address)
+            sending = {n for n in state.in_flight if n >= chain_nonce}
+            state.next_nonce = max(sending) + 1 if sending else chain_nonce
+            state.released = [
+                n for n in range(chain_nonce, state.next_nonce) if n not in sending
+            ]
+            heapq.heapify(state.released)
+            state.in_flight = sending
+            logger.info(f"Nonce for {address} resynced to {chain_nonce}")
+            return chain_nonce
+
+    def handle_error(self, address, nonce, error):
+        """
+        Recover from a failed send, returns True when the nonce
+        was the cause and the transaction can be retried with a
+        freshly allocated nonce
+        """
+        message = str(error).lower()
+        if any(reason in message for reason in NONCE_USED_ERRORS + NONCE_GAP_ERRORS):
+            self.abandon(address, nonce)
+            return True
+        if not any(reason in message for reason in ALREADY_KNOWN_ERRORS):
+            # the node already has this transaction, keep the nonce taken
+            self.release(address, nonce)
+        return False
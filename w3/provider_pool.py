@@ -0,0 +1,280 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from web3.exceptions import ProviderConnectionError
+from web3.providers.base import JSONBaseProvider
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("App.ProviderPool")
+
+# Methods of the nonce stream stay on one endpoint so nonces and
+# pending transactions are always read from the node they were sent to
+STICKY_METHODS = {
+    "eth_sendRawTransaction",
+    "eth_sendTransaction",
+    "eth_getTransactionCount",
+}
+
+
+class Endpoint:
+    def __init__(self, url, pool_size, window=50):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.latency = None
+        self.samples = collections.deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.down_until = 0
+        self.lock = threading.Lock()
+
+    def post(self, data, timeout):
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.url,
+                data=data,
+                headers={"Content-Type": "application/json"},
+                timeout=timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            self.record(False, time.perf_counter() - start)
+            raise
+        self.record(True, time.perf_counter() - start)
+        return response.content
+
+    def record(self, ok, latency):
+        with self.lock:
+            self.samples.append(ok)
+            if ok:
+                self.consecutive_failures = 0
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else 0.8 * self.latency + 0.2 * latency
+                )
+            else:
+                self.consecutive_failures += 1
+                # back off an endpoint exponentially while it keeps failing
+                self.down_until = time.monotonic() + min(
+                    2**self.consecutive_failures, 60
+                )
+
+    @property
+    def error_rate(self):
+        with self.lock:
+            if not self.samples:
+                return 0.0
+            return self.samples.count(False) / len(self.samples)
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    @property
+    def score(self):
+        """Rolling latency penalised by the rolling error rate"""
+        if self.latency is None:
+            return -1
+        return self.latency * (1 + 4 * self.error_rate)
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "latency_ms": None if self.latency is None else self.latency * 1000,
+            "error_rate": self.error_rate,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """
+    Web3 provider spreading requests over several RPC endpoints with
+    pooled keep-alive sessions. Reads go to the endpoint with the lowest
+    rolling latency among the healthy ones and are hedged on the next
+    best endpoint when they are slow, writes stick to one endpoint
+    until it fails. Unhealthy endpoints are probed in the background
+    """
+
+    def __init__(
+        self,
+        urls,
+        timeout=10,
+        hedge_after=0.5,
+        health_check_interval=10,
+        pool_size=10,
+    ):
+        super().__init__()
+        if not urls:
+            raise ValueError("PooledHTTPProvider needs at least one RPC url")
+        self.endpoints = [Endpoint(url, pool_size) for url in urls]
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.health_check_interval = health_check_interval
+
+        self.sticky_endpoint = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="rpc-hedge"
+        )
+
+        self.stop_event = threading.Event()
+        self.health_thread = None
+
+    def __str__(self):
+        return "RPC pool " + ", ".join(e.url for e in self.endpoints)
+
+    def make_request(self, method, params):
+        data = self.encode_rpc_request(method, params)
+        start = time.perf_counter()
+        try:
+            response = self.decode_rpc_response(
+                self.send(data, method in STICKY_METHODS)
+            )
+        except Exception:
+            REGISTRY.counter("rpc_errors_total", method=method).inc()
+            raise
+        finally:
+            REGISTRY.counter("rpc_calls_total", method=method).inc()
+            REGISTRY.histogram("rpc_latency_seconds", method=method).observe(
+                time.perf_counter() - start
+            )
+        if "error" in response:
+            REGISTRY.counter("rpc_errors_total", method=method).inc()
+        return response
+
+    def make_batch_request(self, batch_requests):
+        data = self.encode_batch_rpc_request(batch_requests)
+        sticky = any(method in STICKY_METHODS for method, _ in batch_requests)
+        start = time.perf_counter()
+        try:
+            responses = self.decode_rpc_response(self.send(data, sticky))
+            if not isinstance(responses, list):
+                # a node answers a rejected batch with a single error object
+                raise ProviderConnectionError(f"Batch request failed: {responses}")
+        except Exception:
+            REGISTRY.counter("rpc_errors_total", method="batch").inc()
+            raise
+        finally:
+            REGISTRY.counter("rpc_calls_total", method="batch").inc()
+            REGISTRY.histogram("rpc_latency_seconds", method="batch").observe(
+                time.perf_counter() - start
+            )
+        for method, _ in batch_requests:
+            REGISTRY.counter("rpc_batched_calls_total", method=method).inc()
+        return sorted(responses, key=lambda response: response.get("id", 0))
+
+    def ranked_endpoints(self):
+        """Healthy endpoints by rolling latency, untested ones first"""
+        healthy = [e for e in self.endpoints if e.healthy]
+        ranked = sorted(healthy, key=lambda e: e.score)
+        # fall back to the unhealthy ones rather than failing outright
+        return ranked + [e for e in self.endpoints if e not in healthy]
+
+    def send(self, data, sticky=False):
+        self.start_health_checks()
+        if sticky:
+            return self.send_sticky(data)
+        return self.send_hedged(data)
+
+    def send_sticky(self, data):
+        with self.lock:
+            endpoint = self.sticky_endpoint
+            if endpoint is None or not endpoint.healthy:
+                endpoint = self.sticky_endpoint = self.ranked_endpoints()[0]
+        try:
+            return endpoint.post(data, self.timeout)
+        except requests.RequestException as e:
+            logger.error(f"Write endpoint {endpoint.url} failed, switching: " + str(e))
+            with self.lock:
+                if self.sticky_endpoint is endpoint:
+                    self.sticky_endpoint = None
+            return self.send_sequential(data, exclude=endpoint, error=e)
+
+    def send_hedged(self, data):
+        """
+        Send to the fastest endpoint, when no answer arrived after
+        hedge_after seconds send the same request to the next one too
+        and use whichever answers first
+        """
+        endpoints = self.ranked_endpoints()
+        if len(endpoints) == 1 or not self.hedge_after:
+            return self.send_sequential(data)
+
+        primary, backup = endpoints[0], endpoints[1]
+        futures = {self.executor.submit(primary.post, data, self.timeout): primary}
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done:
+            futures[self.executor.submit(backup.post, data, self.timeout)] = backup
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    error = e
+        return self.send_sequential(data, exclude=futures.values(), error=error)
+
+    def send_sequential(self, data, exclude=(), error=None):
+        exclude = (exclude,) if isinstance(exclude, Endpoint) else tuple(exclude)
+        for endpoint in self.ranked_endpoints():
+            if endpoint in exclude:
+                continue
+            try:
+                return endpoint.post(data, self.timeout)
+            except requests.RequestException as e:
+                logger.error(f"RPC endpoint {endpoint.url} failed: " + str(e))
+                error = e
+        raise ProviderConnectionError(f"All RPC endpoints failed: {error}")
+
+    def start_health_checks(self):
+        if self.health_thread or len(self.endpoints) == 1:
+            return
+        with self.lock:
+            if self.health_thread:
+                return
+            self.health_thread = threading.Thread(
+                target=self.run_health_checks, name="rpc-health"
+            )
+            self.health_thread.daemon = True
+            self.health_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
+
+    def run_health_checks(self):
+        probe = json.dumps(
+            {"jsonrpc": "2.0", "method": "eth_blockNumber", "params": [], "id": 0}
+        ).encode()
+        while not self.stop_event.wait(self.health_check_interval):
+            for endpoint in self.endpoints:
+                if endpoint.healthy and endpoint.latency is not None:
+                    continue
+                try:
+                    endpoint.down_until = 0
+                    endpoint.post(probe, self.timeout)
+                except requests.RequestException as e:
+                    logger.info(f"RPC endpoint {endpoint.url} still down: " + str(e))
+
+    def stats(self):
+        return {
+            "sticky": self.sticky_endpoint.url if self.sticky_endpoint else None,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
@@ -0,0 +1,160 @@
+import collections
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+logger = logging.getLogger("App.Receipts")
+
+
+class PendingTransaction:
+    def __init__(self, txn_hash, from_address=None, nonce=None):
+        self.txn_hash = txn_hash
+        self.from_address = from_address
+        self.nonce = nonce
+        self.submitted_at = time.monotonic()
+        self.future = Future()
+
+
+class ReceiptTracker:
+    """
+    Polls receipts of every pending transaction from one background
+    thread. Each poll fetches all receipts in batched JSON-RPC calls,
+    the poll interval backs off while nothing gets mined and resets
+    as soon as transactions confirm or new ones are tracked
+    """
+
+    def __init__(
+        self,
+        make_batch_request,
+        batch_size=100,
+        min_interval=0.5,
+        max_interval=8,
+        timeout=600,
+    ):
+        self.make_batch_request = make_batch_request
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.interval = min_interval
+
+        self.confirmed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def track(self, txn_hash, from_address=None, nonce=None, on_complete=None):
+        """
+        Start tracking a sent transaction, returns a future resolved
+        with the raw receipt once it is mined. on_complete is called
+        with the PendingTransaction once its future is done
+        """
+        pending = PendingTransaction(txn_hash, from_address, nonce)
+        if on_complete:
+            pending.future.add_done_callback(lambda future: on_complete(pending))
+        with self.condition:
+            if not self.pending:
+                self.condition.notify()
+            self.pending[txn_hash] = pending
+            self.interval = self.min_interval
+        self.start()
+        return pending.future
+
+    def start(self):
+        with self.condition:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="receipt-tracker")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.pending or self.stop_event.is_set()
+                )
+                self.condition.wait(self.interval)
+                pending = list(self.pending.values())
+            if not pending:
+                continue
+            try:
+                completed = self.poll(pending)
+            except Exception as e:
+                logger.error("Exception while polling receipts" + str(e))
+                completed = 0
+            with self.condition:
+                if completed:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+
+    def poll(self, pending):
+        completed = 0
+        for i in range(0, len(pending), self.batch_size):
+            chunk = pending[i : i + self.batch_size]
+            responses = self.make_batch_request(
+                [("eth_getTransactionReceipt", [p.txn_hash]) for p in chunk]
+            )
+            for tx, response in zip(chunk, responses):
+                receipt = response.get("result")
+                if receipt:
+                    self.complete(tx, receipt)
+                    completed += 1
+                elif time.monotonic() - tx.submitted_at > self.timeout:
+                    self.expire(tx)
+        return completed
+
+    def complete(self, tx, receipt):
+        latency = time.monotonic() - tx.submitted_at
+        with self.condition:
+            self.pending.pop(tx.txn_hash, None)
+            self.latencies.append(latency)
+            if int(receipt.get("status", "0x0"), 16) == 1:
+                self.confirmed += 1
+            else:
+                self.failed += 1
+        logger.info(f"Transaction {tx.txn_hash} mined after {latency:.2f}s")
+        tx.future.set_result(receipt)
+
+    def expire(self, tx):
+        with self.condition:
+            self.pending.pop(tx.txn_hash, None)
+            self.timed_out += 1
+        logger.error(f"Transaction {tx.txn_hash} not mined after {self.timeout}s")
+        tx.future.set_exception(
+            TimeoutError(f"Transaction {tx.txn_hash} not mined after {self.timeout}s")
+        )
+
+    def stats(self):
+        """Pending count and confirmation latency in seconds"""
+        with self.condition:
+            latencies = sorted(self.latencies)
+            stats = {
+                "pending": len(self.pending),
+                "confirmed": self.confirmed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "poll_interval": self.interval,
+            }
+        if latencies:
+            stats["latency"] = {
+                "avg": sum(latencies) / len(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                "max": latencies[-1],
+            }
+        return stats
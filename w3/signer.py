@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .calls import encode_disperse_token, encode_transfer
+
+logger = logging.getLogger("App.Signer")
+
+# accounts by lowercase address, only populated inside signer processes
+accounts = {}
+
+
+def build_transfer(token, amounts, batch_contract, fields):
+    """
+    Unsigned transaction paying amounts {recipient: base units} of token,
+    a plain token transfer for one recipient and a disperseToken call of
+    the batching contract for several. fields carries from, gas, the fee
+    fields, nonce and chainId
+    """
+    if len(amounts) == 1:
+        [(to_address, amount)] = amounts.items()
+        to, data = token, encode_transfer(to_address, amount)
+    elif batch_contract:
+        to = batch_contract
+        data = encode_disperse_token(token, list(amounts), list(amounts.values()))
+    else:
+        raise ValueError("Several recipients need TRANSFER_BATCH_CONTRACT")
+    return dict(fields, to=to, data=data, value=0)
+
+
+def load_keys(private_keys):
+    """Initializer of a signer process"""
+    from eth_account import Account
+
+    for private_key in private_keys:
+        account = Account.from_key(private_key)
+        accounts[account.address.lower()] = account
+
+
+def sign_transfer(token, amounts, batch_contract, fields):
+    """Runs in a signer process, returns the raw signed transaction"""
+    account = accounts.get(fields["from"].lower())
+    if account is None:
+        raise ValueError(f"No key for {fields['from']} in the signer")
+    signed = account.sign_transaction(
+        build_transfer(token, amounts, batch_contract, fields)
+    )
+    return bytes(signed.raw_transaction)
+
+
+def ping():
+    return len(accounts)
+
+
+class SignerPool:
+    """
+    Worker processes holding the private keys. ABI encoding and
+    secp256k1 signing of transfers run there instead of on threads of
+    the agent, so they do not hold the GIL of the process serving the
+    sockets. Only the transaction fields go in and the raw signed
+    transaction comes back
+    """
+
+    def __init__(self, private_keys, processes=1):
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_keys,
+            initargs=(list(private_keys),),
+        )
+
+    def start(self):
+        """Spawn the processes up front, the first signature is not delayed"""
+        for future in [self.executor.submit(ping) for _ in range(self.processes)]:
+            future.result()
+        logger.info(f"Started {self.processes} signer processes")
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, token, amounts, batch_contract, fields):
+        """Future of the raw signed transaction"""
+        return self.executor.submit(
+            sign_transfer, token, amounts, batch_contract, fields
+        )
+
+    def sign_transfer(self, token, amounts, batch_contract, fields, timeout=30):
+        return self.submit(token, amounts, batch_contract, fields).result(timeout)
@@ -1,21 +1,62 @@
 import os
 import logging
-import time
-
-from web3 import Web3
-from web3.exceptions import (
-    ProviderConnectionError,
-    Web3RPCError,
-    TransactionIndexingInProgress,
-    InvalidTransaction,
-    TransactionNotFound,
-)
+import threading
+
 from dotenv import load_dotenv
 
+from events import EVENTS, TRANSFER_CONFIRMED, TRANSFER_FAILED, TRANSFER_SENT
+
+from .balance_cache import BalanceCache
+from .chain_params import ChainParams
+from .calls import (
+    DECIMALS_SELECTOR,
+    decode_aggregate3,
+    decode_uint256,
+    encode_aggregate3,
+    encode_balance_of,
+)
+from .heads import HeadTracker
+from .indexer import TransferIndexer
+from .nonce import NonceManager
+from .receipts import ReceiptTracker
+from .signer import SignerPool, build_transfer
+
 logger = logging.getLogger("App.W3")
 
 load_dotenv()
 
+SEND_ATTEMPTS = 2
+BATCH_SIZE = 100
+MULTICALL_CHUNK_SIZE = 500
+TRANSFER_GAS = 200000
+RECIPIENT_GAS = 50000
+# base units of one token with 18 decimals
+ONE_TOKEN = 10**18
+
+ERC20_ABI = [
+    {
+        "constant": True,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "payable": False,
+        "stateMutability": "view",
+        "type": "function",
+    },
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "_to", "type": "address"},
+            {"name": "_value", "type": "uint256"},
+        ],
+        "name": "transfer",
+        "outputs": [{"name": "success", "type": "bool"}],
+        "payable": False,
+        "stateMutability": "nonpayable",
+        "type": "function",
+    },
+]
+
 
 class W3:
     def __init__(self):
@@ -29,98 +70,333 @@ class W3:
 
         self.private_key = os.getenv("PRIVATE_KEY")
 
-        self.erc20_abi = [
-            {
-                "constant": True,
-                "inputs": [{"name": "_owner", "type": "address"}],
-                "name": "balanceOf",
-                "outputs": [{"name": "balance", "type": "uint256"}],
-                "payable": False,
-                "stateMutability": "view",
-                "type": "function",
-            },
-            {
-                "constant": False,
-                "inputs": [
-                    {"name": "_to", "type": "address"},
-                    {"name": "_value", "type": "uint256"},
-                ],
-                "name": "transfer",
-                "outputs": [{"name": "success", "type": "bool"}],
-                "payable": False,
-                "stateMutability": "nonpayable",
-                "type": "function",
-            },
-        ]
-        try:
-            self.w3 = Web3(Web3.HTTPProvider(self.rpc_url))
+        self.multicall_address = os.getenv("MULTICALL_ADDRESS")
+        self.batch_contract_address = os.getenv("TRANSFER_BATCH_CONTRACT")
+        self.token_decimals = {}
+
+        # with signer processes the key is only held by those processes
+        self.signer = None
+        signer_processes = int(os.getenv("SIGNER_PROCESSES", 0))
+        if signer_processes and self.private_key:
+            self.signer = SignerPool([self.private_key], signer_processes)
+            self.private_key = None
+
+        self.balance_cache = BalanceCache()
+        self.head_tracker = HeadTracker(
+            self.fetch_block_number,
+            on_head=self.balance_cache.new_head,
+            ws_url=os.getenv("WS_RPC_URL"),
+            poll_interval=float(os.getenv("HEAD_POLL_INTERVAL", 2)),
+        )
 
-            self.erc20_contract = self.w3.eth.contract(
-                address=self.erc20_contract_address, abi=self.erc20_abi
+        # fees, gas estimates and the sender balance are read in the
+        # background, transfers are built without a round trip
+        self.chain_params = ChainParams(
+            self.make_batch_request,
+            chain_id=self.chain_id,
+            refresh_interval=float(os.getenv("FEE_REFRESH_INTERVAL", 5)),
+            max_age=float(os.getenv("FEE_MAX_AGE", 30)),
+        )
+
+        self.erc20_abi = ERC20_ABI
+        self.receipt_tracker = ReceiptTracker(self.make_batch_request)
+        self.nonce_manager = NonceManager(
+            lambda address: self.w3.eth.get_transaction_count(address, "pending")
+        )
+
+        # local index of the token's Transfer logs, off without INDEXER_DB
+        self.indexer = None
+        if os.getenv("INDEXER_DB"):
+            self.indexer = TransferIndexer(
+                self.make_batch_request,
+                self.erc20_contract_address,
+                os.getenv("INDEXER_DB"),
+                start_block=int(os.getenv("INDEXER_START_BLOCK", 0)),
+                confirmations=int(os.getenv("INDEXER_CONFIRMATIONS", 0)),
+                max_range=int(os.getenv("INDEXER_MAX_RANGE", 2000)),
+                reorg_depth=int(os.getenv("INDEXER_REORG_DEPTH", 64)),
             )
-        except ProviderConnectionError as e:
-            logger.error("Provider connection error" + str(e))
-        except Web3RPCError as e:
-            logger.error("web3 rpc error" + str(e))
-        except Exception as e:
-            logger.error("Unknown error" + str(e))
+
+        # web3 is imported and the provider built on the first chain call
+        self.rpc_urls = (os.getenv("RPC_URLS") or self.rpc_url or "").split(",")
+        self.client = None
+        self.contract = None
+        self.connect_lock = threading.Lock()
+
+    @property
+    def w3(self):
+        if self.client is None:
+            self.connect()
+        return self.client
+
+    def connect(self):
+        """Import web3 and build the pooled provider, once"""
+        with self.connect_lock:
+            if self.client is not None:
+                return self.client
+            try:
+                from web3 import Web3
+
+                from .provider_pool import PooledHTTPProvider
+
+                self.client = Web3(
+                    PooledHTTPProvider(
+                        [url.strip() for url in self.rpc_urls if url.strip()],
+                        hedge_after=float(os.getenv("RPC_HEDGE_AFTER", 0.5)),
+                    )
+                )
+            except Exception as e:
+                logger.error("Unknown error while connecting web3" + str(e))
+                raise
+            logger.info("web3 provider ready")
+            return self.client
+
+    @property
+    def erc20_contract(self):
+        """Contract binding of the token, built once on first use"""
+        if self.contract is None:
+            self.contract = self.w3.eth.contract(
+                address=self.erc20_contract_address, abi=ERC20_ABI
+            )
+        return self.contract
 
     def get_balance(self, address):
+        from web3.exceptions import Web3RPCError
+
         try:
-            balance = self.erc20_contract.functions.balanceOf(address).call()
-            decimals = 18
-            formatted_balance = balance / (10**decimals)
-            return formatted_balance
+            return self.get_balances([address])[0][0]
         except Web3RPCError as e:
             logger.error("web3 rpc error" + str(e))
         except Exception as e:
             logger.error("Couldnot fetch balance" + str(e))
 
-    def transfer(self, from_address, to_address):
-        try:
-            amount = self.w3.to_wei(1, "ether")
-
-            if self.get_balance(self.from_address) >= 1.0:
-                transaction = self.erc20_contract.functions.transfer(
-                    to_address, amount
-                ).build_transaction(
-                    {
-                        "from": from_address,
-                        "gas": 200000,
-                        "gasPrice": self.w3.to_wei("50", "gwei"),
-                        "nonce": self.w3.eth.get_transaction_count(self.from_address),
-                        "chainId": self.chain_id,
-                    }
-                )
+    def get_balances(self, addresses, tokens=None):
+        """
+        Token balances of many addresses, result[i][j] is the balance of
+        addresses[i] in tokens[j] or None when the call failed. Balances
+        of the current head block are served from the balance cache, the
+        remaining balanceOf calls go out as JSON-RPC batches, or as
+        Multicall3 aggregate calls when MULTICALL_ADDRESS is configured
+        """
+        tokens = tokens or [self.erc20_contract_address]
+        decimals = self.get_decimals(tokens)
+        block = self.head_tracker.current()
 
-                signed_txn = self.w3.eth.account.sign_transaction(
-                    transaction, self.private_key
-                )
+        balances = [
+            [self.balance_cache.get(token, address, block) for token in tokens]
+            for address in addresses
+        ]
+        misses = [
+            (i, j)
+            for i, row in enumerate(balances)
+            for j, balance in enumerate(row)
+            if balance is None
+        ]
+        if not misses:
+            return balances
 
-                txn_hash = self.w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        calls = [(tokens[j], encode_balance_of(addresses[i])) for i, j in misses]
+        for (i, j), data in zip(misses, self.eth_calls(calls, hex(block))):
+            raw = decode_uint256(data)
+            if raw is None:
+                continue
+            balances[i][j] = raw / (10 ** decimals[tokens[j]])
+            self.balance_cache.put(tokens[j], addresses[i], block, balances[i][j])
+        return balances
 
-                logger.info(f"Transaction sent with hash: {txn_hash.hex()}")
+    def get_decimals(self, tokens):
+        """Decimals per token, read from the chain once and cached"""
+        missing = [
+            token for token in dict.fromkeys(tokens) if token not in self.token_decimals
+        ]
+        if missing:
+            results = self.eth_calls([(token, DECIMALS_SELECTOR) for token in missing])
+            for token, data in zip(missing, results):
+                decimals = decode_uint256(data)
+                if decimals is None:
+                    raise ValueError(f"Could not read decimals of token {token}")
+                self.token_decimals[token] = decimals
+        return {token: self.token_decimals[token] for token in tokens}
 
-                time.sleep(
-                    5
-                )  # wait for 5 seconds until transaction receipt is generated
+    def eth_calls(self, calls, block="latest"):
+        """
+        Execute (target, calldata) eth_calls at a block, returns
+        the raw result of each call in order, None on failure
+        """
+        if self.multicall_address:
+            chunks = [
+                calls[i : i + MULTICALL_CHUNK_SIZE]
+                for i in range(0, len(calls), MULTICALL_CHUNK_SIZE)
+            ]
+            requests = [
+                (self.multicall_address, encode_aggregate3(chunk)) for chunk in chunks
+            ]
+            results = []
+            for data in self.batch_eth_calls(requests, block):
+                if data is None:
+                    raise ValueError("Multicall aggregate call failed")
+                results.extend(decode_aggregate3(data))
+            return results
+        return self.batch_eth_calls(calls, block)
 
-                txn_receipt = self.w3.eth.get_transaction_receipt(txn_hash)
+    def batch_eth_calls(self, calls, block):
+        results = []
+        for i in range(0, len(calls), BATCH_SIZE):
+            responses = self.make_batch_request(
+                [
+                    ("eth_call", [{"to": target, "data": data}, block])
+                    for target, data in calls[i : i + BATCH_SIZE]
+                ]
+            )
+            results.extend(response.get("result") for response in responses)
+        return results
 
-                if txn_receipt.status == 1:
-                    logger.info(
-                        "Funds transfered from"
-                        + self.from_address
-                        + "to"
-                        + self.to_address
-                    )
+    def fetch_block_number(self):
+        return self.w3.eth.block_number
+
+    def make_batch_request(self, requests):
+        """Send (method, params) pairs as one JSON-RPC batch, raw responses in order"""
+        return self.w3.provider.make_batch_request(requests)
+
+    def transfer(self, from_address, to_address, amount=None):
+        """Transfer amount base units of the token, 1 token by default"""
+        if amount is None:
+            amount = ONE_TOKEN
+        return self.send_transfers(
+            from_address, self.erc20_contract_address, {to_address: amount}
+        )
+
+    def send_transfer_batch(self, batch):
+        """Submit an aggregated TransferBatch as a single transaction"""
+        future = self.send_transfers(
+            batch.from_address, batch.token, batch.amounts, on_sent=batch.sent
+        )
+        if future is None:
+            batch.failed("not sent")
+        return future
+
+    def send_transfers(self, from_address, token, amounts, on_sent=None):
+        """
+        Pay every recipient of amounts in one transaction, a plain token
+        transfer for one recipient and a disperseToken call of the
+        batching contract for several. Returns the receipt future
+        """
+        from web3.exceptions import InvalidTransaction
+
+        try:
+            total = sum(amounts.values())
+            self.get_decimals([token])
+            balance = self.chain_params.balance(token, from_address)
+
+            if balance is not None and balance >= total:
+                for attempt in range(SEND_ATTEMPTS):
+                    nonce = self.nonce_manager.allocate(from_address)
+                    try:
+                        txn_hash = self.send_transfer(
+                            from_address, token, amounts, nonce
+                        )
+                        break
+                    except Exception as e:
+                        retry = self.nonce_manager.handle_error(from_address, nonce, e)
+                        if not retry or attempt == SEND_ATTEMPTS - 1:
+                            raise
+                        logger.info(f"Retrying transfer after nonce error: {e}")
+
+                self.chain_params.debit(token, from_address, total)
+                txn_hash = self.w3.to_hex(txn_hash)
+                logger.info("Transaction sent with hash: %s", txn_hash)
+                EVENTS.publish(
+                    TRANSFER_SENT,
+                    txn_hash=txn_hash,
+                    from_address=from_address,
+                    token=token,
+                    amounts=amounts,
+                    nonce=nonce,
+                )
+
+                future = self.receipt_tracker.track(
+                    txn_hash,
+                    from_address,
+                    nonce,
+                    on_complete=lambda tx: self.on_transfer_complete(
+                        tx, token, amounts
+                    ),
+                )
+                if on_sent:
+                    on_sent(txn_hash, future)
+                return future
             else:
-                logger.info("Not enough funds to transfer from " + self.from_address)
+                logger.info("Not enough funds to transfer from " + from_address)
         except InvalidTransaction as e:
             logger.error("Invalid transaction" + str(e))
-        except TransactionNotFound as e:
-            logger.error("Transaction lookup failed" + str(e))
-        except TransactionIndexingInProgress as e:
-            logger.error("Transaction submitted but yet to be indexed" + str(e))
         except Exception as e:
             logger.error("Exception while transfer" + str(e))
+
+    def on_transfer_complete(self, tx, token, amounts):
+        if tx.future.exception():
+            logger.error("Transfer not confirmed " + str(tx.future.exception()))
+            EVENTS.publish(
+                TRANSFER_FAILED,
+                txn_hash=tx.txn_hash,
+                reason=str(tx.future.exception()),
+            )
+            try:
+                self.nonce_manager.abandon(tx.from_address, tx.nonce)
+            except Exception as e:
+                logger.error("Could not resync nonce after failed transfer" + str(e))
+            return
+        self.nonce_manager.confirm(tx.from_address, tx.nonce)
+        receipt = tx.future.result()
+        if int(receipt["status"], 16) == 1:
+            block = int(receipt["blockNumber"], 16)
+            for to_address, amount in amounts.items():
+                self.balance_cache.apply_transfer(
+                    token,
+                    tx.from_address,
+                    to_address,
+                    amount / (10 ** self.token_decimals[token]),
+                    block,
+                )
+            # the cache already moved to the mined block, catch the head up
+            self.head_tracker.set_head(block)
+            logger.info(
+                "Funds transfered from" + self.from_address + "to" + self.to_address
+            )
+            EVENTS.publish(
+                TRANSFER_CONFIRMED, txn_hash=tx.txn_hash, block=block, amounts=amounts
+            )
+        else:
+            logger.error(f"Transfer {tx.txn_hash} reverted")
+            EVENTS.publish(TRANSFER_FAILED, txn_hash=tx.txn_hash, reason="reverted")
+
+    def send_transfer(self, from_address, token, amounts, nonce):
+        fields = {
+            "from": from_address,
+            "gas": self.chain_params.gas(
+                (token, from_address, len(amounts)),
+                len(amounts),
+                TRANSFER_GAS + RECIPIENT_GAS * (len(amounts) - 1),
+                lambda: build_transfer(
+                    token,
+                    {to_address: 1 for to_address in amounts},
+                    self.batch_contract_address,
+                    {"from": from_address},
+                ),
+            ),
+            "nonce": nonce,
+            "chainId": self.chain_id,
+            **self.chain_params.fees(),
+        }
+        if self.signer is not None:
+            raw_transaction = self.signer.sign_transfer(
+                token, amounts, self.batch_contract_address, fields
+            )
+        else:
+            transaction = build_transfer(
+                token, amounts, self.batch_contract_address, fields
+            )
+            raw_transaction = self.w3.eth.account.sign_transaction(
+                transaction, self.private_key
+            ).raw_transaction
+
+        return self.w3.eth.send_raw_transaction(raw_transaction)